@@ -1,14 +1,27 @@
+from .queryset.advisor import AtlasQueryRecorder, advise_index
+from .queryset.client import AtlasAdminClient
 from .queryset.exceptions import AtlasIndexError, AtlasIndexFieldError
 from .queryset.index import AtlasIndex
-from .queryset.manager import AtlasManager
-from .queryset.node import AtlasQ
-from .queryset.queryset import AtlasQuerySet
+from .queryset.manager import AtlasIndexReport, AtlasManager, ensure_all_indexes
+from .queryset.metadata import AtlasIndexMetadataCache
+from .queryset.node import AtlasQ, Param
+from .queryset.prepared import AtlasPreparedQuery
+from .queryset.queryset import AtlasPage, AtlasQuerySet
 
 __all__ = [
     "AtlasQ",
+    "Param",
+    "AtlasPreparedQuery",
     "AtlasQuerySet",
+    "AtlasPage",
     "AtlasManager",
+    "AtlasIndexReport",
+    "ensure_all_indexes",
     "AtlasIndex",
+    "AtlasAdminClient",
+    "AtlasIndexMetadataCache",
+    "AtlasQueryRecorder",
+    "advise_index",
     "AtlasIndexFieldError",
     "AtlasIndexError",
 ]
@@ -0,0 +1,185 @@
+import datetime
+import threading
+from collections import Counter, defaultdict
+from logging import getLogger
+from typing import Any, Dict, List, Optional, Tuple
+
+from atlasq.queryset.exceptions import AtlasQueryError
+from atlasq.queryset.index import AtlasIndexType
+from atlasq.queryset.node import Param
+from bson import ObjectId
+from mongoengine import fields
+
+logger = getLogger(__name__)
+
+# handler of AtlasTransform -> operator recorded, when they are not the same
+HANDLER_OPERATORS = {
+    "_auto_convert_type_to_keyword": "equals",
+    "_all": "equals",
+}
+# operators that match the whole string, they can use a token field
+EXACT_OPERATORS = frozenset(["equals", "exact"])
+# operators that run on $match, not on the index
+NOT_INDEXED_OPERATORS = frozenset(["size"])
+
+# the order of the types in the advised mapping
+TYPE_ORDER = [
+    AtlasIndexType.STRING.value,
+    AtlasIndexType.TOKEN.value,
+    AtlasIndexType.AUTOCOMPLETE.value,
+    AtlasIndexType.NUMBER.value,
+    AtlasIndexType.DATE.value,
+    AtlasIndexType.BOOLEAN.value,
+    AtlasIndexType.OBJECT_ID.value,
+]
+# for the paths that are just checked for existence
+FIELD_TYPES = (
+    (fields.BooleanField, AtlasIndexType.BOOLEAN.value),
+    ((fields.IntField, fields.LongField, fields.FloatField, fields.DecimalField), AtlasIndexType.NUMBER.value),
+    ((fields.DateTimeField, fields.DateField), AtlasIndexType.DATE.value),
+    ((fields.ObjectIdField, fields.ReferenceField), AtlasIndexType.OBJECT_ID.value),
+    (fields.StringField, AtlasIndexType.STRING.value),
+)
+
+
+class AtlasQueryRecorder:
+    """
+    Paths, operators and value types compiled by AtlasTransform, counted by index and document:
+    documents on different collections can have indexes with the same name.
+    Set it as `AtlasTransform.recorder` to record; the pipelines already cached are not compiled again,
+    so the recorder should be set before the first query.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (index, class name of the document) -> usages
+        self._usages: Dict[Tuple[str, Optional[str]], Counter] = defaultdict(Counter)
+
+    @staticmethod
+    def _value_types(value: Any) -> List[type]:
+        values = value if isinstance(value, (list, tuple, set)) else [value]
+        return list(dict.fromkeys(single.type if isinstance(single, Param) else type(single) for single in values))
+
+    @staticmethod
+    def _document_name(document) -> Optional[str]:
+        # the name, not the class: the recorder does not keep the documents alive
+        return document._class_name if document is not None else None  # pylint: disable=protected-access
+
+    def record(self, index: str, path: str, handler: str, value: Any, document=None) -> None:
+        operator = HANDLER_OPERATORS.get(handler, handler.lstrip("_"))
+        key = (index, self._document_name(document))
+        with self._lock:
+            for value_type in self._value_types(value):
+                self._usages[key][(path, operator, value_type)] += 1
+
+    def usages(self, index: str, document=None) -> Dict[Tuple[str, str, type], int]:
+        """
+        Number of times every (path, operator, value type) has been compiled for the index of the document,
+        or for the indexes with that name of every document if the document is not given.
+        """
+        with self._lock:
+            if document is not None:
+                return dict(self._usages.get((index, self._document_name(document)), {}))
+            usages: Counter = Counter()
+            for (usage_index, _), counter in self._usages.items():
+                if usage_index == index:
+                    usages.update(counter)
+            return dict(usages)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._usages.clear()
+
+
+def _lucene_type(operator: str, value_type: type) -> Optional[str]:
+    # bool is an int, it is checked first
+    if issubclass(value_type, bool):
+        return AtlasIndexType.BOOLEAN.value
+    if issubclass(value_type, ObjectId):
+        return AtlasIndexType.OBJECT_ID.value
+    if issubclass(value_type, (int, float)):
+        return AtlasIndexType.NUMBER.value
+    if issubclass(value_type, (datetime.datetime, datetime.date)):
+        return AtlasIndexType.DATE.value
+    if issubclass(value_type, str):
+        if operator in EXACT_OPERATORS:
+            return AtlasIndexType.TOKEN.value
+        if operator == "startswith":
+            return AtlasIndexType.AUTOCOMPLETE.value
+        return AtlasIndexType.STRING.value
+    return None
+
+
+def _document_field(document, path: str) -> Optional[fields.BaseField]:
+    field = None
+    for part in path.split("."):
+        document_fields = getattr(document, "_fields", {})
+        field = document_fields.get("id" if part == "_id" else part)
+        if field is None:
+            return None
+        inner = field.field if isinstance(field, fields.ListField) else field
+        document = getattr(inner, "document_type", None)
+    return field
+
+
+def _field_type(document, path: str) -> Optional[str]:
+    field = _document_field(document, path)
+    if isinstance(field, fields.ListField):
+        field = field.field
+    for field_classes, lucene_type in FIELD_TYPES:
+        if isinstance(field, field_classes):
+            return lucene_type
+    return None
+
+
+def _document_type(document, path: str) -> str:
+    # lists of embedded documents are indexed as embeddedDocuments, to match the conditions on the same element
+    field = _document_field(document, path)
+    if isinstance(field, fields.ListField) and isinstance(field.field, fields.EmbeddedDocumentField):
+        return AtlasIndexType.EMBEDDED_DOCUMENT.value
+    return AtlasIndexType.DOCUMENT.value
+
+
+def advise_index(document, recorder: Optional[AtlasQueryRecorder] = None) -> Dict:
+    """
+    Minimal static mapping for the queries recorded on the index of the document, in the format of `upload_index`.
+    Every path gets the types its operators and values need, i.e. `token` for the exact matches of strings
+    and `autocomplete` for the prefixes.
+    """
+    if recorder is None:
+        from atlasq.queryset.transform import AtlasTransform  # pylint: disable=import-outside-toplevel
+
+        recorder = AtlasTransform.recorder
+        if recorder is None:
+            raise AtlasQueryError("No query recorded, set AtlasTransform.recorder")
+    index_name = document.atlas.index.index
+    types: Dict[str, set] = defaultdict(set)
+    for path, operator, value_type in recorder.usages(index_name, document):
+        if operator in NOT_INDEXED_OPERATORS:
+            continue
+        lucene_type = _field_type(document, path) if operator == "exists" else _lucene_type(operator, value_type)
+        if lucene_type is None:
+            if operator == "exists":
+                # the existence of any type is enough
+                types.setdefault(path, set())
+            else:
+                logger.warning(f"No index type for {operator} on {path} with {value_type.__name__}")
+            continue
+        types[path].add(lucene_type)
+
+    # paths of the documents with queried fields
+    parents = {".".join(path.split(".")[:i]) for path in types for i in range(1, path.count(".") + 1)}
+    mapping: Dict[str, Any] = {"dynamic": False, "fields": {}}
+    for path in sorted(types):
+        if path in parents:
+            if types[path]:
+                logger.warning(f"{path} is queried both as a field and as a document, it is indexed as a document")
+            continue
+        parent = mapping
+        parts = path.split(".")
+        for i, part in enumerate(parts[:-1]):
+            partial_path = ".".join(parts[: i + 1])
+            parent = parent["fields"].setdefault(part, {"type": _document_type(document, partial_path), "dynamic": False, "fields": {}})
+        definitions = [{"type": lucene_type} for lucene_type in sorted(types[path], key=TYPE_ORDER.index) or [AtlasIndexType.STRING.value]]
+        parent["fields"][parts[-1]] = definitions[0] if len(definitions) == 1 else definitions
+    return {"mappings": mapping}
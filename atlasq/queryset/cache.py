@@ -0,0 +1,91 @@
+import copy
+import datetime
+import threading
+from collections import OrderedDict
+from logging import getLogger
+from typing import Any, Callable, Dict, Hashable, List
+
+from bson import ObjectId
+
+logger = getLogger(__name__)
+
+# values that can be part of a fingerprint, other ones (i.e. QuerySet) may change between two queries
+FINGERPRINT_TYPES = (str, int, float, bool, type(None), ObjectId, datetime.datetime, datetime.date)
+# longer lists (i.e. chunks of ids) are unlikely to be queried again, and would fill the cache with huge pipelines
+FINGERPRINT_MAX_LIST = 100
+
+
+def fingerprint(value: Any) -> Hashable:
+    """
+    Canonical and hashable representation of a (combination of) AtlasQ.
+    Raises TypeError if a value cannot be represented, i.e. a QuerySet.
+    """
+    if hasattr(value, "pipeline"):
+        # AtlasBoundQ, already compiled
+        raise TypeError("Unable to fingerprint a compiled query")
+    if hasattr(value, "children"):
+        return value.operation, tuple(fingerprint(child) for child in value.children)
+    if hasattr(value, "query"):
+        return tuple(sorted((key, fingerprint(val)) for key, val in value.query.items()))
+    if isinstance(value, (list, tuple)):
+        if len(value) > FINGERPRINT_MAX_LIST:
+            raise TypeError(f"Unable to fingerprint a {type(value).__name__} of {len(value)} elements")
+        return type(value).__name__, tuple(fingerprint(val) for val in value)
+    if isinstance(value, dict):
+        return "dict", tuple(sorted((key, fingerprint(val)) for key, val in value.items()))
+    if not isinstance(value, FINGERPRINT_TYPES):
+        raise TypeError(f"Unable to fingerprint {type(value)}")
+    # the type is needed, otherwise True and 1 would have the same fingerprint
+    return type(value).__name__, value
+
+
+class AtlasPipelineCache:
+    """
+    Bounded LRU cache of the compiled pipelines.
+    """
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize: int = maxsize
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+        # clauses of the compiled $search stages, before and after AtlasSearchOptimizer
+        self.clauses_before: int = 0
+        self.clauses_after: int = 0
+        self._pipelines: "OrderedDict[Hashable, List[Dict]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._pipelines)
+
+    def clear(self):
+        with self._lock:
+            self._pipelines.clear()
+            self.hits = self.misses = self.evictions = 0
+            self.clauses_before = self.clauses_after = 0
+
+    def record_optimization(self, clauses_before: int, clauses_after: int):
+        with self._lock:
+            self.clauses_before += clauses_before
+            self.clauses_after += clauses_after
+
+    def get_or_compile(self, key: Hashable, compile_pipeline: Callable[[], List[Dict]]) -> List[Dict]:
+        with self._lock:
+            pipeline = self._pipelines.get(key)
+            if pipeline is not None:
+                self._pipelines.move_to_end(key)
+                self.hits += 1
+                # the caller is free to change the pipeline
+                return copy.deepcopy(pipeline)
+            self.misses += 1
+        pipeline = compile_pipeline()
+        if self.maxsize <= 0:
+            return pipeline
+        with self._lock:
+            self._pipelines[key] = copy.deepcopy(pipeline)
+            self._pipelines.move_to_end(key)
+            while len(self._pipelines) > self.maxsize:
+                evicted, _ = self._pipelines.popitem(last=False)
+                self.evictions += 1
+                logger.debug(f"Evicted pipeline {evicted}")
+        return pipeline
@@ -0,0 +1,120 @@
+import random
+import threading
+import time
+from logging import getLogger
+from typing import Dict, Optional, Tuple, Union
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPDigestAuth
+
+logger = getLogger(__name__)
+
+ATLAS_BASE_URL = "https://cloud.mongodb.com/api/atlas/v1.0"
+
+
+class AtlasAdminClient:
+    """
+    Client of the Atlas Admin API, shared by the indexes with the same credentials.
+    A single session pools the connections and reuses the digest nonce, instead of a handshake and a challenge per call.
+    The requests throttled (429) or failed by the server (5xx) are retried with a bounded exponential backoff and jitter.
+    """
+
+    retry_statuses = frozenset([429, 500, 502, 503, 504])
+    # a POST is retried only if the server did not process it (429)
+    idempotent_methods = frozenset(["GET", "HEAD", "PUT", "PATCH", "DELETE"])
+
+    _clients: Dict[Tuple[str, str], "AtlasAdminClient"] = {}
+    _clients_lock = threading.Lock()
+
+    # pylint: disable=too-many-arguments
+    def __init__(
+        self,
+        user: str,
+        password: str,
+        timeout: Union[float, Tuple[float, float]] = (3.05, 30),
+        retries: int = 3,
+        backoff_factor: float = 0.5,
+        max_backoff: float = 10,
+        pool_maxsize: int = 10,
+        base_url: str = ATLAS_BASE_URL,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.session = requests.Session()
+        # the digest auth keeps the last nonce, so only the first request of the session is challenged
+        self.session.auth = HTTPDigestAuth(user, password)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    @classmethod
+    def shared(cls, user: str, password: str) -> "AtlasAdminClient":
+        """
+        Client of the credentials, created on the first call.
+        """
+        with cls._clients_lock:
+            if (user, password) not in cls._clients:
+                cls._clients[(user, password)] = cls(user, password)
+            return cls._clients[(user, password)]
+
+    def close(self):
+        self.session.close()
+
+    def backoff(self, attempt: int, response: Optional[requests.Response] = None) -> float:
+        retry_after = (getattr(response, "headers", None) or {}).get("Retry-After")
+        if retry_after is not None:
+            try:
+                return min(self.max_backoff, max(0.0, float(retry_after)))
+            except ValueError:
+                pass
+        # full jitter, so that the clients throttled together do not retry together
+        return random.uniform(0, min(self.max_backoff, self.backoff_factor * 2**attempt))
+
+    def build_url(self, url: str) -> str:
+        """
+        Url of the endpoint on the base url of the client.
+        The endpoints are formatted on the Atlas base url, a relative path is joined to the base url.
+        """
+        if url.startswith(ATLAS_BASE_URL):
+            url = url[len(ATLAS_BASE_URL) :]
+        if url.startswith("/"):
+            return self.base_url + url
+        return url
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        method = method.upper()
+        url = self.build_url(url)
+        kwargs.setdefault("timeout", self.timeout)
+        attempt = 0
+        while True:
+            response = None
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= self.retries or method not in self.idempotent_methods:
+                    raise
+                logger.debug(f"{method} {url} failed: {e!r}")
+            else:
+                if (
+                    attempt >= self.retries
+                    or response.status_code not in self.retry_statuses
+                    or (method not in self.idempotent_methods and response.status_code != 429)
+                ):
+                    return response
+            delay = self.backoff(attempt, response)
+            logger.warning(f"Retrying {method} {url} in {delay:0.2f}s, attempt {attempt + 1} of {self.retries}")
+            time.sleep(delay)
+            attempt += 1
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+    def patch(self, url: str, **kwargs) -> requests.Response:
+        return self.request("PATCH", url, **kwargs)
@@ -0,0 +1,239 @@
+import copy
+import datetime
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+from atlasq.queryset.index import AtlasIndex, AtlasIndexType
+from bson import ObjectId
+from mongoengine.queryset.visitor import QCombination, QNode
+
+logger = logging.getLogger(__name__)
+
+# filters of the $search stage without the index (None if there are no filters) and the other aggregations
+CompiledNode = Tuple[Optional[Dict], List[Dict]]
+
+
+class AtlasQueryCompiler:
+    """
+    Compiles a tree of AtlasQ to the pipeline in a single pass, without recursion.
+    It produces the same pipeline as AtlasSimplificationVisitor and AtlasQueryCompilerVisitor,
+    and it does not change the tree.
+    """
+
+    def __init__(self, document, atlas_index: AtlasIndex):
+        self.document = document
+        # the copy keeps the current snapshot of the index, even if it is refreshed during the compilation
+        self.atlas_index = copy.copy(atlas_index)
+
+    def compile(self, node: QNode) -> List[Dict]:
+        filters, aggregations = self._compile(node)
+        if filters is None:
+            return aggregations
+        filters["index"] = self.atlas_index.index
+        return [{"$search": filters}] + aggregations
+
+    def _compile(self, root: QNode) -> CompiledNode:
+        # post order visit: a combination is pushed back with the number of its children,
+        # and it is compiled when the results of all of them are on top of `results`
+        stack: List[Tuple[QNode, Optional[int]]] = [(root, None)]
+        results: List[CompiledNode] = []
+        while stack:
+            node, children_count = stack.pop()
+            if children_count is not None:
+                children = results[len(results) - children_count :]
+                del results[len(results) - children_count :]
+                if node.operation == node.AND:
+                    results.append(self._compile_and(children))
+                else:
+                    results.append(self._compile_or(children))
+                continue
+            if not isinstance(node, QCombination):
+                results.append(self._compile_node(node))
+                continue
+            children = self._flatten(node)
+            query = self._simplify(node, children)
+            if query is not None:
+                results.append(self._compile_query(query))
+                continue
+            stack.append((node, len(children)))
+            stack.extend((child, None) for child in reversed(children))
+        return results[0]
+
+    @staticmethod
+    def _flatten(combination: QCombination) -> List[QNode]:
+        # children of the same operation are merged, empty children are ignored
+        children = []
+        pending = list(reversed(combination.children))
+        while pending:
+            child = pending.pop()
+            if isinstance(child, QCombination) and child.operation == combination.operation:
+                pending.extend(reversed(child.children))
+            elif child:
+                children.append(child)
+        return children
+
+    @staticmethod
+    def _simplify(combination: QCombination, children: List[QNode]) -> Optional[Dict[str, Any]]:
+        # same as SimplificationVisitor: a conjunction of queries without the same keys is a single query
+        if combination.operation != combination.AND:
+            return None
+        query = {}
+        for child in children:
+            if isinstance(child, QCombination) or hasattr(child, "pipeline"):
+                return None
+            if not query.keys().isdisjoint(child.query.keys()):
+                return None
+            query.update(child.query)
+        return query
+
+    def _compile_node(self, node: QNode) -> CompiledNode:
+        if not hasattr(node, "pipeline"):
+            return self._compile_query(node.query)
+        # AtlasBoundQ, already compiled
+        first, *aggregations = copy.deepcopy(node.pipeline) or [{}]
+        if "$search" not in first:
+            return None, [first] + aggregations if first else aggregations
+        first["$search"].pop("index", None)
+        return first["$search"], aggregations
+
+    def _compile_query(self, query: Dict[str, Any]) -> CompiledNode:
+        from atlasq.queryset.transform import AtlasTransform
+
+        if not query:
+            return None, []
+        affirmative, negative, aggregations = AtlasTransform(query, self.atlas_index, self.document).transform()
+        compound = {}
+        if affirmative:
+            compound["filter"] = affirmative
+        if negative:
+            compound["mustNot"] = negative
+        return ({"compound": compound} if compound else None), aggregations
+
+    @staticmethod
+    def _compile_and(children: List[CompiledNode]) -> CompiledNode:
+        affirmatives = []
+        negatives = []
+        aggregations = []
+        for filters, child_aggregations in children:
+            if filters is not None:
+                compound = filters.get("compound", {})
+                affirmatives.extend(compound.get("filter", []))
+                negatives.extend(compound.get("mustNot", []))
+                if "should" in compound:
+                    affirmatives.append(filters)
+            aggregations.extend(child_aggregations)
+        compound = {}
+        if affirmatives:
+            compound["filter"] = affirmatives
+        if negatives:
+            compound["mustNot"] = negatives
+        return {"compound": compound}, aggregations
+
+    @staticmethod
+    def _compile_or(children: List[CompiledNode]) -> CompiledNode:
+        should = []
+        aggregations = []
+        for filters, child_aggregations in children:
+            if filters is not None:
+                should.append(filters)
+            aggregations.extend(child_aggregations)
+        return {"compound": {"should": should, "minimumShouldMatch": 1}}, aggregations
+
+
+class AtlasIndexRouter:
+    """
+    Chooses the index of a query: the smallest ensured index that covers every path and operator of the query.
+    A path is covered if it is indexed, with a type that supports the operator and the values;
+    the fields of dynamic documents cover everything, but the dynamic indexes are the last choice.
+    """
+
+    # operators that analyze the value, they need a string field
+    text_handlers = frozenset(["_text", "_regex", "_endswith", "_startswith"])
+    # they do not use the index
+    aggregation_handlers = frozenset(["_size"])
+    value_types = (
+        # bool is an int, it is checked first
+        (bool, {AtlasIndexType.BOOLEAN.value}),
+        (ObjectId, {AtlasIndexType.OBJECT_ID.value}),
+        ((int, float), {AtlasIndexType.NUMBER.value}),
+        (datetime.datetime, {AtlasIndexType.DATE.value}),
+    )
+
+    def __init__(self, indexes: List[AtlasIndex], default: AtlasIndex):
+        self.indexes = indexes
+        self.default = default
+
+    @staticmethod
+    def usages(root: QNode) -> Optional[List[Tuple[str, str, Any]]]:
+        """
+        Path, handler and value of every condition of the query, None if the query is already compiled.
+        """
+        from atlasq.queryset.transform import AtlasTransform
+
+        usages = []
+        pending = [root]
+        while pending:
+            node = pending.pop()
+            if isinstance(node, QCombination):
+                pending.extend(node.children)
+            elif hasattr(node, "pipeline"):
+                return None
+            else:
+                for key, value in node.query.items():
+                    plan = AtlasTransform._parse_key(key)  # pylint: disable=protected-access
+                    usages.append((plan.path, plan.handler, value))
+        return usages
+
+    def _accepted_types(self, handler: str, value: Any) -> List[set]:
+        from atlasq.queryset.node import Param
+
+        # for every value, the index types that support it
+        accepted = []
+        for single in value if isinstance(value, (list, tuple, set)) else [value]:
+            value_type = single.type if isinstance(single, Param) else type(single)
+            if issubclass(value_type, str):
+                if handler in self.text_handlers:
+                    types = {AtlasIndexType.STRING.value}
+                    if handler == "_startswith":
+                        types.add(AtlasIndexType.AUTOCOMPLETE.value)
+                else:
+                    types = {AtlasIndexType.STRING.value, AtlasIndexType.TOKEN.value}
+                accepted.append(types)
+                continue
+            for python_types, types in self.value_types:
+                if issubclass(value_type, python_types):
+                    accepted.append(types)
+                    break
+        return accepted
+
+    def covers(self, index: AtlasIndex, usages: List[Tuple[str, str, Any]]) -> bool:
+        if not index.ensured:
+            return False
+        for path, handler, value in usages:
+            if handler in self.aggregation_handlers:
+                continue
+            parts = path.split(".")
+            if not all(index.ensure_keyword_is_indexed(".".join(parts[: i + 1])) for i in range(len(parts))):
+                return False
+            if handler == "_exists":
+                continue
+            # empty for the fields of dynamic documents
+            types = set(index.get_types_from_keyword(path))
+            if types and any(not accepted & types for accepted in self._accepted_types(handler, value)):
+                return False
+        return True
+
+    @staticmethod
+    def _size(index: AtlasIndex) -> Tuple[bool, int]:
+        indexed_fields = index.snapshot.indexed_fields
+        return "*" in indexed_fields, len(indexed_fields)
+
+    def route(self, node: QNode) -> AtlasIndex:
+        usages = self.usages(node)
+        if usages is None:
+            return self.default
+        candidates = [index for index in self.indexes if self.covers(index, usages)]
+        if not candidates:
+            logger.debug(f"No index covers the query, using {self.default.index}")
+            return self.default
+        return min(candidates, key=self._size)
@@ -1,18 +1,33 @@
 import fnmatch
+import functools
+import itertools
+import json
+import random
+import threading
+import time
 from enum import Enum
 from logging import getLogger
-from typing import Dict, List, Union
+from types import MappingProxyType
+from typing import Any, Callable, Dict, FrozenSet, Iterable, List, Mapping, Optional, Tuple, Union
 
 import requests
+from atlasq.queryset.client import ATLAS_BASE_URL, AtlasAdminClient
 from atlasq.queryset.exceptions import AtlasIndexError, AtlasIndexFieldError
-from requests.auth import HTTPDigestAuth
+from atlasq.queryset.metadata import AtlasIndexMetadataCache
 
 logger = getLogger(__name__)
 
-ATLAS_BASE_URL = "https://cloud.mongodb.com/api/atlas/v1.0"
 TEXT_INDEXES_ENDPOINT = ATLAS_BASE_URL + "/groups/{GROUP_ID}/clusters/{CLUSTER_NAME}/fts/indexes"
 
 LIST_TEXT_INDEXES_ENDPOINT = TEXT_INDEXES_ENDPOINT + "/{DATABASE_NAME}/{COLLECTION_NAME}"
+TEXT_INDEX_ENDPOINT = TEXT_INDEXES_ENDPOINT + "/{INDEX_ID}"
+
+# the parts of the definition that need a rebuild when they change
+INDEX_DEFINITION_FIELDS = ("analyzer", "searchAnalyzer", "analyzers", "mappings", "synonyms", "storedSource")
+INDEX_READY_STATUS = "STEADY"
+INDEX_FAILED_STATUS = "FAILED"
+# resolved keywords kept by every snapshot: on dynamic indexes the keywords of the queries are unbounded
+RESOLVED_KEYWORDS_MAX_SIZE = 4096
 
 
 class AtlasIndexType(Enum):
@@ -23,19 +38,278 @@ class AtlasIndexType(Enum):
     BOOLEAN = "boolean"
     DATE = "date"
     OBJECT_ID = "objectId"
+    TOKEN = "token"
+    AUTOCOMPLETE = "autocomplete"
+    STRING_FACET = "stringFacet"
 
     @classmethod
     def values(cls) -> List[str]:
         return [e.value for e in cls]
 
 
+def _normalize_definition(value: Any) -> Any:
+    if isinstance(value, list):
+        # the order is relevant, i.e. for the token filters of an analyzer
+        return [_normalize_definition(single) for single in value]
+    if isinstance(value, dict):
+        return {key: _normalize_definition(single) for key, single in value.items() if single is not None}
+    return value
+
+
+def _normalize_fields(fields: Dict) -> Dict:
+    return {name: _normalize_field(definition) for name, definition in fields.items() if definition is not None}
+
+
+def _normalize_field(definition: Any) -> Any:
+    definitions = []
+    for single in definition if isinstance(definition, list) else [definition]:
+        single = _normalize_definition(single)
+        if isinstance(single, dict):
+            if isinstance(single.get("fields"), dict):
+                single["fields"] = _normalize_fields(single["fields"])
+            if single.get("type") in (AtlasIndexType.DOCUMENT.value, AtlasIndexType.EMBEDDED_DOCUMENT.value):
+                single.setdefault("dynamic", False)
+        definitions.append(single)
+    # a field with a single type can be a list of one definition, and the order of the types is not relevant
+    if len(definitions) == 1:
+        return definitions[0]
+    return sorted(definitions, key=lambda single: json.dumps(single, sort_keys=True))
+
+
+def normalize_index_definition(definition: Dict) -> Dict:
+    """
+    Parts of the definition that need a rebuild when they change, with the defaults of Atlas made explicit.
+    """
+    normalized = {field: _normalize_definition(definition[field]) for field in INDEX_DEFINITION_FIELDS if definition.get(field) is not None}
+    normalized.setdefault("analyzer", "lucene.standard")
+    normalized.setdefault("searchAnalyzer", normalized["analyzer"])
+    normalized.setdefault("analyzers", [])
+    normalized.setdefault("synonyms", [])
+    normalized.setdefault("storedSource", False)
+    mappings = normalized.setdefault("mappings", {})
+    mappings.setdefault("dynamic", False)
+    if not mappings["dynamic"]:
+        mappings.setdefault("fields", {})
+    if isinstance(mappings.get("fields"), dict):
+        mappings["fields"] = _normalize_fields(mappings["fields"])
+    return normalized
+
+
+def diff_index_definitions(current: Dict, desired: Dict) -> List[str]:
+    """
+    Paths where the normalized definitions differ, empty if the index does not need a rebuild.
+    """
+    differences = []
+    pending = [("", normalize_index_definition(current), normalize_index_definition(desired))]
+    while pending:
+        path, old, new = pending.pop()
+        if isinstance(old, dict) and isinstance(new, dict):
+            for key in sorted(old.keys() | new.keys(), reverse=True):
+                pending.append((f"{path}.{key}" if path else key, old.get(key), new.get(key)))
+        elif old != new:
+            differences.append(path)
+    return differences
+
+
+class _IndexedFieldNode:
+    __slots__ = ("children", "lucene_type", "dynamic_type")
+
+    def __init__(self):
+        self.children: Dict[str, "_IndexedFieldNode"] = {}
+        # None if the node is just a prefix of the indexed fields
+        self.lucene_type: Optional[str] = None
+        # not None if the node is a dynamic document, every field below is indexed
+        self.dynamic_type: Optional[str] = None
+
+
+class IndexedFieldsTrie:
+    """
+    Indexed fields by the parts of their paths, so that a lookup depends on the depth of the path
+    and not on the number of the indexed fields.
+    A `field.*` (dynamic document) matches every path below `field`, as fnmatch would.
+    """
+
+    def __init__(self, indexed_fields: Union[Mapping[str, str], Iterable[str]]):
+        self._root = _IndexedFieldNode()
+        # patterns that are not simple dynamic documents, matched with fnmatch
+        self._patterns: Dict[str, str] = {}
+        items = indexed_fields.items() if isinstance(indexed_fields, Mapping) else ((field, "") for field in indexed_fields)
+        for field, lucene_type in items:
+            lucene_type = lucene_type or ""
+            if field == "*":
+                self._root.dynamic_type = lucene_type
+            elif field.endswith(".*") and not any(char in field[:-2] for char in "*?["):
+                self._insert(field[:-2]).dynamic_type = lucene_type
+            elif any(char in field for char in "*?["):
+                self._patterns[field] = lucene_type
+            else:
+                self._insert(field).lucene_type = lucene_type
+
+    def _insert(self, field: str) -> _IndexedFieldNode:
+        node = self._root
+        for part in field.split("."):
+            node = node.children.setdefault(part, _IndexedFieldNode())
+        return node
+
+    def resolve(self, keyword: str) -> Tuple[bool, Optional[str]]:
+        """
+        If the keyword is indexed, and its type.
+        """
+        node = self._root
+        dynamic_type = None
+        for part in keyword.split("."):
+            if node.dynamic_type is not None:
+                # the deepest dynamic document wins
+                dynamic_type = node.dynamic_type
+            node = node.children.get(part)
+            if node is None:
+                break
+        else:
+            if node.lucene_type is not None:
+                return True, node.lucene_type
+        if dynamic_type is not None:
+            return True, dynamic_type
+        for pattern, lucene_type in self._patterns.items():
+            if fnmatch.fnmatch(keyword, pattern):
+                return True, lucene_type
+        return False, None
+
+
+class AtlasIndexSnapshot:
+    """
+    Definition of an index at a point in time, never changed once built.
+    A new definition is built aside and swapped in the AtlasIndex, so a query never sees a half-built mapping.
+    """
+
+    __slots__ = ("ensured", "indexed_fields", "indexed_types", "multi_analyzers", "reverse_analyzers", "version", "_trie", "_resolve_cached")
+
+    _versions = itertools.count(1)
+
+    # pylint: disable=too-many-arguments
+    def __init__(
+        self,
+        indexed_fields: Union[Mapping[str, str], Iterable[str], None] = None,
+        indexed_types: Optional[Mapping[str, Iterable[str]]] = None,
+        multi_analyzers: Optional[Mapping[str, Mapping[str, str]]] = None,
+        reverse_analyzers: Iterable[str] = (),
+        ensured: bool = False,
+    ):
+        if indexed_fields is not None and not isinstance(indexed_fields, Mapping):
+            indexed_fields = dict.fromkeys(indexed_fields, "")
+        # the read only views of another snapshot are shared as they are
+        self.indexed_fields: Mapping[str, str] = self._freeze(indexed_fields or {}, str)
+        # a field can be indexed with more types, i.e. string and token
+        self.indexed_types: Mapping[str, Tuple[str, ...]] = self._freeze(indexed_types or {}, tuple)
+        # field -> name of the multi analyzer -> analyzer
+        self.multi_analyzers: Mapping[str, Mapping[str, str]] = self._freeze(multi_analyzers or {}, lambda multi: self._freeze(multi, str))
+        # custom analyzers that reverse the tokens
+        self.reverse_analyzers: FrozenSet[str] = frozenset(reverse_analyzers)
+        self.ensured: bool = ensured
+        # every snapshot has its own version, i.e. to key the compiled pipelines
+        self.version: int = next(self._versions)
+        # built on the first lookup; two threads building it at the same time build the same trie
+        self._trie: Optional[IndexedFieldsTrie] = None
+        self._resolve_cached: Callable[[str], Tuple[bool, Optional[str]]] = functools.lru_cache(maxsize=RESOLVED_KEYWORDS_MAX_SIZE)(self._resolve)
+
+    @staticmethod
+    def _freeze(mapping: Mapping, freeze_value: Callable) -> Mapping:
+        if isinstance(mapping, MappingProxyType):
+            return mapping
+        return MappingProxyType({key: freeze_value(value) for key, value in mapping.items()})
+
+    def replace(self, **changes) -> "AtlasIndexSnapshot":
+        """
+        New snapshot with the given attributes changed.
+        """
+        attributes = {
+            "indexed_fields": self.indexed_fields,
+            "indexed_types": self.indexed_types,
+            "multi_analyzers": self.multi_analyzers,
+            "reverse_analyzers": self.reverse_analyzers,
+            "ensured": self.ensured,
+        }
+        attributes.update(changes)
+        return AtlasIndexSnapshot(**attributes)
+
+    @classmethod
+    def from_index_result(cls, index_result: Dict, ensured: bool = True) -> "AtlasIndexSnapshot":
+        """
+        Snapshot of an index definition, as returned by the Atlas API.
+        """
+        reverse_analyzers = [
+            analyzer["name"]
+            for analyzer in index_result.get("analyzers", [])
+            if any(token_filter.get("type") == "reverse" for token_filter in analyzer.get("tokenFilters", []))
+        ]
+        mappings = {**index_result["mappings"], "type": AtlasIndexType.DOCUMENT.value}
+        return cls(reverse_analyzers=reverse_analyzers, ensured=ensured).with_fields(mappings)
+
+    def with_fields(self, index_result: Union[Dict, List], base_field: str = "") -> "AtlasIndexSnapshot":
+        """
+        New snapshot with the fields of the mapping added.
+        """
+        indexed_fields = dict(self.indexed_fields)
+        indexed_types = {field: list(types) for field, types in self.indexed_types.items()}
+        multi_analyzers = {field: dict(multi) for field, multi in self.multi_analyzers.items()}
+        self._collect_fields(index_result, base_field, indexed_fields, indexed_types, multi_analyzers)
+        logger.debug(indexed_fields)
+        return self.replace(indexed_fields=indexed_fields, indexed_types=indexed_types, multi_analyzers=multi_analyzers)
+
+    @classmethod
+    def _collect_fields(
+        cls,
+        index_result: Union[Dict, List],
+        base_field: str,
+        indexed_fields: Dict[str, str],
+        indexed_types: Dict[str, List[str]],
+        multi_analyzers: Dict[str, Dict[str, str]],
+    ):
+        if isinstance(index_result, list):
+            for obj in index_result:
+                cls._collect_fields(obj, base_field, indexed_fields, indexed_types, multi_analyzers)
+        else:
+            lucene_type = index_result["type"]
+            if lucene_type in [
+                AtlasIndexType.DOCUMENT.value,
+                AtlasIndexType.EMBEDDED_DOCUMENT.value,
+            ]:
+                if not index_result.get("dynamic", False):
+                    for field, value in index_result.get("fields", {}).items():
+                        field = f"{base_field}.{field}" if base_field else field
+                        cls._collect_fields(value, field, indexed_fields, indexed_types, multi_analyzers)
+                else:
+                    indexed_fields[f"{base_field}.*" if base_field else "*"] = ""
+            if base_field:
+                if lucene_type not in AtlasIndexType.values():
+                    logger.warning(f"Lucene type {lucene_type} not configured")
+                else:
+                    indexed_fields[base_field] = lucene_type
+                    types = indexed_types.setdefault(base_field, [])
+                    if lucene_type not in types:
+                        types.append(lucene_type)
+                    for name, multi in index_result.get("multi", {}).items():
+                        analyzer = multi.get("searchAnalyzer", multi.get("analyzer", ""))
+                        multi_analyzers.setdefault(base_field, {})[name] = analyzer
+
+    def resolve(self, keyword: str) -> Tuple[bool, Optional[str]]:
+        """
+        If the keyword is indexed, and its type.
+        """
+        return self._resolve_cached(keyword)
+
+    def _resolve(self, keyword: str) -> Tuple[bool, Optional[str]]:
+        if self._trie is None:
+            self._trie = IndexedFieldsTrie(self.indexed_fields)
+        return self._trie.resolve(keyword)
+
+
 class AtlasIndex:
 
-    fields_to_copy = ["ensured", "_indexed_fields"]
+    # the snapshot is immutable, the copies can share it
+    fields_to_copy = ["_snapshot"]
 
     def __init__(self, index_name: str):
-        self._indexed_fields: Dict[str, str] = {}
-        self.ensured: bool = False
+        self._snapshot: AtlasIndexSnapshot = AtlasIndexSnapshot()
         self._index: str = index_name
 
     def __copy__(self):
@@ -44,6 +318,30 @@ class AtlasIndex:
             setattr(res, field, getattr(self, field))
         return res
 
+    @property
+    def snapshot(self) -> AtlasIndexSnapshot:
+        return self._snapshot
+
+    @property
+    def version(self) -> int:
+        return self._snapshot.version
+
+    @property
+    def ensured(self) -> bool:
+        return self._snapshot.ensured
+
+    @ensured.setter
+    def ensured(self, ensured: bool):
+        self._snapshot = self._snapshot.replace(ensured=ensured)
+
+    @property
+    def _indexed_fields(self) -> Mapping[str, str]:
+        return self._snapshot.indexed_fields
+
+    @_indexed_fields.setter
+    def _indexed_fields(self, indexed_fields: Union[Mapping[str, str], Iterable[str]]):
+        self._snapshot = self._snapshot.replace(indexed_fields=indexed_fields)
+
     @property
     def index(self) -> str:
         return self._index
@@ -61,7 +359,13 @@ class AtlasIndex:
         password: str,
         group_id: str,
         cluster_name: str,
-    ):
+        client: Optional[AtlasAdminClient] = None,
+        metadata_cache: Optional[AtlasIndexMetadataCache] = None,
+    ) -> Dict:
+        """
+        Creates the index, or updates it if the definition of the collection index with the same name is different.
+        The new definition replaces the one in the metadata cache, that may say that the index does not exist.
+        """
         if not self.index:
             raise AtlasIndexError("No index defined")
 
@@ -80,20 +384,56 @@ class AtlasIndex:
             if "_id" not in data["mappings"]["fields"]:
                 data["mappings"]["fields"]["_id"] = {"type": AtlasIndexType.OBJECT_ID.value}
 
-        url = TEXT_INDEXES_ENDPOINT.format(
+        client = client or AtlasAdminClient.shared(user, password)
+        current = None
+        if "database" in data and "collectionName" in data:
+            index_results = self.list_indexes(client, group_id, cluster_name, data["database"], data["collectionName"])
+            current = next((result for result in index_results if result["name"] == data.get("name", self.index)), None)
+        if current is None:
+            url = TEXT_INDEXES_ENDPOINT.format(
+                GROUP_ID=group_id,
+                CLUSTER_NAME=cluster_name,
+            )
+            response = client.post(
+                url,
+                json=data,
+                headers={"Content-Type": "application/json"},
+            )
+            response.raise_for_status()
+            return self._cache_uploaded(response.json(), data, group_id, cluster_name, metadata_cache)
+        # a new definition rebuilds the whole index, it is sent only if something changed
+        differences = diff_index_definitions(current, data)
+        if not differences:
+            logger.info(f"Index {current['name']} is up to date")
+            return current
+        logger.info(f"Updating index {current['name']}, changed {differences}")
+        url = TEXT_INDEX_ENDPOINT.format(
             GROUP_ID=group_id,
             CLUSTER_NAME=cluster_name,
+            INDEX_ID=current["indexID"],
         )
-        response = requests.post(
+        response = client.patch(
             url,
             json=data,
-            auth=HTTPDigestAuth(user, password),
             headers={"Content-Type": "application/json"},
         )
         response.raise_for_status()
+        return self._cache_uploaded(response.json(), data, group_id, cluster_name, metadata_cache)
+
+    def _cache_uploaded(self, index_result: Dict, data: Dict, group_id: str, cluster_name: str, metadata_cache: Optional[AtlasIndexMetadataCache]) -> Dict:
+        if metadata_cache and "database" in data and "collectionName" in data:
+            key = (group_id, cluster_name, data["database"], data["collectionName"], data.get("name", self.index))
+            self._cache_index_result(metadata_cache, key, index_result)
+        return index_result
+
+    def _cache_index_result(self, metadata_cache: AtlasIndexMetadataCache, key: Tuple[str, ...], index_result: Optional[Dict]):
+        try:
+            metadata_cache.set(key, index_result)
+        except OSError as e:
+            logger.warning(f"Unable to cache the metadata of index {self.index}: {e}")
 
     # pylint: disable=too-many-arguments
-    def ensure_index_exists(
+    def wait_until_ready(
         self,
         user: str,
         password: str,
@@ -101,64 +441,216 @@ class AtlasIndex:
         cluster_name: str,
         db_name: str,
         collection_name: str,
-    ):
+        timeout: float = 600,
+        client: Optional[AtlasAdminClient] = None,
+        poll_interval: float = 1,
+        max_poll_interval: float = 30,
+    ) -> bool:
+        """
+        Polls the status of the index, with an exponential backoff, until it is ready to be queried.
+        False if the index is not ready within `timeout` seconds.
+        """
         if not self.index:
             raise AtlasIndexError("No index defined")
+        client = client or AtlasAdminClient.shared(user, password)
+        deadline = time.monotonic() + timeout
+        while True:
+            index_results = self.list_indexes(client, group_id, cluster_name, db_name, collection_name)
+            index_result = next((result for result in index_results if result["name"] == self.index), None)
+            status = index_result.get("status") if index_result else None
+            if status == INDEX_READY_STATUS:
+                return True
+            if status == INDEX_FAILED_STATUS:
+                raise AtlasIndexError(f"Build of index {self.index} failed")
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                logger.warning(f"Index {self.index} not ready after {timeout}s, status {status}")
+                return False
+            logger.debug(f"Index {self.index} is {status}, polling again in {poll_interval}s")
+            time.sleep(min(poll_interval, remaining))
+            poll_interval = min(poll_interval * 2, max_poll_interval)
+
+    @staticmethod
+    def list_indexes(client: AtlasAdminClient, group_id: str, cluster_name: str, db_name: str, collection_name: str) -> List[Dict]:
+        """
+        Definitions of all the search indexes of the collection.
+        """
         url = LIST_TEXT_INDEXES_ENDPOINT.format(
             GROUP_ID=group_id,
             CLUSTER_NAME=cluster_name,
             DATABASE_NAME=db_name,
             COLLECTION_NAME=collection_name,
         )
-        response = requests.get(url, auth=HTTPDigestAuth(user, password))
+        response = client.get(url)
         response.raise_for_status()
-        index_results = response.json()
-        self._indexed_fields.clear()
-        for index_result in index_results:
-            if index_result["name"] == self.index:
-                self._set_indexed_from_mappings(index_result)
-                self.ensured = True
-                break
-        else:
-            self.ensured = False
-        return self.ensured
+        return response.json()
+
+    # pylint: disable=too-many-arguments
+    def ensure_index_exists(
+        self,
+        user: str,
+        password: str,
+        group_id: str,
+        cluster_name: str,
+        db_name: str,
+        collection_name: str,
+        metadata_cache: Optional[AtlasIndexMetadataCache] = None,
+        client: Optional[AtlasAdminClient] = None,
+        fetch_indexes: Optional[Callable[[], List[Dict]]] = None,
+    ):
+        """
+        Loads the definition of the index, from the metadata cache or from the indexes of the collection.
+        `fetch_indexes` replaces the call to the Atlas API, i.e. to fetch the indexes of a collection once for more documents.
+        """
+        if not self.index:
+            raise AtlasIndexError("No index defined")
+        key = (group_id, cluster_name, db_name, collection_name, self.index)
+        found, index_result = metadata_cache.get(key) if metadata_cache else (False, None)
+        if not found:
+            if fetch_indexes is None:
+                client = client or AtlasAdminClient.shared(user, password)
+                index_results = self.list_indexes(client, group_id, cluster_name, db_name, collection_name)
+            else:
+                index_results = fetch_indexes()
+            index_result = next((result for result in index_results if result["name"] == self.index), None)
+            if metadata_cache:
+                self._cache_index_result(metadata_cache, key, index_result)
+        # the new definition is swapped only when complete, the queries keep using the old one until then
+        snapshot = AtlasIndexSnapshot.from_index_result(index_result) if index_result is not None else AtlasIndexSnapshot()
+        self._snapshot = snapshot
+        return snapshot.ensured
 
     def _set_indexed_fields(self, index_result: Union[Dict, List], base_field: str = ""):
-        if isinstance(index_result, list):
-            for obj in index_result:
-                self._set_indexed_fields(obj, base_field=base_field)
-        else:
-            lucene_type = index_result["type"]
-            if lucene_type in [
-                AtlasIndexType.DOCUMENT.value,
-                AtlasIndexType.EMBEDDED_DOCUMENT.value,
-            ]:
-                if not index_result.get("dynamic", False):
-                    for field, value in index_result.get("fields", {}).items():
-                        field = f"{base_field}.{field}" if base_field else field
-                        self._set_indexed_fields(value, base_field=field)
-                else:
-                    self._indexed_fields[f"{base_field}.*" if base_field else "*"] = ""
-            if base_field:
-                if lucene_type not in AtlasIndexType.values():
-                    logger.warning(f"Lucene type {lucene_type} not configured")
-                else:
-                    self._indexed_fields[base_field] = lucene_type
+        self._snapshot = self._snapshot.with_fields(index_result, base_field)
 
     def _set_indexed_from_mappings(self, index_result: Dict):
-        mappings = index_result["mappings"]
-        mappings["type"] = AtlasIndexType.DOCUMENT.value
-        self._set_indexed_fields(mappings)
-        logger.debug(self._indexed_fields)
+        self._snapshot = AtlasIndexSnapshot.from_index_result(index_result, ensured=self.ensured)
+
+    def start_refresher(  # pylint: disable=too-many-arguments
+        self,
+        user: str,
+        password: str,
+        group_id: str,
+        cluster_name: str,
+        db_name: str,
+        collection_name: str,
+        interval: float = 300,
+        jitter: float = 0.1,
+        metadata_cache: Optional[AtlasIndexMetadataCache] = None,
+    ) -> "AtlasIndexRefresher":
+        """
+        Starts a daemon thread that ensures the index every `interval` seconds, plus or minus `jitter` of it.
+        """
+        refresher = AtlasIndexRefresher(
+            self,
+            (user, password, group_id, cluster_name, db_name, collection_name),
+            interval=interval,
+            jitter=jitter,
+            metadata_cache=metadata_cache,
+        )
+        refresher.start()
+        return refresher
 
     def ensure_keyword_is_indexed(self, keyword: str):
-        if not self.ensured:
+        snapshot = self._snapshot
+        if not snapshot.ensured:
             raise AtlasIndexError("Index not ensured")
-        return any(fnmatch.fnmatch(keyword, field) for field in self._indexed_fields)
+        return snapshot.resolve(keyword)[0]
 
     def get_type_from_keyword(self, keyword) -> str:
-        if not self.ensured:
+        """
+        Type of the keyword, an empty string for the fields of dynamic documents.
+        """
+        snapshot = self._snapshot
+        if not snapshot.ensured:
             raise AtlasIndexError("Index not ensured")
-        if keyword in self._indexed_fields:
-            return self._indexed_fields[keyword]
+        indexed, lucene_type = snapshot.resolve(keyword)
+        if indexed:
+            return lucene_type
         raise AtlasIndexFieldError(f"Keyword {keyword} not present in index")
+
+    def get_types_from_keyword(self, keyword: str) -> List[str]:
+        """
+        All the types the keyword is indexed with, empty if the keyword is not explicitly mapped.
+        """
+        snapshot = self._snapshot
+        if not snapshot.ensured:
+            raise AtlasIndexError("Index not ensured")
+        return list(snapshot.indexed_types.get(keyword, ()))
+
+    def get_multi_from_analyzer(self, keyword: str, analyzer: str) -> Optional[str]:
+        """
+        Name of the multi of the keyword that uses the analyzer, if any.
+        """
+        snapshot = self._snapshot
+        if not snapshot.ensured:
+            raise AtlasIndexError("Index not ensured")
+        for name, multi_analyzer in snapshot.multi_analyzers.get(keyword, {}).items():
+            if multi_analyzer == analyzer:
+                return name
+        return None
+
+    def get_reverse_multi(self, keyword: str) -> Optional[str]:
+        """
+        Name of the multi of the keyword that uses an analyzer with the reverse token filter, if any.
+        """
+        snapshot = self._snapshot
+        if not snapshot.ensured:
+            raise AtlasIndexError("Index not ensured")
+        for analyzer in snapshot.reverse_analyzers:
+            for name, multi_analyzer in snapshot.multi_analyzers.get(keyword, {}).items():
+                if multi_analyzer == analyzer:
+                    return name
+        return None
+
+
+class AtlasIndexRefresher(threading.Thread):
+    """
+    Ensures the index in background, so that the queries never wait for the Atlas API.
+    The refreshes are spread by the jitter, to not have all the processes calling the API at the same time.
+    If a refresh fails, the queries keep using the last definition of the index.
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(
+        self,
+        index: AtlasIndex,
+        credentials: Tuple[str, str, str, str, str, str],
+        interval: float = 300,
+        jitter: float = 0.1,
+        metadata_cache: Optional[AtlasIndexMetadataCache] = None,
+    ):
+        if interval <= 0:
+            raise AtlasIndexError(f"Interval must be positive, not {interval}")
+        if not 0 <= jitter < 1:
+            raise AtlasIndexError(f"Jitter must be between 0 and 1, not {jitter}")
+        super().__init__(name=f"atlasq-refresher-{index.index}", daemon=True)
+        self.index = index
+        self.credentials = credentials
+        self.interval = interval
+        self.jitter = jitter
+        self.metadata_cache = metadata_cache
+        self._stopped = threading.Event()
+
+    def next_interval(self) -> float:
+        return self.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def refresh(self) -> bool:
+        try:
+            return self.index.ensure_index_exists(*self.credentials, metadata_cache=self.metadata_cache)
+        except (requests.RequestException, AtlasIndexError, KeyError, ValueError) as e:
+            logger.warning(f"Unable to refresh index {self.index.index}: {e!r}")
+            return False
+
+    def run(self):
+        while not self._stopped.wait(self.next_interval()):
+            try:
+                self.refresh()
+            except Exception:  # pylint: disable=broad-except
+                # i.e. a malformed definition: the next refreshes may succeed, the thread must not die
+                logger.exception(f"Unexpected error refreshing index {self.index.index}")
+
+    def stop(self, timeout: Optional[float] = None):
+        self._stopped.set()
+        if self.is_alive():
+            self.join(timeout)
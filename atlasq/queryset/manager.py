@@ -1,8 +1,19 @@
-from typing import Union
+import copy
+import functools
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple, Type, Union
 
+from atlasq.queryset.client import AtlasAdminClient
+from atlasq.queryset.exceptions import AtlasIndexError
 from atlasq.queryset.index import AtlasIndex
+from atlasq.queryset.metadata import AtlasIndexMetadataCache
 from atlasq.queryset.queryset import AtlasQuerySet
-from mongoengine import QuerySetManager
+from mongoengine import Document, QuerySetManager
+from mongoengine.base.common import _document_registry
+
+logger = getLogger(__name__)
 
 
 class AtlasManager(QuerySetManager):
@@ -19,13 +30,144 @@ class AtlasManager(QuerySetManager):
 
     def __init__(
         self,
-        atlas_index: Union[str, None],
+        atlas_index: Union[str, AtlasIndex, List[Union[str, AtlasIndex]], None],
     ):
         super().__init__()
-        self._index = AtlasIndex(atlas_index) if atlas_index else None
+        if not isinstance(atlas_index, list):
+            atlas_index = [atlas_index] if atlas_index else []
+        # the first index is the default one, used when no index covers a query
+        self._indexes = [index if isinstance(index, AtlasIndex) else AtlasIndex(index) for index in atlas_index]
+        self._index = self._indexes[0] if self._indexes else None
+        self._owner: Optional[Type[Document]] = None
+        # collection -> indexes, for the documents that inherit the manager from an abstract document
+        self._collection_indexes: Dict[str, List[AtlasIndex]] = {}
+
+    def __set_name__(self, owner, name):
+        self._owner = owner
 
     def __get__(self, instance, owner):
         queryset = super().__get__(instance, owner)
         if isinstance(queryset, AtlasQuerySet):
-            queryset.index = self._index
+            indexes = self.indexes_for(owner)
+            queryset.index = indexes[0] if indexes else None
+            queryset.indexes = indexes
         return queryset
+
+    def indexes_for(self, document: Type[Document]) -> List[AtlasIndex]:
+        """
+        Indexes of the document. The subclasses of an abstract document have their own collections,
+        every collection gets its own copy of the indexes, ensured on its own.
+        """
+        if self._owner is None or not self._owner._meta.get("abstract"):  # pylint: disable=protected-access
+            return self._indexes
+        collection_name = document._get_collection_name()  # pylint: disable=protected-access
+        if collection_name is None:
+            return self._indexes
+        if collection_name not in self._collection_indexes:
+            self._collection_indexes.setdefault(collection_name, [copy.copy(index) for index in self._indexes])
+        return self._collection_indexes[collection_name]
+
+    @property
+    def index(self) -> Optional[AtlasIndex]:
+        return self._index
+
+    @property
+    def indexes(self) -> List[AtlasIndex]:
+        return self._indexes
+
+
+class AtlasIndexReport(NamedTuple):
+    document: Type[Document]
+    index: str
+    ensured: bool
+    error: Optional[Exception] = None
+
+
+def _atlas_documents() -> List[Tuple[Type[Document], AtlasManager]]:
+    """
+    Every concrete document registered by mongoengine, with the AtlasManager (with an index) it has, inherited ones included.
+    """
+    documents = []
+    for document in list(_document_registry.values()):
+        if document._meta.get("abstract"):  # pylint: disable=protected-access
+            continue
+        names = set()
+        for klass in document.__mro__:
+            for name, value in vars(klass).items():
+                # the attributes of the subclasses hide the ones of the parents
+                if name in names:
+                    continue
+                names.add(name)
+                if isinstance(value, AtlasManager) and value.indexes:
+                    documents.append((document, value))
+    return documents
+
+
+# pylint: disable=too-many-arguments,too-many-locals
+def ensure_all_indexes(
+    user: str,
+    password: str,
+    group_id: str,
+    cluster_name: str,
+    workers: int = 8,
+    documents: Optional[Iterable[Type[Document]]] = None,
+    client: Optional[AtlasAdminClient] = None,
+    metadata_cache: Optional[AtlasIndexMetadataCache] = None,
+) -> List[AtlasIndexReport]:
+    """
+    Ensures the indexes of every document with an AtlasManager (or just of `documents`), on a thread pool.
+    The indexes of a collection are fetched once, for all the documents of the collection.
+    """
+    if not isinstance(workers, int) or workers <= 0:
+        raise AtlasIndexError(f"Workers must be a positive integer, not {workers}")
+    client = client or AtlasAdminClient.shared(user, password)
+    metadata_cache = metadata_cache or AtlasQuerySet.metadata_cache
+    selected = set(documents) if documents is not None else None
+    collections: Dict[Tuple[str, str], List[Tuple[Type[Document], AtlasIndex]]] = defaultdict(list)
+    reports: List[AtlasIndexReport] = []
+    for document, manager in _atlas_documents():
+        if selected is not None and document not in selected:
+            continue
+        try:
+            # pylint: disable=protected-access
+            key = (document._get_db().name, document._get_collection_name())
+        except Exception as e:  # pylint: disable=broad-except
+            # i.e. a document on a connection not registered yet
+            logger.warning(f"Unable to find the collection of {document.__name__}: {e!r}")
+            reports.extend(AtlasIndexReport(document, index.index, False, e) for index in manager.indexes)
+            continue
+        for index in manager.indexes_for(document):
+            collections[key].append((document, index))
+
+    def ensure_collection(db_name: str, collection_name: str, entries: List[Tuple[Type[Document], AtlasIndex]]) -> List[AtlasIndexReport]:
+        @functools.lru_cache(maxsize=None)
+        def fetch_indexes() -> List[Dict]:
+            return AtlasIndex.list_indexes(client, group_id, cluster_name, db_name, collection_name)
+
+        reports = []
+        ensured: Dict[int, bool] = {}
+        for document, index in entries:
+            try:
+                if id(index) not in ensured:
+                    # the documents of the collection that share the manager share the index too
+                    ensured[id(index)] = index.ensure_index_exists(
+                        user,
+                        password,
+                        group_id,
+                        cluster_name,
+                        db_name,
+                        collection_name,
+                        metadata_cache=metadata_cache,
+                        client=client,
+                        fetch_indexes=fetch_indexes,
+                    )
+                reports.append(AtlasIndexReport(document, index.index, ensured[id(index)]))
+            except Exception as e:  # pylint: disable=broad-except
+                logger.warning(f"Unable to ensure index {index.index} of {document.__name__}: {e!r}")
+                reports.append(AtlasIndexReport(document, index.index, False, e))
+        return reports
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(ensure_collection, db_name, collection_name, entries) for (db_name, collection_name), entries in collections.items()]
+        reports.extend(report for future in futures for report in future.result())
+    return reports
@@ -0,0 +1,78 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+from logging import getLogger
+from typing import Dict, Optional, Tuple
+
+logger = getLogger(__name__)
+
+
+class AtlasIndexMetadataCache:
+    """
+    Index definitions saved on disk, so that the processes starting together do not all call the Atlas API.
+    Every entry is a file, written atomically, that is valid for `ttl` seconds.
+    """
+
+    # entries written with another version are ignored
+    version: int = 1
+
+    def __init__(self, directory: str, ttl: float = 300):
+        self.directory = directory
+        self.ttl = ttl
+
+    @staticmethod
+    def _hash(index: Optional[Dict]) -> str:
+        return hashlib.sha256(json.dumps(index, sort_keys=True).encode()).hexdigest()
+
+    def _path(self, key: Tuple[str, ...]) -> str:
+        name = hashlib.sha256("\0".join(key).encode()).hexdigest()
+        return os.path.join(self.directory, f"{name}.json")
+
+    def get(self, key: Tuple[str, ...]) -> Tuple[bool, Optional[Dict]]:
+        """
+        If a valid entry exists, and the definition of the index (None if the index does not exist).
+        """
+        try:
+            with open(self._path(key), encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return False, None
+        if not isinstance(entry, dict) or entry.get("version") != self.version or entry.get("key") != list(key):
+            return False, None
+        if time.time() - entry.get("created", 0) > self.ttl:
+            logger.debug(f"Index metadata of {key} expired")
+            return False, None
+        if entry.get("hash") != self._hash(entry.get("index")):
+            logger.warning(f"Index metadata of {key} is corrupted")
+            return False, None
+        return True, entry["index"]
+
+    def set(self, key: Tuple[str, ...], index: Optional[Dict]) -> None:
+        entry = {
+            "version": self.version,
+            "key": list(key),
+            "created": time.time(),
+            "hash": self._hash(index),
+            "index": index,
+        }
+        os.makedirs(self.directory, exist_ok=True)
+        # the file is replaced only when complete, so the other processes never read half an entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(entry, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self._path(key))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def clear(self) -> None:
+        if not os.path.isdir(self.directory):
+            return
+        for name in os.listdir(self.directory):
+            if name.endswith(".json"):
+                os.unlink(os.path.join(self.directory, name))
@@ -1,19 +1,60 @@
+import copy
 import logging
 from typing import Dict, List, Tuple, Union
 
-from atlasq.queryset.visitor import AtlasQueryCompilerVisitor, AtlasSimplificationVisitor
+from atlasq.queryset.compiler import AtlasQueryCompiler
+from atlasq.queryset.exceptions import AtlasQueryError
 from mongoengine import Q
 from mongoengine.queryset.visitor import QCombination
 
 logger = logging.getLogger(__name__)
 
 
+class Param:
+    """
+    Placeholder for a value that will be bound to an AtlasPreparedQuery.
+    The type is needed to choose the operator, i.e. `equals` instead of `text`.
+    """
+
+    def __init__(self, name: str, param_type: type = str):
+        self.name = name
+        self.type = param_type
+
+    def __repr__(self):
+        return f"Param({self.name!r}, {self.type.__name__})"
+
+    def __eq__(self, other):
+        return isinstance(other, Param) and self.name == other.name and self.type == other.type
+
+    def __hash__(self):
+        return hash((self.name, self.type))
+
+
+def _ensure_combinable(node, other):
+    if node and other and (isinstance(node, AtlasBoundQ) or isinstance(other, AtlasBoundQ)):
+        raise AtlasQueryError("A bound query cannot be combined with other queries")
+
+
+def _combine(node, other, operation) -> Union["AtlasQ", "AtlasQCombination"]:
+    # same as QNode._combine, but the combination is built only once
+    _ensure_combinable(node, other)
+    if not other:
+        return node
+    if not node:
+        if isinstance(other, QCombination):
+            return AtlasQCombination(other.operation, other.children)
+        if isinstance(other, AtlasQ):
+            return other
+        return AtlasQ(**other.query)
+    return AtlasQCombination(operation, [node, other])
+
+
 class AtlasQ(Q):
     @property
     def operation(self):
         return self.AND
 
-    def to_query(self, document) -> List[Dict]:  # pylint: disable=arguments-differ
+    def to_query(self, document, atlas_index=None) -> List[Dict]:  # pylint: disable=arguments-differ
         from atlasq import AtlasQuerySet
 
         qs = getattr(document, "atlas", None)
@@ -21,31 +62,56 @@ class AtlasQ(Q):
             raise ValueError("Document must set `atlas` to an AtlasManager")
         if not isinstance(qs, AtlasQuerySet):
             return super().to_query(document)
-        atlas_index = qs.index
+        # the default index of the document, if the queryset has not chosen another one
+        atlas_index = atlas_index or qs.index
         logger.debug(f"to_query {self.__class__.__name__} {document}")
-        query = self.accept(AtlasSimplificationVisitor())
-        query = query.accept(AtlasQueryCompilerVisitor(document, atlas_index))
-        return query
+        return AtlasQueryCompiler(document, atlas_index).compile(self)
 
     def _combine(self, other, operation) -> Union["AtlasQ", "AtlasQCombination"]:
-        logger.debug(f"_combine {self.__class__.__name__} {other}, {operation}")
+        logger.debug(f"_combine {self.__class__.__name__} {other.__class__.__name__}, {operation}")
+        return _combine(self, other, operation)
+
+
+class AtlasBoundQ(AtlasQ):
+    """
+    Query already compiled by AtlasPreparedQuery.bind
+    """
+
+    def __init__(self, pipeline: List[Dict]):
+        super().__init__()
+        self.pipeline = pipeline
+
+    def __bool__(self):
+        return bool(self.pipeline)
+
+    def __eq__(self, other):
+        return isinstance(other, AtlasBoundQ) and self.pipeline == other.pipeline
+
+    def __repr__(self):
+        return f"AtlasBoundQ({self.pipeline!r})"
 
-        result = super()._combine(other, operation)
-        if isinstance(result, QCombination):
-            return AtlasQCombination(result.operation, result.children)
-        return AtlasQ(**result.query)
+    def to_query(self, document, atlas_index=None) -> List[Dict]:  # pylint: disable=unused-argument
+        # the caller is free to change the pipeline, i.e. adding the sort
+        return copy.deepcopy(self.pipeline)
 
 
 class AtlasQCombination(QCombination):
     def __bool__(self):
-        return any(bool(child) for child in self.children)
+        # without recursion, the tree can be deeper than the recursion limit
+        pending = list(self.children)
+        while pending:
+            child = pending.pop()
+            if isinstance(child, AtlasQCombination):
+                pending.extend(child.children)
+            elif child:
+                return True
+        return False
 
     def _combine(self, other, operation):
-        logger.debug(f"_combine {self.__class__.__name__} {other}, {operation}")
-        result = super()._combine(other, operation)
-        return AtlasQCombination(result.operation, result.children)
+        logger.debug(f"_combine {self.__class__.__name__} {other.__class__.__name__}, {operation}")
+        return _combine(self, other, operation)
 
-    def to_query(self, document) -> Tuple[Dict, List[Dict]]:  # pylint: disable=arguments-differ
+    def to_query(self, document, atlas_index=None) -> Tuple[Dict, List[Dict]]:  # pylint: disable=arguments-differ
         from atlasq import AtlasQuerySet
 
         qs = getattr(document, "atlas", None)
@@ -53,11 +119,10 @@ class AtlasQCombination(QCombination):
             raise ValueError("Document must set `atlas` to an AtlasManager")
         if not isinstance(qs, AtlasQuerySet):
             return super().to_query(document)
-        atlas_index = qs.index
+        # the default index of the document, if the queryset has not chosen another one
+        atlas_index = atlas_index or qs.index
         logger.debug(f"to_query {self.__class__.__name__} {document}")
-        query = self.accept(AtlasSimplificationVisitor())
-        query = query.accept(AtlasQueryCompilerVisitor(document, atlas_index))
-        return query
+        return AtlasQueryCompiler(document, atlas_index).compile(self)
 
     def accept(self, visitor):
         logger.debug(f"accept {self.__class__.__name__} {visitor}")
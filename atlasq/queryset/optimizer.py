@@ -0,0 +1,229 @@
+import logging
+from typing import Any, Dict, Hashable, List, Optional
+
+from atlasq.queryset.node import Param
+from atlasq.queryset.transform import AtlasTransform
+
+logger = logging.getLogger(__name__)
+
+COMPOUND_CLAUSES = ("filter", "must", "mustNot", "should")
+
+
+def _key(value: Any) -> Hashable:
+    # canonical representation, the order of the keys of a clause is not relevant
+    if isinstance(value, dict):
+        return "dict", tuple(sorted((key, _key(val)) for key, val in value.items()))
+    if isinstance(value, list):
+        return "list", tuple(_key(val) for val in value)
+    return type(value).__name__, repr(value)
+
+
+def _dedupe(clauses: List[Dict]) -> List[Dict]:
+    seen = set()
+    result = []
+    for clause in clauses:
+        key = _key(clause)
+        if key not in seen:
+            seen.add(key)
+            result.append(clause)
+    return result
+
+
+def count_clauses(clause: Dict) -> int:
+    """
+    Number of operators in the clause, compound and embeddedDocument included.
+    """
+    count = 0
+    pending = [clause]
+    while pending:
+        clause = pending.pop()
+        count += 1
+        if "compound" in clause:
+            for name in COMPOUND_CLAUSES:
+                pending.extend(clause["compound"].get(name, []))
+        elif "embeddedDocument" in clause:
+            pending.append(clause["embeddedDocument"]["operator"])
+    return count
+
+
+class AtlasSearchOptimizer:
+    """
+    Rewrites the compound of the $search stage to a smaller one that matches the same documents.
+    The compound is flattened where it is possible, duplicated clauses are removed,
+    `equals` on the same path in a `should` are merged to `in`, and `text` with the same query to a multi path `text`.
+    """
+
+    def __init__(self):
+        self.clauses_before: int = 0
+        self.clauses_after: int = 0
+
+    def optimize(self, pipeline: List[Dict]) -> List[Dict]:
+        if not pipeline or "compound" not in pipeline[0].get("$search", {}):
+            return pipeline
+        search = pipeline[0]["$search"]
+        self.clauses_before = count_clauses({"compound": search["compound"]})
+        clause = self._optimize_clause({"compound": search["compound"]})
+        # $search needs a compound to add the count, but not an or of a single clause
+        compound = clause["compound"] if "compound" in clause else {"filter": [clause]}
+        self.clauses_after = count_clauses({"compound": compound})
+        logger.debug(f"Optimized $search from {self.clauses_before} to {self.clauses_after} clauses")
+        return [{"$search": {**search, "compound": compound}}] + pipeline[1:]
+
+    def _optimize_clause(self, clause: Dict) -> Dict:
+        if "embeddedDocument" in clause:
+            embedded_document = clause["embeddedDocument"]
+            return {
+                "embeddedDocument": {
+                    **embedded_document,
+                    "operator": self._optimize_clause(embedded_document["operator"]),
+                }
+            }
+        if "compound" not in clause:
+            return clause
+        compound = self._optimize_compound(clause["compound"])
+        if compound.keys() == {"should", "minimumShouldMatch"} and len(compound["should"]) == 1:
+            # or of a single clause
+            return compound["should"][0]
+        if compound.keys() == {"filter"} and len(compound["filter"]) == 1 and "compound" in compound["filter"][0]:
+            # and of a single compound
+            return compound["filter"][0]
+        return {"compound": compound}
+
+    @staticmethod
+    def _is_or(compound: Dict) -> bool:
+        return compound.keys() == {"should", "minimumShouldMatch"} and compound["minimumShouldMatch"] == 1
+
+    def _optimize_compound(self, compound: Dict) -> Dict:
+        result = {}
+        for name, value in compound.items():
+            if name in COMPOUND_CLAUSES:
+                result[name] = [self._optimize_clause(clause) for clause in value]
+            else:
+                result[name] = value
+
+        if "filter" in result:
+            self._flatten_filter(result)
+        if "mustNot" in result:
+            self._flatten_must_not(result)
+        if "should" in result and result.get("minimumShouldMatch") == 1:
+            result["should"] = self._merge_should(result["should"])
+        if "filter" in result and "should" not in result and "minimumShouldMatch" not in result:
+            # a single or in the filter can be the should of this compound
+            ors = [clause for clause in result["filter"] if "compound" in clause and self._is_or(clause["compound"])]
+            if len(ors) == 1:
+                result["filter"] = [clause for clause in result["filter"] if clause is not ors[0]]
+                result["should"] = ors[0]["compound"]["should"]
+                result["minimumShouldMatch"] = 1
+        for name in COMPOUND_CLAUSES:
+            if name in result:
+                if name != "should" or result.get("minimumShouldMatch") == 1:
+                    # duplicates would count twice to reach a minimumShouldMatch greater than 1
+                    result[name] = _dedupe(result[name])
+                if not result[name]:
+                    result.pop(name)
+        return result
+
+    @staticmethod
+    def _flatten_filter(compound: Dict) -> None:
+        filters = []
+        for clause in compound["filter"]:
+            if "compound" in clause and clause["compound"] and clause["compound"].keys() <= {"filter", "mustNot"}:
+                # and inside an and
+                filters.extend(clause["compound"].get("filter", []))
+                compound.setdefault("mustNot", []).extend(clause["compound"].get("mustNot", []))
+            else:
+                filters.append(clause)
+        compound["filter"] = filters
+
+    def _flatten_must_not(self, compound: Dict) -> None:
+        negatives = []
+        for clause in compound["mustNot"]:
+            if "compound" in clause and self._is_or(clause["compound"]):
+                # not (a or b) is (not a) and (not b)
+                negatives.extend(clause["compound"]["should"])
+            else:
+                negatives.append(clause)
+        compound["mustNot"] = negatives
+
+    def _merge_should(self, clauses: List[Dict]) -> List[Dict]:
+        flattened = []
+        for clause in clauses:
+            if "compound" in clause and self._is_or(clause["compound"]):
+                # or inside an or
+                flattened.extend(clause["compound"]["should"])
+            else:
+                flattened.append(clause)
+        flattened = _dedupe(flattened)
+        # the clauses that can be merged are grouped, the group takes the position of the first clause
+        result: List[Any] = []
+        groups: Dict[Hashable, List[Dict]] = {}
+        for clause in flattened:
+            wrapped = self._is_wrapped(clause)
+            leaf = clause["compound"]["filter"][0] if wrapped else clause
+            key = self._merge_key(leaf)
+            if key is None:
+                result.append(clause)
+                continue
+            key = (wrapped, key)
+            if key not in groups:
+                groups[key] = []
+                result.append(key)
+            groups[key].append(clause)
+        merged = []
+        for item in result:
+            if isinstance(item, tuple):
+                merged.extend(self._merge(groups[item]))
+            else:
+                merged.append(item)
+        return merged
+
+    @staticmethod
+    def _is_wrapped(clause: Dict) -> bool:
+        # a single clause in the filter of a compound, as AtlasQ compiles a branch of an or
+        return "compound" in clause and clause["compound"].keys() == {"filter"} and len(clause["compound"]["filter"]) == 1
+
+    @staticmethod
+    def _merge_key(clause: Dict) -> Optional[Hashable]:
+        # clauses with the same key can be merged in a single one
+        if clause.keys() == {"equals"} and clause["equals"].keys() == {"path", "value"}:
+            value = clause["equals"]["value"]
+            if isinstance(value, Param) or not isinstance(clause["equals"]["path"], str):
+                return None
+            return "in", clause["equals"]["path"], type(value)
+        if clause.keys() == {"in"} and clause["in"].keys() == {"path", "value"}:
+            values = clause["in"]["value"]
+            if not isinstance(values, list) or not values or not isinstance(clause["in"]["path"], str):
+                return None
+            types = {type(value) for value in values}
+            if len(types) != 1 or Param in types:
+                return None
+            return "in", clause["in"]["path"], types.pop()
+        if clause.keys() == {"text"} and "path" in clause["text"]:
+            path = clause["text"]["path"]
+            if not isinstance(path, (str, list)) or (isinstance(path, list) and not all(isinstance(single, str) for single in path)):
+                # i.e. a multi analyzer
+                return None
+            return "text", _key({key: value for key, value in clause["text"].items() if key != "path"})
+        return None
+
+    def _merge(self, clauses: List[Dict]) -> List[Dict]:
+        if len(clauses) == 1:
+            return clauses
+        wrapped = self._is_wrapped(clauses[0])
+        leaves = [clause["compound"]["filter"][0] for clause in clauses] if wrapped else clauses
+        if "text" in leaves[0]:
+            paths = {}
+            for leaf in leaves:
+                path = leaf["text"]["path"]
+                paths.update(dict.fromkeys(path if isinstance(path, list) else [path]))
+            merged = [{"text": {**leaves[0]["text"], "path": list(paths)}}]
+        else:
+            path = (leaves[0].get("in") or leaves[0]["equals"])["path"]
+            values = {}
+            for leaf in leaves:
+                values.update(dict.fromkeys(leaf["in"]["value"] if "in" in leaf else [leaf["equals"]["value"]]))
+            values = list(values)
+            # the lists stay split as AtlasTransform does
+            chunk_size = AtlasTransform.in_chunk_size
+            merged = [{"in": {"path": path, "value": values[i : i + chunk_size]}} for i in range(0, len(values), chunk_size)]
+        return [{"compound": {"filter": [clause]}} for clause in merged] if wrapped else merged
@@ -0,0 +1,103 @@
+import copy
+from typing import Any, Callable, Dict, List, Optional, Set, Union
+
+from atlasq.queryset.exceptions import AtlasQueryError
+from atlasq.queryset.index import AtlasIndex
+from atlasq.queryset.node import AtlasBoundQ, AtlasQ, AtlasQCombination, Param
+from atlasq.queryset.transform import AtlasTransform
+from bson import ObjectId
+from mongoengine import QuerySet
+
+
+def _bind_text(transform: AtlasTransform, clause: Dict, param: Param, value: Any) -> Dict:  # pylint: disable=unused-argument
+    return transform._text(clause["path"], value)  # pylint: disable=protected-access
+
+
+def _bind_equals(transform: AtlasTransform, clause: Dict, param: Param, value: Any) -> Dict:
+    if param.type is ObjectId:
+        value = transform._cast_to_object_id(value)  # pylint: disable=protected-access
+    return transform._equals(clause["path"], value)  # pylint: disable=protected-access
+
+
+def _bind_range(transform: AtlasTransform, clause: Dict, param: Param, value: Any) -> Dict:
+    keywords = [keyword for keyword, clause_value in clause.items() if clause_value is param]
+    return transform._range(clause["path"], value, keywords)  # pylint: disable=protected-access
+
+
+class AtlasPreparedQuery:
+    """
+    Query compiled once, where the Param are replaced with the actual values on every bind.
+    The query is compiled for the index the queryset routes it to: pass a queryset instead of the document
+    to choose the index, i.e. `MyDocument.atlas.using_index("name")`.
+    """
+
+    binders: Dict[str, Callable[[AtlasTransform, Dict, Param, Any], Dict]] = {
+        "text": _bind_text,
+        "equals": _bind_equals,
+        "range": _bind_range,
+    }
+
+    def __init__(self, query: Union[AtlasQ, AtlasQCombination], document):
+        queryset = document if isinstance(document, QuerySet) else document.atlas
+        self.document = queryset._document  # pylint: disable=protected-access
+        self._check_keywords(query)
+        self.index: AtlasIndex = queryset.filter(query)._search_index() or queryset.index  # pylint: disable=protected-access
+        self.pipeline: List[Dict] = query.to_query(self.document, self.index)
+        self.params: Set[str] = set()
+        self._find_params(self.pipeline)
+
+    @staticmethod
+    def _check_keywords(query: Union[AtlasQ, AtlasQCombination]):
+        pending = [query]
+        while pending:
+            node = pending.pop()
+            if isinstance(node, AtlasQCombination):
+                pending.extend(node.children)
+                continue
+            for key, value in getattr(node, "query", {}).items():
+                if isinstance(value, Param):
+                    param_error = AtlasTransform._parse_key(key).param_error  # pylint: disable=protected-access
+                    if param_error:
+                        raise AtlasQueryError(f"{param_error}: {key}")
+
+    def _find_params(self, obj: Any, operator: Optional[str] = None):
+        if isinstance(obj, Param):
+            if operator not in self.binders:
+                raise AtlasQueryError(f"Parameter {obj.name} can not be bound to {operator or 'the query'}")
+            self.params.add(obj.name)
+        elif isinstance(obj, dict):
+            if len(obj) == 1 and isinstance(next(iter(obj.values())), dict):
+                # the parameters must be values of the clause of the operator
+                operator, clause = next(iter(obj.items()))
+                for value in clause.values():
+                    self._find_params(value, operator)
+                return
+            for value in obj.values():
+                self._find_params(value)
+        elif isinstance(obj, list):
+            for value in obj:
+                self._find_params(value)
+
+    def bind(self, **values) -> AtlasBoundQ:
+        missing = self.params - values.keys()
+        if missing:
+            raise AtlasQueryError(f"Missing values for parameters {sorted(missing)}")
+        unknown = values.keys() - self.params
+        if unknown:
+            raise AtlasQueryError(f"Unknown parameters {sorted(unknown)}")
+        transform = AtlasTransform({}, copy.copy(self.index))
+        return AtlasBoundQ(self._bind(self.pipeline, values, transform))
+
+    def _bind(self, obj: Any, values: Dict[str, Any], transform: AtlasTransform) -> Any:
+        if isinstance(obj, list):
+            return [self._bind(value, values, transform) for value in obj]
+        if not isinstance(obj, dict):
+            return obj
+        if len(obj) == 1:
+            operator, clause = next(iter(obj.items()))
+            if operator in self.binders:
+                param = next((value for value in clause.values() if isinstance(value, Param)), None)
+                if param is not None:
+                    # the clause is built again, so that the value is validated as if it was not a Param
+                    return self.binders[operator](transform, clause, param, values[param.name])
+        return {key: self._bind(value, values, transform) for key, value in obj.items()}
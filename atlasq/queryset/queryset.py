@@ -1,14 +1,25 @@
 import copy
 import logging
 import time
-from typing import Any, Dict, List, Tuple
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple, Union
 
+from atlasq.queryset.cache import AtlasPipelineCache, fingerprint
 from atlasq.queryset.exceptions import AtlasIndexError, AtlasQueryError
-from atlasq.queryset.index import AtlasIndex
+from atlasq.queryset.compiler import AtlasIndexRouter
+from atlasq.queryset.index import AtlasIndex, AtlasIndexRefresher
+from atlasq.queryset.metadata import AtlasIndexMetadataCache
 from atlasq.queryset.node import AtlasQ
-from mongoengine import Q, QuerySet
+from atlasq.queryset.optimizer import AtlasSearchOptimizer
+from bson import ObjectId
+from mongoengine import Document, Q, QuerySet
 from pymongo.command_cursor import CommandCursor
 
+PAGINATION_TOKEN_FIELD = "_paginationToken"
+# an ObjectId in the `in` array is about 20 bytes of BSON, far from the 16MB limit of a command
+BULK_IDS_MAX_CHUNK_SIZE = 200000
+
 
 def clock(func):
     def clocked(self, *args, **kwargs):
@@ -22,33 +33,56 @@ def clock(func):
     return clocked
 
 
+class AtlasPage(NamedTuple):
+    documents: List[Document]
+    next_token: Optional[str] = None
+    prev_token: Optional[str] = None
+    total: Optional[int] = None
+
+
 # pylint: disable=too-many-instance-attributes
 class AtlasQuerySet(QuerySet):
+    pipeline_cache = AtlasPipelineCache()
+    # set it to share the index definitions between processes
+    metadata_cache: Optional[AtlasIndexMetadataCache] = None
+
     def _clone_into(self, new_qs):
         copy_props = (
             "index",
-            "_aggrs_query",
-            "_search_result",
+            "indexes",
+            "_using_index",
             "_count",
             "_return_objects",
-            "_other_aggregations",
         )
-        qs = super()._clone_into(new_qs)
+        cursor_obj = self._cursor_obj
+        if not hasattr(cursor_obj, "clone"):
+            # aggregation cursors can be neither cloned nor rewound: the new queryset will run its own
+            self._cursor_obj = None
+        try:
+            qs = super()._clone_into(new_qs)
+        finally:
+            self._cursor_obj = cursor_obj
         for prop in copy_props:
             val = getattr(self, prop)
             setattr(new_qs, prop, copy.copy(val))
+        # the id query depends on skip, limit and ordering, that the clone is free to change
+        new_qs._mongo_query = None  # pylint: disable=protected-access
         return qs
 
     def __init__(self, document, collection):
         super().__init__(document, collection)
         self._query_obj = AtlasQ()
         self.index: AtlasIndex = None
+        # all the indexes of the document, the queries are routed to the smallest one that covers them
+        self.indexes: List[AtlasIndex] = []
+        # set by using_index, the query is not routed
+        self._using_index: bool = False
 
         self._aggrs_query: List[Dict[str, Any]] = None
         self._search_result: CommandCursor = None
         self._count: bool = False
+        self._total: int = None
         self._return_objects: bool = True
-        self._other_aggregations: List[Dict] = []
         self.logger = logging.getLogger(f"{__name__}.{self._document._get_collection_name()}")
 
     # pylint: disable=too-many-arguments
@@ -69,55 +103,175 @@ class AtlasQuerySet(QuerySet):
         if "name" not in json_index:
             json_index["name"] = self.index._index  # pylint: disable=protected-access
         self.logger.info(f"Sending {json_index} to create new index")
-        return self.index.upload_index(json_index, user, password, group_id, cluster_name)
+        return self.index.upload_index(json_index, user, password, group_id, cluster_name, metadata_cache=self.metadata_cache)
 
     def ensure_index(self, user: str, password: str, group_id: str, cluster_name: str):
         db_name = self._document._get_db().name  # pylint: disable=protected-access
         collection_name = self._document._get_collection_name()  # pylint: disable=protected-access
-        return self.index.ensure_index_exists(user, password, group_id, cluster_name, db_name, collection_name)
+        results = [
+            index.ensure_index_exists(user, password, group_id, cluster_name, db_name, collection_name, metadata_cache=self.metadata_cache)
+            for index in self.indexes or [self.index]
+        ]
+        return all(results)
+
+    def using_index(self, name: str) -> "AtlasQuerySet":
+        """
+        Runs the query on the given index, instead of the one chosen automatically.
+        """
+        index = next((index for index in self.indexes or [self.index] if index.index == name), None)
+        if index is None:
+            raise AtlasIndexError(f"Index {name} is not an index of {self._document.__name__}")
+        qs = self.clone()
+        qs.index = copy.copy(index)
+        qs._using_index = True  # pylint: disable=protected-access
+        return qs
+
+    def _current_indexes(self) -> List[AtlasIndex]:
+        # the index of the queryset is copied on every clone, and it keeps the snapshot it had then:
+        # the manager has the indexes that are ensured and refreshed
+        manager_qs = getattr(self._document, "atlas", None)
+        if isinstance(manager_qs, AtlasQuerySet) and manager_qs.indexes:
+            return manager_qs.indexes
+        return self.indexes or [self.index]
+
+    def _search_index(self) -> Optional[AtlasIndex]:
+        # None for the default index of the document
+        if self._using_index:
+            return self.index
+        current = self._current_indexes()
+        if len(current) <= 1:
+            return None
+        # the default is the first index of the manager, not the copy of it taken when the queryset was cloned
+        indexes = [copy.copy(index) for index in current]
+        return AtlasIndexRouter(indexes, default=indexes[0]).route(self._query_obj)
+
+    def wait_until_ready(self, user: str, password: str, group_id: str, cluster_name: str, timeout: float = 600) -> List[bool]:
+        """
+        Waits for every index of the document, within `timeout` seconds overall; whether each one is ready, in order.
+        """
+        db_name = self._document._get_db().name  # pylint: disable=protected-access
+        collection_name = self._document._get_collection_name()  # pylint: disable=protected-access
+        deadline = time.monotonic() + timeout
+        return [
+            index.wait_until_ready(user, password, group_id, cluster_name, db_name, collection_name, timeout=max(0, deadline - time.monotonic()))
+            for index in self.indexes or [self.index]
+        ]
+
+    def start_index_refresher(
+        self, user: str, password: str, group_id: str, cluster_name: str, interval: float = 300, jitter: float = 0.1
+    ) -> List[AtlasIndexRefresher]:
+        """
+        Starts a refresher for every index of the document.
+        """
+        db_name = self._document._get_db().name  # pylint: disable=protected-access
+        collection_name = self._document._get_collection_name()  # pylint: disable=protected-access
+        return [
+            index.start_refresher(
+                user,
+                password,
+                group_id,
+                cluster_name,
+                db_name,
+                collection_name,
+                interval=interval,
+                jitter=jitter,
+                metadata_cache=self.metadata_cache,
+            )
+            for index in self.indexes or [self.index]
+        ]
 
     def __iter__(self):
         if not self._return_objects:
             return iter(self._cursor)
         return super().__iter__()
 
-    def delete(self, write_concern=None, _from_doc_delete=False, cascade_refs=None):
-        # we need to get the mongoengine query, the fastest way it to just call _cursor
-        assert self._cursor is not None
-        assert self._query is not None
-        return super().delete(
-            write_concern=write_concern,
-            _from_doc_delete=_from_doc_delete,
-            cascade_refs=cascade_refs,
-        )
+    def distinct(self, field):
+        # distinct is run by pymongo on a find cursor, so it needs the id-requery
+        qs = self.clone()
+        qs._cursor_obj = qs._collection.find(qs._query)  # pylint: disable=protected-access
+        return super(AtlasQuerySet, qs).distinct(field)
 
     @property
     @clock
     def _aggrs(self):
         # corresponding of _query for us
         if self._aggrs_query is None:
-            self._aggrs_query = self._query_obj.to_query(self._document)
-            if self._aggrs_query:
-                if self._count:
-                    self._aggrs_query[0]["$search"]["count"] = {"type": "total"}
-                if self._ordering:
-                    self._aggrs_query[0]["$search"]["sort"] = dict(self._ordering)
+            self._aggrs_query = self._get_search_pipeline()
+            if self._aggrs_query and self._count:
+                self._aggrs_query[0]["$search"]["count"] = {"type": "total"}
+            if self._count and self._aggrs_query:
+                # the page and the total number of hits in a single round trip
+                self._aggrs_query.append(
+                    {
+                        "$facet": {
+                            "documents": self._get_slice() + self._get_projections(),
+                            "meta": self._get_meta_projections(),
+                        }
+                    }
+                )
             else:
-                if self._ordering:
-                    raise AtlasQueryError("Atlas search does not support ordering without filtering.")
-            self._aggrs_query += self._get_projections()
-            self._aggrs_query += self._other_aggregations
+                self._aggrs_query += self._get_slice()
+                self._aggrs_query += self._get_projections()
         return self._aggrs_query
 
+    def _compile_search_pipeline(self, index: AtlasIndex) -> List[Dict[str, Any]]:
+        pipeline = self._query_obj.to_query(self._document, index)
+        optimizer = AtlasSearchOptimizer()
+        try:
+            pipeline = optimizer.optimize(pipeline)
+        except RecursionError:
+            self.logger.debug("Pipeline too deep to be optimized")
+        else:
+            self.pipeline_cache.record_optimization(optimizer.clauses_before, optimizer.clauses_after)
+        if pipeline:
+            if self._ordering:
+                pipeline[0]["$search"]["sort"] = dict(self._ordering)
+        else:
+            if self._ordering:
+                raise AtlasQueryError("Atlas search does not support ordering without filtering.")
+        return pipeline
+
+    def _get_search_pipeline(self) -> List[Dict[str, Any]]:
+        # resolved once: the key and the compilation see the same snapshot of the index
+        index = copy.copy(self._search_index() or self._current_indexes()[0])
+        try:
+            key = (
+                self._document._class_name,  # pylint: disable=protected-access
+                fingerprint(self._query_obj),
+                index.index,
+                # a new snapshot of the index (i.e. refreshed in background) compiles new pipelines
+                index.version,
+                tuple(self._ordering or ()),
+            )
+        except (TypeError, RecursionError) as e:
+            # too deep trees are compiled without recursion, but they are not fingerprinted
+            self.logger.debug(f"Pipeline not cacheable: {e!r}")
+            return self._filter_cls(self._compile_search_pipeline(index))
+        return self._filter_cls(self.pipeline_cache.get_or_compile(key, lambda: self._compile_search_pipeline(index)))
+
+    def _filter_cls(self, pipeline: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        # the documents of the other classes of the hierarchy are in the same collection (and in the same index)
+        if not self._cls_query:
+            return pipeline
+        if pipeline and "$search" in pipeline[0]:
+            return pipeline[:1] + [{"$match": self._cls_query}] + pipeline[1:]
+        return [{"$match": self._cls_query}] + pipeline
+
     @property
     def _cursor(self):
-        if not self._search_result:
-            self._search_result = self.__collection_aggregate(self._aggrs)
-        if not self._return_objects:
+        if self._cursor_obj is None:
+            if self._search_result is None:
+                self._search_result = self.__collection_aggregate(self._aggrs)
+            # mongoengine will call _from_son on every row, no need to query again
             self._cursor_obj = self._search_result  # pylint: disable=attribute-defined-outside-init
         cursor = super()._cursor
         return cursor
 
+    def _search_ids(self) -> List[ObjectId]:
+        # we just need the ids, i.e. for delete and update
+        cursor = self.__collection_aggregate(self._aggrs + [{"$project": {"_id": 1}}])
+        return [obj["_id"] for obj in cursor if obj]
+
     def order_by(self, *keys):
         if not keys:
             return self
@@ -126,34 +280,129 @@ class AtlasQuerySet(QuerySet):
         qs._ordering = order_by  # pylint: disable=protected-access
         return qs
 
-    def __getitem__(self, key):
+    def __getitem__(self, key):  # pylint: disable=protected-access
+        # same as mongoengine, without slicing the cursor: aggregation cursors do not support it
+        qs = self.clone()
+        qs._empty = False
+        if isinstance(key, slice):
+            if (key.start or 0) < 0 or (key.stop or 0) < 0:
+                # same as pymongo cursors, that mongoengine slices
+                raise IndexError("Cursor instances do not support negative indices")
+            qs._skip, qs._limit = key.start, key.stop
+            if key.start and key.stop:
+                qs._limit = key.stop - key.start
+            if qs._limit == 0:
+                qs._empty = True
+            return qs
         if isinstance(key, int):
-            from mongoengine.queryset.base import BaseQuerySet
-
-            qs = self.clone()
+            if key < 0:
+                raise IndexError("Cursor instances do not support negative indices")
+            qs._skip = (qs._skip or 0) + key
             qs._limit = 1
-            return BaseQuerySet.__getitem__(qs, key)
-        return super().__getitem__(key)
+            try:
+                return next(qs)
+            except StopIteration as e:
+                raise IndexError(f"Index {key} out of range") from e
+        raise TypeError("Provide a slice or an integer index")
+
+    def exists(self) -> bool:
+        if self._none or self._empty:
+            return False
+        # we just need to know if there is at least a hit, so we do not load the document
+        qs = self.only("id")
+        qs._limit = 1  # pylint: disable=protected-access
+        cursor = qs.__collection_aggregate(qs._aggrs)  # pylint: disable=protected-access
+        return next(cursor, None) is not None
+
+    def paginate_after(self, token: Optional[str], size: int) -> AtlasPage:
+        return self._paginate(token, size, after=True)
+
+    def paginate_before(self, token: str, size: int) -> AtlasPage:
+        if not token:
+            raise AtlasQueryError("A token is required to paginate before")
+        return self._paginate(token, size, after=False)
+
+    def _paginate(self, token: Optional[str], size: int, after: bool) -> AtlasPage:
+        if not isinstance(size, int) or size <= 0:
+            raise AtlasQueryError(f"Page size must be a positive integer, not {size}")
+        qs = self.clone()
+        qs._skip, qs._limit = None, size  # pylint: disable=protected-access
+        pipeline = qs._aggrs  # pylint: disable=protected-access
+        if not pipeline or "$search" not in pipeline[0]:
+            raise AtlasQueryError("Atlas search does not support pagination without filtering.")
+        # unlike skip, the tokens let atlas start directly from the last hit, whatever the depth of the page
+        if token:
+            pipeline[0]["$search"]["searchAfter" if after else "searchBefore"] = token
+        pipeline.append({"$addFields": {PAGINATION_TOKEN_FIELD: {"$meta": "searchSequenceToken"}}})
+        documents, tokens = [], []
+        for row in qs.__collection_aggregate(pipeline):  # pylint: disable=protected-access
+            tokens.append(row.pop(PAGINATION_TOKEN_FIELD))
+            documents.append(qs._document._from_son(row, _auto_dereference=qs._auto_dereference))  # pylint: disable=protected-access
+        if not documents:
+            return AtlasPage(documents)
+        if after:
+            return AtlasPage(documents, tokens[-1] if len(documents) == size else None, tokens[0] if token else None)
+        # searchBefore returns the hits in reverse order
+        documents.reverse()
+        tokens.reverse()
+        return AtlasPage(documents, tokens[-1], tokens[0] if len(documents) == size else None)
+
+    def in_bulk_ids(self, ids: Iterable[Union[str, ObjectId]], chunk_size: int = 10000, workers: int = 4) -> Iterator[Document]:
+        """
+        Documents with the given ids (that match the other filters too), searched in chunks of ids on a thread pool.
+        At most `workers` chunks are loaded at the same time; the documents are returned in the order of the chunks.
+        """
+        if not isinstance(chunk_size, int) or not 0 < chunk_size <= BULK_IDS_MAX_CHUNK_SIZE:
+            raise AtlasQueryError(f"Chunk size must be between 1 and {BULK_IDS_MAX_CHUNK_SIZE}, not {chunk_size}")
+        if not isinstance(workers, int) or workers <= 0:
+            raise AtlasQueryError(f"Workers must be a positive integer, not {workers}")
+        if self._skip or self._limit is not None:
+            raise AtlasQueryError("Skip and limit would be applied to every chunk of ids")
+        # validated now, not on the first iteration
+        return self._in_bulk_chunks(self._chunk_ids(ids, chunk_size), workers)
+
+    def _in_bulk_chunks(self, chunks: List[List[ObjectId]], workers: int) -> Iterator[Document]:
+        pending = deque()
+        executor = ThreadPoolExecutor(max_workers=workers)
+        try:
+            for chunk in chunks:
+                qs = self.filter(id__in=chunk)
+                # the pipeline is compiled here, the workers just run it
+                _ = qs._aggrs  # pylint: disable=protected-access
+                pending.append(executor.submit(list, qs))
+                if len(pending) >= workers:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+        finally:
+            # if the iteration is stopped, the chunks not started yet are not needed anymore
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    @staticmethod
+    def _chunk_ids(ids: Iterable[Union[str, ObjectId]], chunk_size: int) -> List[List[ObjectId]]:
+        ids = list(ids)
+        wrong = next((id_ for id_ in ids if not isinstance(id_, (str, ObjectId))), None)
+        if wrong is not None:
+            raise TypeError(f"Wrong type {type(wrong)} for id field")
+        # a document in more chunks would be returned more than once
+        unique_ids = list(dict.fromkeys(id_ if isinstance(id_, ObjectId) else ObjectId(id_) for id_ in ids))
+        return [unique_ids[i : i + chunk_size] for i in range(0, len(unique_ids), chunk_size)]
+
+    def _has_data(self):
+        return self.exists()
 
     @property
     def _query(self):
-        if not self._search_result:
-            return None
-        start = self._skip
-        end = self._limit
-        # unfortunately here we have to actually run the query to get the objects
-        # I do not see other way to do this atm
-        ids: List[str] = []
-        for i, obj in enumerate(self._search_result):
-            if end is not None and i >= end:
-                break
-            if start is not None and i < start:
-                continue
-            if obj:
-                ids.append(obj["_id"])
-        self._query_obj = Q(id__in=ids)
-        self.logger.debug(self._query_obj.to_query(self._document))
-        return super()._query
+        # mongoengine needs an actual filter (i.e. delete, update):
+        # unfortunately here we have to run the search to get the ids and query them again
+        if self._mongo_query is None:
+            self._mongo_query = Q(id__in=self._search_ids()).to_query(self._document)
+            if self._cls_query:
+                self._mongo_query.update(self._cls_query)
+            self.logger.debug(self._mongo_query)
+        return self._mongo_query
 
     def __collection_aggregate(self, final_pipeline, **kwargs):
         collection = self._collection
@@ -181,35 +430,77 @@ class AtlasQuerySet(QuerySet):
         qs = super().__call__(q)
         return qs
 
+    def _get_meta_projections(self) -> List[Dict[str, Any]]:
+        if len(self._aggrs_query) == 1:
+            return [{"$replaceWith": "$$SEARCH_META"}, {"$limit": 1}]
+        # the search metadata do not know about the other aggregations, we have to count after them
+        return [{"$count": "count"}]
+
     def _get_projections(self) -> List[Dict[str, Any]]:
-        if self._count:
-            if self._query_obj:
-                return [{"$project": {"meta": "$$SEARCH_META"}}]
-            return [{"$count": "count"}]
         loaded_fields = self._loaded_fields.as_dict()
         self.logger.debug(loaded_fields)
         if loaded_fields:
             return [{"$project": loaded_fields}]
         return []
 
-    def count(self, with_limit_and_skip=False) -> int:  # pylint: disable=unused-argument
-        self._count = True
-        cursor = self.__collection_aggregate(self._aggrs)  # pylint: disable=protected-access
-        try:
-            count = next(cursor)
-        except StopIteration:
-            self._len = 0  # pylint: disable=attribute-defined-outside-init
-        else:
-            self.logger.debug(count)
-            if self._query_obj:
-                self._len = count["meta"]["count"]["total"]  # pylint: disable=attribute-defined-outside-init
-            else:
-                self._len = count["count"]  # pylint: disable=attribute-defined-outside-init
-        self.logger.debug(self._len)
-        return self._len
+    def _get_count_pipeline(self) -> List[Dict[str, Any]]:
+        # optimized and cached, as the pipeline of the documents
+        pipeline = self._get_search_pipeline()
+        if len(pipeline) == 1 and "$search" in pipeline[0]:
+            # $searchMeta returns just one document with the metadata, instead of a row for every hit
+            search = {key: value for key, value in pipeline[0]["$search"].items() if key != "sort"}
+            return [{"$searchMeta": {**search, "count": {"type": "total"}}}]
+        # the other aggregations have to filter the documents, so we have to count after them
+        return pipeline + [{"$count": "count"}]
+
+    def count(self, with_limit_and_skip=False, exact: bool = False) -> int:  # pylint: disable=unused-argument
+        if self._none or self._empty:
+            return 0
+        if not self._query_obj:
+            # no need to pass through the aggregation framework, that would scan the whole collection
+            if self._cls_query:
+                return self._collection.count_documents(self._cls_query)
+            if exact:
+                return self._collection.count_documents({})
+            return self._collection.estimated_document_count()
+        if self._total is not None:
+            return self._total
+        cursor = self.__collection_aggregate(self._get_count_pipeline())
+        self._total = self._read_count(next(cursor, None))
+        self.logger.debug(self._total)
+        return self._total
 
-    def limit(self, n):
+    def _read_count(self, count: Optional[Dict]) -> int:
+        self.logger.debug(count)
+        if not count:
+            return 0
+        # $searchMeta and $$SEARCH_META return {"count": {"total": n}}, $count returns {"count": n}
+        if isinstance(count["count"], dict):
+            return count["count"]["total"]
+        return count["count"]
+
+    def paginate(self, page: int, size: int) -> AtlasPage:
+        if not isinstance(page, int) or page <= 0:
+            raise AtlasQueryError(f"Page must be a positive integer, not {page}")
+        if not isinstance(size, int) or size <= 0:
+            raise AtlasQueryError(f"Page size must be a positive integer, not {size}")
         qs = self.clone()
-        qs._limit = n  # pylint: disable=protected-access
-        qs._other_aggregations.append({"$limit": n})  # pylint: disable=protected-access
-        return qs
+        qs._skip, qs._limit = (page - 1) * size or None, size  # pylint: disable=protected-access
+        if not qs._query_obj:  # pylint: disable=protected-access
+            # without filters there are no search metadata, but counting is just a metadata lookup
+            return AtlasPage(list(qs), total=qs.count())
+        qs._count = True  # pylint: disable=protected-access
+        result = next(qs.__collection_aggregate(qs._aggrs))  # pylint: disable=protected-access
+        from_son = qs._document._from_son  # pylint: disable=protected-access
+        documents = [from_son(row, _auto_dereference=qs._auto_dereference) for row in result["documents"]]
+        meta = result["meta"][0] if result["meta"] else None
+        return AtlasPage(documents, total=qs._read_count(meta))  # pylint: disable=protected-access
+
+    def _get_slice(self) -> List[Dict[str, Any]]:
+        # skip and limit are applied by atlas, so that we transfer just the requested page
+        aggregations = []
+        if self._skip:
+            aggregations.append({"$skip": self._skip})
+        if self._limit:
+            aggregations.append({"$limit": self._limit})
+        return aggregations
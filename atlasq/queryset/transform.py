@@ -1,10 +1,13 @@
 import datetime
+import functools
 import logging
 import re
-from typing import Any, Dict, List, Tuple, Union
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple, Union
 
+from atlasq.queryset.advisor import AtlasQueryRecorder
 from atlasq.queryset.exceptions import AtlasFieldError, AtlasIndexFieldError
 from atlasq.queryset.index import AtlasIndex, AtlasIndexType
+from atlasq.queryset.node import Param
 from bson import ObjectId
 from mongoengine import QuerySet
 
@@ -27,63 +30,104 @@ def mergedicts(dict1, dict2):
             yield k, dict2[k]
 
 
+class KeyPlan(NamedTuple):
+    """
+    Result of the parsing of a field__subfield__keywords key.
+    """
+
+    path: str
+    cast_id: bool
+    positive: bool
+    types: int
+    handler: str
+    args: Tuple
+    param_error: Optional[str]
+
+
 class AtlasTransform:
 
-    id_keywords = [
-        "pk",
-        "id",
-        "_id",
-    ]
-
-    keywords = [
-        "ne",
-        "lt",
-        "gt",
-        "lte",
-        "gte",
-        "in",
-        "nin",
-        "all",
-        "size",
-        "exists",
-        "exact",
-        "iexact",
-        "contains",
-        "icontains",
-        "startswith",
-        "istartswith",
-        "iendswith",
-        "endswith",
-        "iwholeword",
-        "wholeword",
-        "not",
-        "mod",
-        "regex",
-        "iregex",
-        "match",
-        "is",
-        "type",
-    ]
-    type_keywords = ["type"]
-    negative_keywords = ["ne", "nin", "not"]
-    exists_keywords = ["exists"]
-    range_keywords = ["gt", "gte", "lt", "lte"]
-    equals_keywords = []
+    id_keywords = frozenset(
+        [
+            "pk",
+            "id",
+            "_id",
+        ]
+    )
+
+    keywords = frozenset(
+        [
+            "ne",
+            "lt",
+            "gt",
+            "lte",
+            "gte",
+            "in",
+            "nin",
+            "all",
+            "size",
+            "exists",
+            "exact",
+            "iexact",
+            "contains",
+            "icontains",
+            "startswith",
+            "istartswith",
+            "iendswith",
+            "endswith",
+            "iwholeword",
+            "wholeword",
+            "not",
+            "mod",
+            "regex",
+            "iregex",
+            "match",
+            "is",
+            "type",
+        ]
+    )
+    type_keywords = frozenset(["type"])
+    negative_keywords = frozenset(["ne", "nin", "not"])
+    exists_keywords = frozenset(["exists"])
+    range_keywords = frozenset(["gt", "gte", "lt", "lte"])
+    equals_keywords = frozenset()
     equals_type_supported = (bool, ObjectId, int, datetime.datetime)
-    startswith_keywords = ["startswith", "istartswith"]
-    endswith_keywords = ["endswith", "iendswith"]
-    text_keywords = ["iwholeword", "wholeword", "exact", "iexact", "eq", "contains", "icontains"]
-    all_keywords = ["all"]
-    regex_keywords = ["regex", "iregex"]
-    size_keywords = ["size"]
-    not_converted = [
-        "mod",
-        "match",
-    ]
-
-    def __init__(self, atlas_query, atlas_index: AtlasIndex):
+    # lists longer than this are split in several `in` clauses
+    in_chunk_size: int = 1000
+    startswith_keywords = frozenset(["startswith", "istartswith"])
+    endswith_keywords = frozenset(["endswith", "iendswith"])
+    text_keywords = frozenset(["iwholeword", "wholeword", "iexact", "eq", "contains", "icontains"])
+    exact_keywords = frozenset(["exact"])
+    all_keywords = frozenset(["all"])
+    regex_keywords = frozenset(["regex", "iregex"])
+    size_keywords = frozenset(["size"])
+    not_converted = frozenset(
+        [
+            "mod",
+            "match",
+        ]
+    )
+    # keywords that can have a Param as value, the other ones change the structure of the query
+    param_keywords = frozenset(["ne", "nin", "not", "in"]) | range_keywords | equals_keywords | text_keywords | exact_keywords
+    # keyword -> method that builds the clause
+    operators = {
+        **dict.fromkeys(range_keywords, "_range"),
+        **dict.fromkeys(equals_keywords, "_equals"),
+        **dict.fromkeys(text_keywords, "_text"),
+        **dict.fromkeys(exact_keywords, "_exact"),
+        **dict.fromkeys(regex_keywords, "_regex"),
+        **dict.fromkeys(all_keywords, "_all"),
+        **dict.fromkeys(startswith_keywords, "_startswith"),
+        **dict.fromkeys(endswith_keywords, "_endswith"),
+    }
+
+    # set it to record the compiled paths and operators, see advise_index
+    recorder: Optional[AtlasQueryRecorder] = None
+
+    def __init__(self, atlas_query, atlas_index: AtlasIndex, document=None):
         self.atlas_query = atlas_query
         self.atlas_index = atlas_index
+        # the document the query is compiled for, to record the queries of every document on its own
+        self.document = document
 
     def _type(self, path: str, value: str):
         return {
@@ -140,14 +184,23 @@ class AtlasTransform:
                 raise AtlasFieldError(f"Range search for {path} must be {self.range_keywords}, not {keyword}")
         if isinstance(value, datetime.datetime):
             value = value.replace(microsecond=0)
-        elif isinstance(value, int):
+        elif isinstance(value, (int, Param)):
             pass
         else:
             raise AtlasFieldError(f"Range search for {path} must have a value of datetime or integer")
         return {"range": {"path": path, **{keyword: value for keyword in keywords}}}
 
+    def _equals_types(self, path: str) -> Tuple[type, ...]:
+        # strings can be compared as they are just on token fields
+        if self._is_token(path):
+            return (str, *self.equals_type_supported)
+        return self.equals_type_supported
+
+    def _is_token(self, path: str) -> bool:
+        return self.atlas_index.ensured and AtlasIndexType.TOKEN.value in self.atlas_index.get_types_from_keyword(path)
+
     def _single_equals(self, path: str, value: Union[ObjectId, bool]):
-        if not isinstance(value, self.equals_type_supported):
+        if not isinstance(value, (Param, *self._equals_types(path))):
             raise AtlasFieldError(f"Text search for equals on {path=} cannot be {value}, must be ObjectId or bool")
         return {
             "equals": {
@@ -161,32 +214,89 @@ class AtlasTransform:
             return {path: {"$elemMatch": value}}
         return {path: {"$elemMatch": {f"${keyword}": value}}}
 
+    def _in(self, path: str, values: List[Union[ObjectId, bool, int, datetime.datetime]]) -> Dict:
+        equals_types = self._equals_types(path)
+        for value in values:
+            if not isinstance(value, equals_types):
+                raise AtlasFieldError(f"Text search for equals on {path=} cannot be {value}, must be ObjectId or bool")
+        clauses = [
+            {
+                "in": {
+                    "path": path,
+                    "value": values[i : i + self.in_chunk_size],
+                }
+            }
+            for i in range(0, len(values), self.in_chunk_size)
+        ]
+        if len(clauses) == 1:
+            return clauses[0]
+        return {"compound": {"should": clauses, "minimumShouldMatch": 1}}
+
     def _equals(self, path: str, value: Union[List[Union[ObjectId, bool]], ObjectId, bool]) -> Dict:
         if isinstance(value, list):
             values = value
             if not values:
                 raise AtlasFieldError(f"Text search for equals on {path=} cannot be empty")
+            if not any(isinstance(value, Param) for value in values):
+                return self._in(path, values)
+            # every Param is bound on its own clause
             base = {"compound": {"should": [], "minimumShouldMatch": 1}}
             for value in values:
                 base["compound"]["should"].append(self._single_equals(path, value))
             return base
         return self._single_equals(path, value)
 
-    def _text(self, path: str, value: Any) -> Dict:
+    def _text(self, path: Union[str, Dict], value: Any) -> Dict:
         if not value:
             raise AtlasFieldError(f"Text search for {path} cannot be {value}")
         return {
             "text": {"query": value, "path": path},
         }
 
+    def _exact(self, path: str, value: Any) -> Dict:
+        # the cheapest operator that matches the whole value, without analyzing it
+        value_to_check = value[0] if isinstance(value, list) and value else value
+        if isinstance(value_to_check, Param):
+            is_string = issubclass(value_to_check.type, str)
+        else:
+            is_string = isinstance(value_to_check, str)
+        if is_string and self._is_token(path):
+            return self._equals(path, value)
+        if self.atlas_index.ensured:
+            multi = self.atlas_index.get_multi_from_analyzer(path, "lucene.keyword")
+            if multi:
+                return self._text({"value": path, "multi": multi}, value)
+        return self._text(path, value)
+
+    @staticmethod
+    def _escape_wildcard(value: str) -> str:
+        return re.sub(r"([\\*?])", r"\\\1", value)
+
+    def _wildcard(self, path: Union[str, Dict], value: str) -> Dict:
+        return {"wildcard": {"query": value, "path": path, "allowAnalyzedField": True}}
+
     def _startswith(self, path: str, value: Any) -> Dict:
         if not value:
             raise AtlasFieldError(f"Text search for {path} cannot be {value}")
-        return self._regex(path, f"{re.escape(value)}.*")
+        # a regex has to walk all the terms, while autocomplete and a wildcard with a prefix seek them
+        if self.atlas_index.ensured:
+            if AtlasIndexType.AUTOCOMPLETE.value in self.atlas_index.get_types_from_keyword(path):
+                # sequential: the tokens of the value in the same order, as a prefix of the whole string would be
+                return {"autocomplete": {"query": value, "path": path, "tokenOrder": "sequential"}}
+            multi = self.atlas_index.get_multi_from_analyzer(path, "lucene.keyword")
+            if multi:
+                # the prefix of the whole value, not of a single word
+                return self._wildcard({"value": path, "multi": multi}, f"{self._escape_wildcard(value)}*")
+        return self._wildcard(path, f"{self._escape_wildcard(value)}*")
 
     def _endswith(self, path: str, value: Any) -> Dict:
         if not value:
             raise AtlasFieldError(f"Text search for {path} cannot be {value}")
+        if self.atlas_index.ensured:
+            multi = self.atlas_index.get_reverse_multi(path)
+            if multi:
+                # the suffix is the prefix of the reversed value
+                return self._wildcard({"value": path, "multi": multi}, f"{self._escape_wildcard(value[::-1])}*")
         return self._regex(path, f".*{re.escape(value)}")
 
     def _size(self, path: str, value: int, operator: str) -> Dict:
@@ -228,6 +338,9 @@ class AtlasTransform:
                     raise TypeError(f"Wrong type {type(value[j])} for id field")
         elif isinstance(value, ObjectId):
             pass
+        elif isinstance(value, Param):
+            # the value will be cast when bound
+            value = Param(value.name, ObjectId)
         else:
             raise TypeError(f"Wrong type {type(value)} for id field")
         return value
@@ -241,97 +354,107 @@ class AtlasTransform:
             raise TypeError(f"It is not possible to have a dictionary as a value: {value}")
         else:
             value_to_check = value
-        if isinstance(value_to_check, self.equals_type_supported):
+        if isinstance(value_to_check, Param):
+            is_equals = issubclass(value_to_check.type, self.equals_type_supported)
+        else:
+            is_equals = isinstance(value_to_check, self.equals_type_supported)
+        if is_equals:
             obj = self._equals(path, value)
         else:
-            obj = self._text(path, value)
+            obj = self._exact(path, value)
         return obj
 
+    @classmethod
+    @functools.lru_cache(maxsize=4096)
+    def _parse_key(cls, key: str) -> KeyPlan:
+        key_parts = key.split("__")
+        path = ""
+        cast_id = False
+        positive = True
+        types = 0
+        param_error = None
+        for i, keyword in enumerate(key_parts):
+            if keyword in cls.id_keywords:
+                keyword = "_id"
+                key_parts[i] = keyword
+                cast_id = True
+            if keyword not in cls.keywords:
+                continue
+            # the key_part is made of field__subfield__keywords
+            # meaning that the first time that we find a keyword, we have the entire path
+            if not path:
+                path = ".".join(key_parts[:i])
+
+            if keyword in cls.not_converted:
+                raise NotImplementedError(f"Keyword {keyword} not implemented yet")
+            if keyword not in cls.param_keywords and param_error is None:
+                param_error = f"Keyword {keyword} does not support parameters"
+            if keyword in cls.negative_keywords:
+                positive = not positive
+
+            if keyword in cls.size_keywords:
+                # it must the last keyword, otherwise we do not support it
+                if i != len(key_parts) - 1:
+                    raise NotImplementedError(f"Keyword {keyword} not implemented yet")
+                return KeyPlan(path, cast_id, positive, types, "_size", (), param_error)
+            if keyword in cls.exists_keywords:
+                return KeyPlan(path, cast_id, positive, types, "_exists", (), param_error)
+            if keyword in cls.operators:
+                args = ((keyword,),) if keyword in cls.range_keywords else ()
+                return KeyPlan(path, cast_id, positive, types, cls.operators[keyword], args, param_error)
+            if keyword in cls.type_keywords:
+                if not positive:
+                    raise NotImplementedError(f"At the moment you can't have a negative `{keyword}` keyword")
+                types += 1
+        if not path:
+            path = ".".join(key_parts)
+        return KeyPlan(path, cast_id, positive, types, "_auto_convert_type_to_keyword", (), param_error)
+
     def transform(self) -> Tuple[List[Dict], List[Dict], List[Dict]]:
         other_aggregations = []
         affirmative = []
         negative = []
+        # embedded documents in affirmative, by path
+        embedded_documents = {}
 
         for key, value in self.atlas_query.items():
             # if the value is positive, we add the element in the positive list
             # if the value is negative, we add the element in the negative list
-            positive = 1
             if isinstance(value, QuerySet):
                 logger.debug("Casting queryset to list, otherwise the aggregation will fail")
                 value = list(value)
-            key_parts = key.split("__")
+            plan = self._parse_key(key)
+            path = plan.path
+            positive = plan.positive
+            if plan.cast_id:
+                value = self._cast_to_object_id(value)
+            if isinstance(value, Param) and plan.param_error:
+                raise NotImplementedError(plan.param_error)
+            if self.recorder is not None:
+                self.recorder.record(self.atlas_index.index, path, plan.handler, value, self.document)
+            for _ in range(plan.types):
+                other_aggregations.append(self._type(path, value))
             obj = None
-            path = ""
-            for i, keyword in enumerate(key_parts):
-                if keyword in self.id_keywords:
-                    keyword = "_id"
-                    key_parts[i] = keyword
-                    value = self._cast_to_object_id(value)
-                if keyword not in self.keywords:
-                    continue
-                # the key_part is made of field__subfield__keywords
-                # meaning that the first time that we find a keyword, we have the entire path
-                if not path:
-                    path = ".".join(key_parts[:i])
-
-                if keyword in self.not_converted:
-                    raise NotImplementedError(f"Keyword {keyword} not implemented yet")
-                if keyword in self.negative_keywords:
-                    positive *= -1
-
-                if keyword in self.size_keywords:
-                    # it must the last keyword, otherwise we do not support it
-                    if i != len(key_parts) - 1:
-                        raise NotImplementedError(f"Keyword {keyword} not implemented yet")
-                    other_aggregations.append(self._size(path, value, "eq" if positive == 1 else "ne"))
-                    break
-                if keyword in self.exists_keywords:
-                    if value is False:
-                        positive *= -1
-                    obj = self._exists(path)
-                    break
-
-                if keyword in self.range_keywords:
-                    obj = self._range(path, value, [keyword])
-                    break
-                if keyword in self.equals_keywords:
-                    obj = self._equals(path, value)
-                    break
-                if keyword in self.text_keywords:
-                    obj = self._text(path, value)
-                    break
-                if keyword in self.regex_keywords:
-                    obj = self._regex(path, value)
-                    break
-                if keyword in self.all_keywords:
-                    obj = self._all(path, value)
-                    break
-                if keyword in self.startswith_keywords:
-                    obj = self._startswith(path, value)
-                    break
-                if keyword in self.endswith_keywords:
-                    obj = self._endswith(path, value)
-                    break
-                if keyword in self.type_keywords:
-                    if positive == -1:
-                        raise NotImplementedError(f"At the moment you can't have a negative `{keyword}` keyword")
-                    other_aggregations.append(self._type(path, value))
+            if plan.handler == "_size":
+                other_aggregations.append(self._size(path, value, "eq" if positive else "ne"))
+            elif plan.handler == "_exists":
+                if value is False:
+                    positive = not positive
+                obj = self._exists(path)
             else:
-                if not path:
-                    path = ".".join(key_parts)
-                obj = self._auto_convert_type_to_keyword(path, value)
+                obj = getattr(self, plan.handler)(path, value, *plan.args)
 
             if obj:
                 if self.atlas_index.ensured:
                     self._ensure_path_is_indexed(path.split("."))
                 # we are wrapping the result to an embedded document
-                converted = self._convert_to_embedded_document(path.split("."), obj, positive=positive == 1)
+                converted = self._convert_to_embedded_document(path.split("."), obj, positive=positive)
                 if obj != converted:
                     # we have an embedded object
                     # the mustNot is done inside the embedded document clause
-                    affirmative = self.merge_embedded_documents(converted, affirmative)
+                    self._merge_embedded_document(converted, affirmative, embedded_documents)
                 else:
-                    if positive == 1:
+                    if positive:
                         affirmative.append(converted)
                     else:
                         negative.append(converted)
@@ -346,6 +469,22 @@ class AtlasTransform:
     @staticmethod
     def merge_embedded_documents(obj: Dict, list_of_obj: List[Dict]) -> List[Dict]:
         list_of_obj = list(list_of_obj)  # I hate function that change stuff in place
+        embedded_documents = {}
+        for already_present_obj in list_of_obj:
+            # we have added an object that is not actually an embedded object, nothing to do
+            if "embeddedDocument" in already_present_obj:
+                # only the first hit is merged, as it was when checking the list in order
+                embedded_documents.setdefault(already_present_obj["embeddedDocument"]["path"], already_present_obj)
+        AtlasTransform._merge_embedded_document(obj, list_of_obj, embedded_documents)
+        return list_of_obj
+
+    @staticmethod
+    def _merge_embedded_document(obj: Dict, list_of_obj: List[Dict], embedded_documents: Dict[str, Dict]) -> None:
+        """
+        Merges obj in list_of_obj, in place.
+        embedded_documents maps the path of the embedded documents in list_of_obj to the object,
+        so that the lookup does not depend on the length of the list.
+        """
         assert "embeddedDocument" in obj
         assert "path" in obj["embeddedDocument"]
         assert "operator" in obj["embeddedDocument"]
@@ -357,18 +496,11 @@ class AtlasTransform:
         operator = keys[0]  # values could be (must, mustNot)
         # the actual query
         content = obj["embeddedDocument"]["operator"]["compound"][operator]
-        for already_present_obj in list_of_obj:
-            # we have added an object that is not actually an embedded object, nothing to do
-            if "embeddedDocument" not in already_present_obj:
-                continue
-            # we check for a correspondence
-            if path == already_present_obj["embeddedDocument"]["path"]:
-                # we merge the objects
-                already_present_obj["embeddedDocument"]["operator"]["compound"].setdefault(operator, []).extend(content)
-                # we can exit since we are sure that it can be only 1 hit for path
-                # if this method is called at every embedded object
-                break
-        # otherwise we just add the object if no hit has been found
+        already_present_obj = embedded_documents.get(path)
+        if already_present_obj is not None:
+            # we merge the objects
+            already_present_obj["embeddedDocument"]["operator"]["compound"].setdefault(operator, []).extend(content)
         else:
+            # otherwise we just add the object if no hit has been found
             list_of_obj.append(obj)
-        return list_of_obj
+            embedded_documents[path] = obj
@@ -84,7 +84,7 @@ class AtlasQueryCompilerVisitor(QueryCompilerVisitor):
     def visit_query(self, query) -> List[Dict]:
         from atlasq.queryset.transform import AtlasTransform
 
-        affirmative, negative, aggregations = AtlasTransform(query.query, self.atlas_index).transform()
+        affirmative, negative, aggregations = AtlasTransform(query.query, self.atlas_index, self.document).transform()
         filters = {}
         if affirmative:
             filters.setdefault("compound", {})["filter"] = affirmative
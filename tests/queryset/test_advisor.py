@@ -0,0 +1,106 @@
+import datetime
+from unittest.mock import patch
+
+from atlasq import AtlasManager, AtlasQ, Param
+from atlasq.queryset.advisor import AtlasQueryRecorder, advise_index
+from atlasq.queryset.exceptions import AtlasQueryError
+from atlasq.queryset.transform import AtlasTransform
+from bson import ObjectId
+from mongoengine import (
+    BooleanField,
+    DateTimeField,
+    Document,
+    EmbeddedDocument,
+    EmbeddedDocumentField,
+    EmbeddedDocumentListField,
+    IntField,
+    StringField,
+)
+from tests.test_base import TestBaseCase
+
+
+class Address(EmbeddedDocument):
+    city = StringField()
+
+
+class Item(EmbeddedDocument):
+    sku = StringField()
+    quantity = IntField()
+
+
+class MyDocument(Document):
+    name = StringField()
+    surname = StringField()
+    age = IntField()
+    created = DateTimeField()
+    flag = BooleanField()
+    address = EmbeddedDocumentField(Address)
+    items = EmbeddedDocumentListField(Item)
+
+    atlas = AtlasManager("advisor")
+
+
+class MyOtherDocument(Document):
+    name = StringField()
+
+    atlas = AtlasManager("advisor")
+
+
+class TestAdvisor(TestBaseCase):
+    def test_record(self):
+        recorder = AtlasQueryRecorder()
+        with patch.object(AtlasTransform, "recorder", recorder):
+            AtlasQ(name="a", id__in=[ObjectId(), ObjectId()]).to_query(MyDocument)
+            AtlasQ(name=Param("n"), surname__startswith="s").to_query(MyDocument)
+        self.assertEqual(
+            {
+                ("name", "equals", str): 2,
+                ("_id", "equals", ObjectId): 1,
+                ("surname", "startswith", str): 1,
+            },
+            recorder.usages("advisor"),
+        )
+        self.assertEqual({}, recorder.usages("other"))
+        self.assertEqual(recorder.usages("advisor"), recorder.usages("advisor", MyDocument))
+        self.assertEqual({}, recorder.usages("advisor", MyOtherDocument))
+        recorder.clear()
+        self.assertEqual({}, recorder.usages("advisor"))
+
+    def test_advise_index(self):
+        recorder = AtlasQueryRecorder()
+        with patch.object(AtlasTransform, "recorder", recorder):
+            AtlasQ(name="a", surname__contains="b", age__gte=3, flag=True).to_query(MyDocument)
+            AtlasQ(name__startswith="a", created__lt=datetime.datetime(2020, 1, 1), id=ObjectId()).to_query(MyDocument)
+            AtlasQ(address__city__exists=True, items__sku="s", items__quantity__lte=2).to_query(MyDocument)
+            AtlasQ(age__size=0).to_query(MyDocument)
+            # an index with the same name, on another collection
+            AtlasQ(name="a", other__contains="b").to_query(MyOtherDocument)
+            self.assertEqual(advise_index(MyDocument), advise_index(MyDocument, recorder))
+        self.assertEqual(
+            {
+                "mappings": {
+                    "dynamic": False,
+                    "fields": {
+                        "_id": {"type": "objectId"},
+                        "address": {"type": "document", "dynamic": False, "fields": {"city": {"type": "string"}}},
+                        "age": {"type": "number"},
+                        "created": {"type": "date"},
+                        "flag": {"type": "boolean"},
+                        "items": {
+                            "type": "embeddedDocuments",
+                            "dynamic": False,
+                            "fields": {"quantity": {"type": "number"}, "sku": {"type": "token"}},
+                        },
+                        "name": [{"type": "token"}, {"type": "autocomplete"}],
+                        "surname": {"type": "string"},
+                    },
+                }
+            },
+            advise_index(MyDocument, recorder),
+        )
+        self.assertEqual(
+            {"mappings": {"dynamic": False, "fields": {"name": {"type": "token"}, "other": {"type": "string"}}}},
+            advise_index(MyOtherDocument, recorder),
+        )
+        with self.assertRaises(AtlasQueryError):
+            advise_index(MyDocument)
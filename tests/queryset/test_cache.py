@@ -0,0 +1,108 @@
+import datetime
+
+from atlasq import AtlasManager, AtlasQ
+from atlasq.queryset.cache import AtlasPipelineCache, fingerprint
+from mongoengine import Document, StringField
+from tests.test_base import TestBaseCase
+
+
+class MyDocument(Document):
+    name = StringField()
+    surname = StringField()
+
+    atlas = AtlasManager("test")
+
+
+class TestFingerprint(TestBaseCase):
+    def test_fingerprint(self):
+        self.assertEqual(fingerprint(AtlasQ(name="a", surname="b")), fingerprint(AtlasQ(surname="b", name="a")))
+        self.assertNotEqual(fingerprint(AtlasQ(name=1)), fingerprint(AtlasQ(name=True)))
+        self.assertNotEqual(fingerprint(AtlasQ(name="a") & AtlasQ(surname="b")), fingerprint(AtlasQ(name="a") | AtlasQ(surname="b")))
+        self.assertEqual(
+            fingerprint(AtlasQ(name__in=["a", "b"], date=datetime.datetime(2023, 1, 1))),
+            fingerprint(AtlasQ(name__in=["a", "b"], date=datetime.datetime(2023, 1, 1))),
+        )
+        with self.assertRaises(TypeError):
+            fingerprint(AtlasQ(name__in=MyDocument.objects.all()))
+        with self.assertRaises(TypeError):
+            fingerprint(AtlasQ(name__in=[str(i) for i in range(1000)]))
+
+
+class TestAtlasPipelineCache(TestBaseCase):
+    def test_get_or_compile(self):
+        cache = AtlasPipelineCache(maxsize=2)
+        pipeline = cache.get_or_compile("a", lambda: [{"$search": {"index": "a"}}])
+        self.assertEqual([{"$search": {"index": "a"}}], pipeline)
+        self.assertEqual((0, 1, 0), (cache.hits, cache.misses, cache.evictions))
+        # changing the result does not change the cache
+        pipeline[0]["$search"]["sort"] = {"name": 1}
+        pipeline = cache.get_or_compile("a", lambda: self.fail("Should not be compiled"))
+        self.assertEqual([{"$search": {"index": "a"}}], pipeline)
+        self.assertEqual((1, 1, 0), (cache.hits, cache.misses, cache.evictions))
+        cache.get_or_compile("b", lambda: [])
+        cache.get_or_compile("a", lambda: self.fail("Should not be compiled"))
+        cache.get_or_compile("c", lambda: [])
+        # b is the least recently used
+        self.assertEqual((2, 3, 1), (cache.hits, cache.misses, cache.evictions))
+        self.assertEqual(2, len(cache))
+        cache.get_or_compile("a", lambda: self.fail("Should not be compiled"))
+        cache.get_or_compile("b", lambda: [])
+        self.assertEqual((3, 4, 2), (cache.hits, cache.misses, cache.evictions))
+        cache.clear()
+        self.assertEqual(0, len(cache))
+        self.assertEqual((0, 0, 0), (cache.hits, cache.misses, cache.evictions))
+
+    def test_queryset(self):
+        cache = MyDocument.atlas.pipeline_cache
+        cache.clear()
+        first = MyDocument.atlas.filter(name="a").order_by("surname")._aggrs
+        second = MyDocument.atlas.filter(name="a").order_by("surname")._aggrs
+        self.assertEqual(first, second)
+        self.assertIsNot(first, second)
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+        MyDocument.atlas.filter(name="a").order_by("-surname")._aggrs
+        MyDocument.atlas.filter(name="b").order_by("surname")._aggrs
+        self.assertEqual((1, 3), (cache.hits, cache.misses))
+        # slicing and projections are not part of the cached pipeline
+        qs = MyDocument.atlas.only("name").filter(name="a").order_by("surname")[10:20]
+        self.assertEqual(first + [{"$skip": 10}, {"$limit": 10}, {"$project": {"name": 1}}], qs._aggrs)
+        self.assertEqual((2, 3), (cache.hits, cache.misses))
+
+    def test_queryset_optimization(self):
+        cache = MyDocument.atlas.pipeline_cache
+        cache.clear()
+        MyDocument.atlas.filter(AtlasQ(name="a") | AtlasQ(name="a"))._aggrs
+        # the or of the same clause is the clause alone, compounds included
+        self.assertEqual((5, 2), (cache.clauses_before, cache.clauses_after))
+        # the pipelines already cached are not optimized again
+        MyDocument.atlas.filter(AtlasQ(name="a") | AtlasQ(name="a"))._aggrs
+        self.assertEqual((5, 2), (cache.clauses_before, cache.clauses_after))
+        cache.clear()
+        self.assertEqual((0, 0), (cache.clauses_before, cache.clauses_after))
+
+    def test_queryset_index_version(self):
+        cache = MyDocument.atlas.pipeline_cache
+        cache.clear()
+        index = MyDocument.atlas.index
+        MyDocument.atlas.filter(name="a")._aggrs
+        # a new definition of the index is a new version, the pipelines compiled before are not used
+        index._indexed_fields = {"name": ["token"]}
+        MyDocument.atlas.filter(name="a")._aggrs
+        self.assertEqual((0, 2), (cache.hits, cache.misses))
+        MyDocument.atlas.filter(name="a")._aggrs
+        self.assertEqual((1, 2), (cache.hits, cache.misses))
+
+    def test_queryset_cloned_before_ensure(self):
+        index = MyDocument.atlas.index
+        qs = MyDocument.atlas.filter(surname="a")
+        self.assertEqual([{"text": {"query": "a", "path": "surname"}}], qs._get_search_pipeline()[0]["$search"]["compound"]["filter"])
+        # the queryset was cloned before the index was ensured, it compiles for the current definition anyway
+        index._set_indexed_from_mappings({"mappings": {"dynamic": False, "fields": {"surname": {"type": "token"}}}})
+        index.ensured = True
+        try:
+            self.assertEqual(
+                [{"equals": {"path": "surname", "value": "a"}}],
+                qs._get_search_pipeline()[0]["$search"]["compound"]["filter"],
+            )
+        finally:
+            index.ensured = False
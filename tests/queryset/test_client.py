@@ -0,0 +1,73 @@
+from unittest.mock import MagicMock, patch
+
+import requests
+from atlasq.queryset.client import AtlasAdminClient
+from atlasq.queryset.index import TEXT_INDEXES_ENDPOINT, AtlasIndex
+from requests.auth import HTTPDigestAuth
+from tests.test_base import TestBaseCase
+
+
+def _response(status_code, headers=None):
+    return MagicMock(status_code=status_code, headers=headers or {})
+
+
+class TestAtlasAdminClient(TestBaseCase):
+    def test_shared(self):
+        client = AtlasAdminClient.shared("user", "password")
+        self.assertIs(client, AtlasAdminClient.shared("user", "password"))
+        self.assertIsNot(client, AtlasAdminClient.shared("user", "other"))
+        self.assertIsInstance(client.session.auth, HTTPDigestAuth)
+
+    @patch("time.sleep")
+    def test_retry(self, sleep):
+        client = AtlasAdminClient("user", "password", retries=2, timeout=5)
+        with patch.object(client.session, "request", side_effect=[_response(503), _response(429, {"Retry-After": "3"}), _response(200)]) as mock:
+            self.assertEqual(200, client.get("url").status_code)
+        self.assertEqual(3, mock.call_count)
+        mock.assert_called_with("GET", "url", timeout=5)
+        self.assertEqual(3, sleep.call_args_list[1][0][0])
+
+        with patch.object(client.session, "request", side_effect=[_response(500)] * 3) as mock:
+            self.assertEqual(500, client.get("url").status_code)
+        self.assertEqual(3, mock.call_count)
+
+        with patch.object(client.session, "request", side_effect=[requests.ConnectionError(), _response(200)]) as mock:
+            self.assertEqual(200, client.get("url").status_code)
+        self.assertEqual(2, mock.call_count)
+
+    @patch("time.sleep")
+    def test_retry_post(self, sleep):
+        client = AtlasAdminClient("user", "password")
+        with patch.object(client.session, "request", side_effect=[_response(500)]) as mock:
+            self.assertEqual(500, client.post("url").status_code)
+        self.assertEqual(1, mock.call_count)
+        with patch.object(client.session, "request", side_effect=[requests.ConnectionError()]):
+            with self.assertRaises(requests.ConnectionError):
+                client.post("url")
+        with patch.object(client.session, "request", side_effect=[_response(429), _response(200)]) as mock:
+            self.assertEqual(200, client.post("url").status_code)
+        self.assertEqual(2, mock.call_count)
+        sleep.assert_called_once()
+
+    def test_backoff(self):
+        client = AtlasAdminClient("user", "password", backoff_factor=1, max_backoff=5)
+        for attempt in range(10):
+            self.assertTrue(0 <= client.backoff(attempt) <= min(5, 2**attempt))
+        self.assertEqual(5, client.backoff(0, _response(429, {"Retry-After": "60"})))
+        self.assertTrue(0 <= client.backoff(0, _response(429, {"Retry-After": "soon"})) <= 1)
+
+    def test_build_url(self):
+        url = TEXT_INDEXES_ENDPOINT.format(GROUP_ID="group", CLUSTER_NAME="cluster")
+        self.assertEqual("https://cloud.mongodb.com/api/atlas/v1.0/groups/group/clusters/cluster/fts/indexes", url)
+        self.assertEqual(url, AtlasAdminClient("user", "password").build_url(url))
+        client = AtlasAdminClient("user", "password", base_url="http://127.0.0.1:8080/")
+        self.assertEqual("http://127.0.0.1:8080/groups/group/clusters/cluster/fts/indexes", client.build_url(url))
+        self.assertEqual("http://127.0.0.1:8080/groups", client.build_url("/groups"))
+        self.assertEqual("url", client.build_url("url"))
+
+    def test_index(self):
+        client = AtlasAdminClient("user", "password")
+        with patch.object(client, "request", return_value=_response(200)) as mock:
+            AtlasIndex("myindex").upload_index({"mappings": {"fields": {}}}, "user", "password", "group", "cluster", client=client)
+        self.assertEqual("POST", mock.call_args[0][0])
+        self.assertEqual({"mappings": {"fields": {}}}, mock.call_args[1]["json"])
@@ -0,0 +1,185 @@
+import copy
+from unittest.mock import patch
+
+from atlasq import AtlasManager
+from atlasq.queryset.compiler import AtlasIndexRouter, AtlasQueryCompiler
+from atlasq.queryset.exceptions import AtlasIndexError
+from atlasq.queryset.index import AtlasIndex
+from atlasq.queryset.node import AtlasBoundQ, AtlasQ, AtlasQCombination
+from atlasq.queryset.visitor import AtlasQueryCompilerVisitor, AtlasSimplificationVisitor
+from bson import ObjectId
+from mongoengine import Document, StringField
+from tests.test_base import TestBaseCase
+
+
+class MyDocument(Document):
+    key = StringField()
+    key2 = StringField()
+    key3 = StringField()
+    key4 = StringField()
+
+    atlas = AtlasManager("test")
+
+
+class TestAtlasQueryCompiler(TestBaseCase):
+    def _visit(self, q):
+        q = copy.deepcopy(q)
+        q = q.accept(AtlasSimplificationVisitor())
+        return q.accept(AtlasQueryCompilerVisitor(MyDocument, AtlasIndex("test")))
+
+    def test_compile_same_as_visitors(self):
+        queries = [
+            AtlasQ(key="value"),
+            AtlasQ(key="value", key2__ne="value2"),
+            AtlasQ(key="value") & AtlasQ(key2="value2"),
+            AtlasQ(key="value") & AtlasQ(key="value2"),
+            AtlasQ(key="value") | AtlasQ(key2__ne="value2"),
+            ((AtlasQ(key="value") | AtlasQ(key2="value2")) & AtlasQ(key4="value4")) | AtlasQ(key3="value3"),
+            (AtlasQ(key="value") | AtlasQ(key2__size=0)) & AtlasQ(key3__type="string"),
+        ]
+        for q in queries:
+            with self.subTest(q=q):
+                self.assertEqual(self._visit(q), AtlasQueryCompiler(MyDocument, AtlasIndex("test")).compile(q))
+
+    def test_compile_flatten(self):
+        q = AtlasQCombination(
+            AtlasQ.OR,
+            [AtlasQ(key="a"), AtlasQCombination(AtlasQ.OR, [AtlasQ(key="b"), AtlasQ()]), AtlasQ(key="c")],
+        )
+        filters, *aggregations = AtlasQueryCompiler(MyDocument, AtlasIndex("test")).compile(q)
+        self.assertEqual([], aggregations)
+        self.assertEqual(
+            {
+                "compound": {
+                    "should": [
+                        {"compound": {"filter": [{"text": {"query": "a", "path": "key"}}]}},
+                        {"compound": {"filter": [{"text": {"query": "b", "path": "key"}}]}},
+                        {"compound": {"filter": [{"text": {"query": "c", "path": "key"}}]}},
+                    ],
+                    "minimumShouldMatch": 1,
+                },
+                "index": "test",
+            },
+            filters["$search"],
+        )
+
+    def test_compile_large(self):
+        q = AtlasQ()
+        for i in range(5000):
+            q = q | AtlasQ(key=str(i))
+        filters, *aggregations = q.to_query(MyDocument)
+        self.assertEqual([], aggregations)
+        self.assertEqual(5000, len(filters["$search"]["compound"]["should"]))
+
+    def test_compile_deep(self):
+        q = AtlasQ(key="0")
+        for i in range(1, 3000):
+            if i % 2:
+                q = q | AtlasQ(key=str(i))
+            else:
+                q = q & AtlasQ(key2=str(i))
+        filters, *aggregations = q.to_query(MyDocument)
+        self.assertEqual([], aggregations)
+        self.assertIn("should", filters["$search"]["compound"])
+        # too deep to be fingerprinted, but it can still be compiled
+        pipeline = MyDocument.atlas.filter(q)._get_search_pipeline()
+        self.assertEqual(1, len(pipeline))
+        self.assertIn("should", pipeline[0]["$search"]["compound"])
+
+    def test_compile_does_not_change_the_tree(self):
+        q = (AtlasQ(key="a") | AtlasQ(key2="b")) & AtlasQ(key3="c")
+        before = copy.deepcopy(q)
+        AtlasQueryCompiler(MyDocument, AtlasIndex("test")).compile(q)
+        self.assertEqual(before, q)
+
+
+class MyRoutedDocument(Document):
+    name = StringField()
+    description = StringField()
+
+    atlas = AtlasManager(["full", "exact", "dynamic"])
+
+
+class TestAtlasIndexRouter(TestBaseCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.full, self.exact, self.dynamic = MyRoutedDocument.atlas.indexes
+        self.full._set_indexed_from_mappings(
+            {
+                "mappings": {
+                    "dynamic": False,
+                    "fields": {
+                        "_id": {"type": "objectId"},
+                        "name": [{"type": "string"}, {"type": "token"}],
+                        "description": {"type": "string"},
+                    },
+                }
+            }
+        )
+        self.exact._set_indexed_from_mappings({"mappings": {"dynamic": False, "fields": {"_id": {"type": "objectId"}, "name": {"type": "token"}}}})
+        self.dynamic._set_indexed_from_mappings({"mappings": {"dynamic": True}})
+        for index in MyRoutedDocument.atlas.indexes:
+            index.ensured = True
+        self.router = AtlasIndexRouter(MyRoutedDocument.atlas.indexes, default=self.full)
+
+    def tearDown(self) -> None:
+        for index in MyRoutedDocument.atlas.indexes:
+            index.ensured = False
+        super().tearDown()
+
+    def test_usages(self):
+        ids = [ObjectId()]
+        self.assertEqual(
+            [("name", "_auto_convert_type_to_keyword", "a"), ("_id", "_auto_convert_type_to_keyword", ids)],
+            sorted(AtlasIndexRouter.usages(AtlasQ(name="a") | AtlasQ(id__in=ids)), reverse=True),
+        )
+        self.assertIsNone(AtlasIndexRouter.usages(AtlasBoundQ([{"$search": {}}])))
+
+    def test_route(self):
+        self.assertIs(self.exact, self.router.route(AtlasQ(name="a", id=ObjectId())))
+        self.assertIs(self.exact, self.router.route(AtlasQ(name__size=0) | AtlasQ(name__exists=True)))
+        # text needs a string field
+        self.assertIs(self.full, self.router.route(AtlasQ(name__contains="a")))
+        self.assertIs(self.full, self.router.route(AtlasQ(name="a", description__contains="b")))
+        # fields indexed by the dynamic index only
+        self.assertIs(self.dynamic, self.router.route(AtlasQ(other="a")))
+        self.assertIs(self.full, self.router.route(AtlasBoundQ([{"$search": {}}])))
+        self.exact.ensured = False
+        self.dynamic.ensured = False
+        self.assertIs(self.full, self.router.route(AtlasQ(name="a")))
+        self.assertIs(self.full, self.router.route(AtlasQ(other="a")))
+
+    def test_queryset(self):
+        qs = MyRoutedDocument.atlas.filter(name="a")
+        self.assertEqual("exact", qs._get_search_pipeline()[0]["$search"]["index"])
+        self.assertEqual("exact", qs._get_count_pipeline()[0]["$searchMeta"]["index"])
+        self.assertEqual("full", MyRoutedDocument.atlas.filter(name__contains="a")._get_search_pipeline()[0]["$search"]["index"])
+        qs = qs.using_index("dynamic")
+        self.assertEqual("dynamic", qs._get_search_pipeline()[0]["$search"]["index"])
+        # the choice is kept by the clones
+        self.assertEqual("dynamic", qs.filter(description="b")._get_search_pipeline()[0]["$search"]["index"])
+        with self.assertRaises(AtlasIndexError):
+            qs.using_index("other")
+
+    def test_queryset_default_refreshed(self):
+        self.dynamic.ensured = False
+        qs = MyRoutedDocument.atlas.filter(other__contains="a")
+        version = qs.index.version
+        # the full index is refreshed after the queryset was cloned
+        self.full._set_indexed_from_mappings({"mappings": {"dynamic": False, "fields": {"_id": {"type": "objectId"}, "title": {"type": "string"}}}})
+        self.assertNotEqual(version, self.full.version)
+        # no index covers the query, it goes to the default one as it is now
+        index = qs._search_index()
+        self.assertEqual("full", index.index)
+        self.assertEqual(self.full.version, index.version)
+
+    def test_queryset_every_index(self):
+        with patch("atlasq.queryset.queryset.AtlasIndex.wait_until_ready", side_effect=[True, False, True]) as wait_until_ready:
+            self.assertEqual([True, False, True], MyRoutedDocument.atlas.wait_until_ready("user", "password", "group", "cluster", timeout=10))
+        self.assertEqual(3, wait_until_ready.call_count)
+        # the timeout is for all the indexes
+        self.assertTrue(all(call.kwargs["timeout"] <= 10 for call in wait_until_ready.call_args_list))
+        with patch("atlasq.queryset.queryset.AtlasIndex.start_refresher", side_effect=lambda *args, **kwargs: object()) as start_refresher:
+            refreshers = MyRoutedDocument.atlas.start_index_refresher("user", "password", "group", "cluster")
+        self.assertEqual(3, len(refreshers))
+        self.assertEqual(3, start_refresher.call_count)
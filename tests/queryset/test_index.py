@@ -1,6 +1,16 @@
 from unittest.mock import patch
 
-from atlasq.queryset.index import AtlasIndex
+import copy
+import fnmatch
+import json
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from atlasq.queryset.exceptions import AtlasIndexError, AtlasIndexFieldError
+from atlasq.queryset.client import AtlasAdminClient
+from atlasq.queryset.index import AtlasIndex, AtlasIndexRefresher, AtlasIndexSnapshot, IndexedFieldsTrie, diff_index_definitions
+from atlasq.queryset.metadata import AtlasIndexMetadataCache
 from requests import HTTPError
 from tests.test_base import TestBaseCase
 
@@ -27,6 +37,32 @@ class TestIndex(TestBaseCase):
         self.assertFalse(index.ensure_keyword_is_indexed("field2"))
         self.assertTrue(index.ensure_keyword_is_indexed("field2.field3"))
 
+    def test_indexed_fields_trie(self):
+        fields = {"field1": "string", "field2": "document", "field2.*": "", "field3.field4": "number", "fi?ld5": "date"}
+        trie = IndexedFieldsTrie(fields)
+        for keyword in ["field1", "field1.a", "field2", "field2.a", "field2.a.b", "field3", "field3.field4", "field3.field5", "field5", "fie.ld5", "other"]:
+            with self.subTest(keyword=keyword):
+                self.assertEqual(any(fnmatch.fnmatch(keyword, field) for field in fields), trie.resolve(keyword)[0])
+        self.assertEqual((True, "string"), trie.resolve("field1"))
+        self.assertEqual((True, "document"), trie.resolve("field2"))
+        self.assertEqual((True, ""), trie.resolve("field2.a.b"))
+        self.assertEqual((True, "date"), trie.resolve("field5"))
+        self.assertEqual((False, None), trie.resolve("field3"))
+        self.assertEqual((True, ""), IndexedFieldsTrie(["*"]).resolve("any.field"))
+
+    def test_get_type_from_keyword(self):
+        index = AtlasIndex("myindex")
+        index.ensured = True
+        index._indexed_fields = {"field": "embeddedDocuments", "field.*": ""}
+        self.assertEqual("embeddedDocuments", index.get_type_from_keyword("field"))
+        self.assertEqual("", index.get_type_from_keyword("field.field2"))
+        with self.assertRaises(AtlasIndexFieldError):
+            index.get_type_from_keyword("other")
+        index._indexed_fields = {**index._indexed_fields, "other": "string"}
+        self.assertEqual("string", index.get_type_from_keyword("other"))
+        # the copies share the snapshot, with the resolved keywords
+        self.assertIs(index.snapshot, copy.copy(index).snapshot)
+
     def test_set_indexed_from_mappings(self):
         index = AtlasIndex("myindex")
         index._set_indexed_from_mappings(
@@ -94,7 +130,7 @@ class TestIndex(TestBaseCase):
             index._indexed_fields,
             ["field1", "field2", "field2.field3", "field2.field4"],
         )
-        index._indexed_fields.clear()
+        index._indexed_fields = {}
         index._set_indexed_fields(
             {
                 "type": "document",
@@ -102,15 +138,45 @@ class TestIndex(TestBaseCase):
             }
         )
         self.assertCountEqual(index._indexed_fields, ["*"])
-        index._indexed_fields.clear()
+        index._indexed_fields = {}
         index._set_indexed_fields([{"type": "string"}, {"type": "number"}], "f")
         self.assertCountEqual(index._indexed_fields, ["f"])
 
+    def test_set_indexed_fields_multi_types(self):
+        index = AtlasIndex("myindex")
+        index._set_indexed_from_mappings(
+            {
+                "mappings": {
+                    "dynamic": False,
+                    "fields": {
+                        "name": [
+                            {"type": "string", "multi": {"keyword": {"type": "string", "analyzer": "lucene.keyword"}}},
+                            {"type": "token"},
+                            {"type": "autocomplete"},
+                            {"type": "stringFacet"},
+                        ],
+                        "surname": {"type": "string"},
+                    },
+                }
+            }
+        )
+        index.ensured = True
+        self.assertEqual(["string", "token", "autocomplete", "stringFacet"], index.get_types_from_keyword("name"))
+        self.assertEqual(["string"], index.get_types_from_keyword("surname"))
+        self.assertEqual([], index.get_types_from_keyword("other"))
+        self.assertEqual("keyword", index.get_multi_from_analyzer("name", "lucene.keyword"))
+        self.assertIsNone(index.get_multi_from_analyzer("surname", "lucene.keyword"))
+        self.assertIsNone(index.get_reverse_multi("name"))
+        index.ensured = False
+        for accessor in (index.get_types_from_keyword, index.get_reverse_multi):
+            with self.assertRaises(AtlasIndexError):
+                accessor("name")
+
     def test_ensure_index_exists(self):
         index = AtlasIndex("myindex")
         self.assertFalse(index.ensured)
         with patch(
-            "requests.get",
+            "requests.Session.request",
             return_value=MockResponse(
                 [
                     {
@@ -139,7 +205,7 @@ class TestIndex(TestBaseCase):
             self.assertTrue(index.ensure_keyword_is_indexed("field1"))
             self.assertFalse(index.ensure_keyword_is_indexed("field3"))
         with patch(
-            "requests.get",
+            "requests.Session.request",
             return_value=MockResponse(
                 [
                     {
@@ -166,7 +232,7 @@ class TestIndex(TestBaseCase):
             self.assertFalse(index.ensured)
             self.assertCountEqual(index._indexed_fields, [])
         with patch(
-            "requests.get",
+            "requests.Session.request",
             return_value=MockResponse(
                 {
                     "detail": "Current user is not authorized to perform this action.",
@@ -180,3 +246,235 @@ class TestIndex(TestBaseCase):
         ):
             with self.assertRaises(HTTPError):
                 index.ensure_index_exists("user", "password", "group", "cluster", "db", "collection")
+
+    def test_snapshot(self):
+        index_result = {"name": "myindex", "mappings": {"dynamic": False, "fields": {"field1": {"type": "boolean"}}}}
+        snapshot = AtlasIndexSnapshot.from_index_result(index_result)
+        self.assertNotIn("type", index_result["mappings"])
+        self.assertTrue(snapshot.ensured)
+        with self.assertRaises(TypeError):
+            snapshot.indexed_fields["field2"] = "string"
+        self.assertEqual((True, "boolean"), snapshot.resolve("field1"))
+        replaced = snapshot.replace(ensured=False)
+        self.assertFalse(replaced.ensured)
+        self.assertIs(snapshot.indexed_fields, replaced.indexed_fields)
+        self.assertNotEqual(snapshot.version, replaced.version)
+        # the keywords of the queries on a dynamic index are unbounded, the resolved ones are not
+        with patch("atlasq.queryset.index.RESOLVED_KEYWORDS_MAX_SIZE", 10):
+            dynamic = AtlasIndexSnapshot.from_index_result({"name": "myindex", "mappings": {"dynamic": True}})
+        for i in range(100):
+            self.assertEqual((True, ""), dynamic.resolve(f"field{i}"))
+        self.assertEqual(10, dynamic._resolve_cached.cache_info().currsize)
+
+        index = AtlasIndex("myindex")
+        before = copy.copy(index)
+        with patch("requests.Session.request", return_value=MockResponse([index_result], 200)):
+            self.assertTrue(index.ensure_index_exists("user", "password", "group", "cluster", "db", "collection"))
+        # the copies made before keep the old definition
+        self.assertFalse(before.ensured)
+        self.assertEqual({}, dict(before._indexed_fields))
+        current = index.snapshot
+        with patch("requests.Session.request", return_value=MockResponse({"error": 401}, 401)):
+            with self.assertRaises(HTTPError):
+                index.ensure_index_exists("user", "password", "group", "cluster", "db", "collection")
+        self.assertIs(current, index.snapshot)
+
+    def test_refresher(self):
+        index_result = {"name": "myindex", "mappings": {"dynamic": False, "fields": {"field1": {"type": "boolean"}}}}
+        index = AtlasIndex("myindex")
+        with self.assertRaises(AtlasIndexError):
+            AtlasIndexRefresher(index, ("user", "password", "group", "cluster", "db", "collection"), interval=0)
+        with self.assertRaises(AtlasIndexError):
+            AtlasIndexRefresher(index, ("user", "password", "group", "cluster", "db", "collection"), jitter=1)
+        refresher = AtlasIndexRefresher(index, ("user", "password", "group", "cluster", "db", "collection"), interval=10, jitter=0.5)
+        for _ in range(100):
+            self.assertTrue(5 <= refresher.next_interval() <= 15)
+        with patch("requests.Session.request", return_value=MockResponse({"error": 401}, 401)):
+            self.assertFalse(refresher.refresh())
+        self.assertFalse(index.ensured)
+
+        refreshed = threading.Event()
+        with patch("requests.Session.request", return_value=MockResponse([index_result], 200)) as mock:
+            mock.side_effect = lambda *args, **kwargs: refreshed.set() or mock.return_value
+            refresher = index.start_refresher("user", "password", "group", "cluster", "db", "collection", interval=0.01)
+            try:
+                self.assertTrue(refreshed.wait(5))
+            finally:
+                refresher.stop(timeout=5)
+        self.assertFalse(refresher.is_alive())
+        self.assertTrue(index.ensured)
+        self.assertTrue(index.ensure_keyword_is_indexed("field1"))
+
+    def test_refresher_unexpected_error(self):
+        index = AtlasIndex("myindex")
+        refreshed = threading.Event()
+        errors = [TypeError("unexpected"), KeyError("mappings")]
+
+        def ensure_index_exists(*args, **kwargs):  # pylint: disable=unused-argument
+            if errors:
+                raise errors.pop(0)
+            refreshed.set()
+            return True
+
+        # the errors are logged, and the next refreshes go on
+        with patch.object(AtlasIndex, "ensure_index_exists", side_effect=ensure_index_exists):
+            with self.assertLogs("atlasq.queryset.index", "ERROR"):
+                refresher = index.start_refresher("user", "password", "group", "cluster", "db", "collection", interval=0.01)
+                try:
+                    self.assertTrue(refreshed.wait(5))
+                finally:
+                    refresher.stop(timeout=5)
+        self.assertEqual([], errors)
+
+
+class AtlasStandInHandler(BaseHTTPRequestHandler):
+    """
+    Search indexes endpoints of the Admin API, on the indexes of the server.
+    A new or updated index is ready after `polls_to_ready` reads.
+    """
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+    def _reply(self, status_code, body):
+        data = json.dumps(body).encode()
+        self.send_response(status_code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _body(self):
+        return json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        self.server.requests.append(("GET", self.path))
+        *_, db_name, collection_name = self.path.split("/")
+        results = []
+        for index in self.server.indexes.values():
+            if (index["database"], index["collectionName"]) == (db_name, collection_name):
+                index["polls"] += 1
+                if index["polls"] >= self.server.polls_to_ready and index["status"] == "IN_PROGRESS":
+                    index["status"] = "STEADY"
+                results.append({key: value for key, value in index.items() if key != "polls"})
+        self._reply(200, results)
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        self.server.requests.append(("POST", self.path))
+        index = {**self._body(), "indexID": str(len(self.server.indexes)), "status": "IN_PROGRESS", "polls": 0}
+        self.server.indexes[index["indexID"]] = index
+        self._reply(200, {key: value for key, value in index.items() if key != "polls"})
+
+    def do_PATCH(self):  # pylint: disable=invalid-name
+        self.server.requests.append(("PATCH", self.path))
+        index_id = self.path.rsplit("/", 1)[-1]
+        if index_id not in self.server.indexes:
+            self._reply(404, {"error": 404})
+            return
+        index = self.server.indexes[index_id]
+        index.update(self._body(), status="IN_PROGRESS", polls=0)
+        self._reply(200, {key: value for key, value in index.items() if key != "polls"})
+
+
+class TestIndexAdminAPI(TestBaseCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), AtlasStandInHandler)
+        self.server.indexes = {}
+        self.server.requests = []
+        self.server.polls_to_ready = 2
+        threading.Thread(target=self.server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True).start()
+        self.client = AtlasAdminClient("user", "password", base_url=f"http://127.0.0.1:{self.server.server_address[1]}")
+
+    def tearDown(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+        self.client.close()
+        super().tearDown()
+
+    def _definition(self, **fields):
+        return {
+            "name": "myindex",
+            "database": "db",
+            "collectionName": "collection",
+            "mappings": {"dynamic": False, "fields": {"field1": {"type": "string"}, **fields}},
+        }
+
+    def test_diff_index_definitions(self):
+        current = {
+            "name": "myindex",
+            "indexID": "ID",
+            "status": "STEADY",
+            "analyzer": "lucene.standard",
+            "mappings": {"dynamic": False, "fields": {"field1": [{"type": "string"}], "field2": [{"type": "token"}, {"type": "string"}]}},
+        }
+        desired = {"mappings": {"fields": {"field1": {"type": "string"}, "field2": [{"type": "string"}, {"type": "token"}]}}}
+        self.assertEqual([], diff_index_definitions(current, desired))
+        desired["mappings"]["fields"]["field1"]["analyzer"] = "lucene.keyword"
+        desired["analyzer"] = "lucene.english"
+        self.assertEqual(["analyzer", "mappings.fields.field1.analyzer", "searchAnalyzer"], diff_index_definitions(current, desired))
+        # the types of the fields of the documents can be in any order too
+        current["mappings"]["fields"]["doc"] = {"type": "document", "fields": {"field3": [{"type": "token"}, {"type": "string"}]}}
+        desired["mappings"]["fields"]["doc"] = {"type": "document", "dynamic": False, "fields": {"field3": [{"type": "string"}, {"type": "token"}]}}
+        self.assertNotIn("mappings.fields.doc", diff_index_definitions(current, desired))
+        # while the token filters are applied in order
+        current["analyzers"] = [{"name": "custom", "tokenizer": {"type": "standard"}, "tokenFilters": [{"type": "lowercase"}, {"type": "reverse"}]}]
+        desired["analyzers"] = [{"name": "custom", "tokenizer": {"type": "standard"}, "tokenFilters": [{"type": "reverse"}, {"type": "lowercase"}]}]
+        self.assertIn("analyzers", diff_index_definitions(current, desired))
+
+    def test_upload_index(self):
+        index = AtlasIndex("myindex")
+        endpoint = "/groups/group/clusters/cluster/fts/indexes"
+        created = index.upload_index(self._definition(), "user", "password", "group", "cluster", client=self.client)
+        self.assertEqual("0", created["indexID"])
+        self.assertEqual([("GET", endpoint + "/db/collection"), ("POST", endpoint)], self.server.requests)
+
+        # the same mapping is not sent again
+        self.server.requests.clear()
+        index.upload_index(self._definition(), "user", "password", "group", "cluster", client=self.client)
+        self.assertEqual(["GET"], [method for method, _ in self.server.requests])
+
+        self.server.requests.clear()
+        updated = index.upload_index(self._definition(field2={"type": "number"}), "user", "password", "group", "cluster", client=self.client)
+        self.assertEqual([("GET", endpoint + "/db/collection"), ("PATCH", endpoint + "/0")], self.server.requests)
+        self.assertEqual({"type": "number"}, updated["mappings"]["fields"]["field2"])
+        self.assertEqual(1, len(self.server.indexes))
+
+        # a different order of the token filters is a different analyzer
+        analyzer = {"name": "custom", "tokenizer": {"type": "standard"}, "tokenFilters": [{"type": "lowercase"}, {"type": "reverse"}]}
+        index.upload_index({**self._definition(field2={"type": "number"}), "analyzers": [analyzer]}, "user", "password", "group", "cluster", client=self.client)
+        self.server.requests.clear()
+        analyzer = {**analyzer, "tokenFilters": analyzer["tokenFilters"][::-1]}
+        index.upload_index({**self._definition(field2={"type": "number"}), "analyzers": [analyzer]}, "user", "password", "group", "cluster", client=self.client)
+        self.assertEqual(["GET", "PATCH"], [method for method, _ in self.server.requests])
+
+    def test_upload_index_metadata_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            metadata_cache = AtlasIndexMetadataCache(directory, ttl=300)
+            index = AtlasIndex("myindex")
+            # the index does not exist yet, and that is cached too
+            self.assertFalse(index.ensure_index_exists("user", "password", "group", "cluster", "db", "collection", metadata_cache, self.client))
+            index.upload_index(self._definition(), "user", "password", "group", "cluster", client=self.client, metadata_cache=metadata_cache)
+            self.server.requests.clear()
+            self.assertTrue(index.ensure_index_exists("user", "password", "group", "cluster", "db", "collection", metadata_cache, self.client))
+            self.assertEqual([], self.server.requests)
+            self.assertEqual("string", index.get_type_from_keyword("field1"))
+            # an update replaces the cached definition too
+            definition = self._definition(field2={"type": "number"})
+            index.upload_index(definition, "user", "password", "group", "cluster", client=self.client, metadata_cache=metadata_cache)
+            self.assertTrue(index.ensure_index_exists("user", "password", "group", "cluster", "db", "collection", metadata_cache, self.client))
+            self.assertEqual("number", index.get_type_from_keyword("field2"))
+
+    @patch("time.sleep")
+    def test_wait_until_ready(self, sleep):
+        index = AtlasIndex("myindex")
+        index.upload_index(self._definition(), "user", "password", "group", "cluster", client=self.client)
+        self.assertTrue(index.wait_until_ready("user", "password", "group", "cluster", "db", "collection", client=self.client, poll_interval=0.5))
+        self.assertEqual([0.5], [args[0] for args, _ in sleep.call_args_list])
+
+        self.server.polls_to_ready = 100
+        index.upload_index(self._definition(field2={"type": "number"}), "user", "password", "group", "cluster", client=self.client)
+        self.assertFalse(index.wait_until_ready("user", "password", "group", "cluster", "db", "collection", timeout=0, client=self.client))
+        self.server.indexes["0"]["status"] = "FAILED"
+        with self.assertRaises(AtlasIndexError):
+            index.wait_until_ready("user", "password", "group", "cluster", "db", "collection", client=self.client)
@@ -1,6 +1,13 @@
-from atlasq.queryset.manager import AtlasManager
+from unittest.mock import patch
+
+from atlasq.queryset.exceptions import AtlasIndexError
+from atlasq.queryset.index import AtlasIndex
+from atlasq.queryset.manager import AtlasIndexReport, AtlasManager, _atlas_documents, ensure_all_indexes
 from atlasq.queryset.queryset import AtlasQuerySet
 from mongoengine import Document, QuerySet, fields
+from mongoengine.connection import ConnectionFailure
+from requests import HTTPError
+from tests.queryset.test_index import MockResponse
 from tests.test_base import TestBaseCase
 
 
@@ -14,6 +21,18 @@ class TestManager(TestBaseCase):
         self.assertEqual(MyDocument.atlas.index.index, "myindex")
         # self.assertIsNotNone(MyDocument.atlas.cache)
 
+    def test_with_indexes(self):
+        exact = AtlasIndex("exact")
+
+        class MyDocument(Document):
+            name = fields.StringField(required=True)
+            atlas = AtlasManager(["full", exact])
+
+        self.assertEqual(["full", "exact"], [index.index for index in MyDocument.atlas.indexes])
+        self.assertIs(exact, MyDocument.atlas.indexes[1])
+        # the first one is the default
+        self.assertEqual("full", MyDocument.atlas.index.index)
+
     def test_no_index(self):
         class MyDocument(Document):
             name = fields.StringField(required=True)
@@ -22,3 +41,109 @@ class TestManager(TestBaseCase):
         self.assertIsInstance(MyDocument.atlas, QuerySet)
         with self.assertRaises(AssertionError):
             self.assertIsInstance(MyDocument.atlas, AtlasQuerySet)
+
+    def test_atlas_documents(self):
+        class MyDocument(Document):
+            name = fields.StringField(required=True)
+            atlas = AtlasManager("myindex")
+
+        class MyAbstractDocument(Document):
+            meta = {"abstract": True}
+            atlas = AtlasManager("myindex")
+
+        class MyConcreteDocument(MyAbstractDocument):
+            pass
+
+        class MyPlainDocument(MyAbstractDocument):
+            atlas = None
+
+        documents = _atlas_documents()
+        self.assertIn((MyDocument, MyDocument.__dict__["atlas"]), documents)
+        # the manager of an abstract document is inherited by the concrete ones
+        self.assertIn((MyConcreteDocument, MyAbstractDocument.__dict__["atlas"]), documents)
+        self.assertNotIn(MyAbstractDocument, [document for document, _ in documents])
+        self.assertNotIn(MyPlainDocument, [document for document, _ in documents])
+
+    def test_ensure_all_indexes(self):
+        class MyDocument(Document):
+            meta = {"collection": "shared"}
+            name = fields.StringField(required=True)
+            atlas = AtlasManager("myindex")
+
+        class MyOtherDocument(Document):
+            meta = {"collection": "shared"}
+            name = fields.StringField(required=True)
+            atlas = AtlasManager("otherindex")
+
+        class MyMissingDocument(Document):
+            meta = {"collection": "missing"}
+            name = fields.StringField(required=True)
+            atlas = AtlasManager("myindex")
+
+        class MyFailingDocument(Document):
+            meta = {"collection": "failing"}
+            name = fields.StringField(required=True)
+            atlas = AtlasManager("myindex")
+
+        class MyUnconnectedDocument(Document):
+            meta = {"collection": "unconnected", "db_alias": "unconnected"}
+            name = fields.StringField(required=True)
+            atlas = AtlasManager("myindex")
+
+        indexes = {
+            "shared": MockResponse(
+                [
+                    {"name": "myindex", "mappings": {"dynamic": False, "fields": {"name": {"type": "string"}}}},
+                    {"name": "otherindex", "mappings": {"dynamic": True}},
+                ],
+                200,
+            ),
+            "missing": MockResponse([], 200),
+            "failing": MockResponse({"error": 401}, 401),
+        }
+        documents = [MyDocument, MyOtherDocument, MyMissingDocument, MyFailingDocument, MyUnconnectedDocument]
+        with patch("requests.Session.request", side_effect=lambda method, url, **kwargs: indexes[url.rsplit("/", 1)[-1]]) as mock:
+            reports = ensure_all_indexes("user", "password", "group", "cluster", workers=2, documents=documents)
+        # the indexes of a collection are fetched once
+        self.assertEqual(3, mock.call_count)
+        reports = {report.document: report for report in reports}
+        self.assertCountEqual(documents, reports)
+        self.assertEqual(AtlasIndexReport(MyDocument, "myindex", True), reports[MyDocument])
+        self.assertEqual(AtlasIndexReport(MyOtherDocument, "otherindex", True), reports[MyOtherDocument])
+        self.assertEqual(AtlasIndexReport(MyMissingDocument, "myindex", False), reports[MyMissingDocument])
+        self.assertFalse(reports[MyFailingDocument].ensured)
+        self.assertIsInstance(reports[MyFailingDocument].error, HTTPError)
+        # the collection of the document can not be found, the other documents are ensured anyway
+        self.assertFalse(reports[MyUnconnectedDocument].ensured)
+        self.assertIsInstance(reports[MyUnconnectedDocument].error, ConnectionFailure)
+        self.assertTrue(MyDocument.atlas.index.ensure_keyword_is_indexed("name"))
+        self.assertTrue(MyOtherDocument.atlas.index.ensure_keyword_is_indexed("name"))
+        with self.assertRaises(AtlasIndexError):
+            ensure_all_indexes("user", "password", "group", "cluster", workers=0)
+
+    def test_ensure_all_indexes_abstract(self):
+        class MyAbstractDocument(Document):
+            meta = {"abstract": True}
+            atlas = AtlasManager("myindex")
+
+        class MyFirstDocument(MyAbstractDocument):
+            meta = {"collection": "first"}
+            name = fields.StringField()
+
+        class MySecondDocument(MyAbstractDocument):
+            meta = {"collection": "second"}
+            surname = fields.StringField()
+
+        # every collection has its own index
+        self.assertIsNot(MyFirstDocument.atlas.index, MySecondDocument.atlas.index)
+        self.assertIs(MyFirstDocument.atlas.index, MyFirstDocument.atlas.index)
+        self.assertIsNot(MyAbstractDocument.__dict__["atlas"].index, MyFirstDocument.atlas.index)
+        indexes = {
+            "first": MockResponse([{"name": "myindex", "mappings": {"dynamic": False, "fields": {"name": {"type": "string"}}}}], 200),
+            "second": MockResponse([{"name": "myindex", "mappings": {"dynamic": False, "fields": {"surname": {"type": "string"}}}}], 200),
+        }
+        with patch("requests.Session.request", side_effect=lambda method, url, **kwargs: indexes[url.rsplit("/", 1)[-1]]):
+            reports = ensure_all_indexes("user", "password", "group", "cluster", documents=[MyFirstDocument, MySecondDocument])
+        self.assertTrue(all(report.ensured for report in reports))
+        self.assertEqual(["name"], list(MyFirstDocument.atlas.index._indexed_fields))
+        self.assertEqual(["surname"], list(MySecondDocument.atlas.index._indexed_fields))
@@ -0,0 +1,72 @@
+import json
+import os
+import tempfile
+import time
+from unittest.mock import patch
+
+from atlasq.queryset.index import AtlasIndex
+from atlasq.queryset.metadata import AtlasIndexMetadataCache
+from tests.queryset.test_index import MockResponse
+from tests.test_base import TestBaseCase
+
+INDEX = {
+    "name": "myindex",
+    "mappings": {"dynamic": False, "fields": {"field1": {"type": "boolean"}}},
+}
+
+
+class TestAtlasIndexMetadataCache(TestBaseCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self.directory = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.cache = AtlasIndexMetadataCache(self.directory.name, ttl=60)
+        self.key = ("group", "cluster", "db", "collection", "myindex")
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+        super().tearDown()
+
+    def test_get_set(self):
+        self.assertEqual((False, None), self.cache.get(self.key))
+        self.cache.set(self.key, INDEX)
+        self.assertEqual((True, INDEX), self.cache.get(self.key))
+        self.assertEqual((False, None), self.cache.get(self.key[:-1] + ("other",)))
+        self.cache.set(self.key, None)
+        self.assertEqual((True, None), self.cache.get(self.key))
+        # no temporary file is left behind
+        self.assertEqual(1, len(os.listdir(self.directory.name)))
+        self.cache.clear()
+        self.assertEqual((False, None), self.cache.get(self.key))
+
+    def test_invalid(self):
+        self.cache.set(self.key, INDEX)
+        path = self.cache._path(self.key)
+        with patch("time.time", return_value=time.time() + 61):
+            self.assertEqual((False, None), self.cache.get(self.key))
+        with open(path, encoding="utf-8") as f:
+            entry = json.load(f)
+        entry["index"]["name"] = "other"
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(entry, f)
+        self.assertEqual((False, None), self.cache.get(self.key))
+        entry["version"] = 0
+        entry["index"]["name"] = "myindex"
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(entry, f)
+        self.assertEqual((False, None), self.cache.get(self.key))
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("{")
+        self.assertEqual((False, None), self.cache.get(self.key))
+
+    def test_ensure_index_exists(self):
+        with patch("requests.Session.request", return_value=MockResponse([INDEX], 200)) as mock:
+            index = AtlasIndex("myindex")
+            self.assertTrue(index.ensure_index_exists("user", "password", "group", "cluster", "db", "collection", metadata_cache=self.cache))
+            index = AtlasIndex("myindex")
+            self.assertTrue(index.ensure_index_exists("user", "password", "group", "cluster", "db", "collection", metadata_cache=self.cache))
+            mock.assert_called_once()
+            self.assertEqual("boolean", index.get_type_from_keyword("field1"))
+            index = AtlasIndex("otherindex")
+            self.assertFalse(index.ensure_index_exists("user", "password", "group", "cluster", "db", "collection", metadata_cache=self.cache))
+            self.assertFalse(index.ensure_index_exists("user", "password", "group", "cluster", "db", "collection", metadata_cache=self.cache))
+            self.assertEqual(2, mock.call_count)
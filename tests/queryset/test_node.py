@@ -46,3 +46,14 @@ class TestAtlasQCombination(TestBaseCase):
         q1 = AtlasQCombination(AtlasQCombination.AND, [AtlasQ(field=3), AtlasQ(field2=4)])
         q2 = AtlasQCombination(AtlasQCombination.AND, [AtlasQ(field3=3), AtlasQ(field4=4)])
         self.assertIsInstance(q1._combine(q2, q1.AND), AtlasQCombination)
+
+    def test_to_query_twice(self):
+        class MyDocument(Document):
+            name = fields.StringField()
+            surname = fields.StringField()
+
+            atlas = AtlasManager("test")
+
+        q = (AtlasQ(name="a") | AtlasQ(surname="b")) & AtlasQ(name="c")
+        self.assertEqual(q.to_query(MyDocument), q.to_query(MyDocument))
+        self.assertIsInstance(q.children[0], AtlasQCombination)
@@ -0,0 +1,129 @@
+from unittest.mock import patch
+
+from atlasq import AtlasManager, AtlasQ
+from atlasq.queryset.optimizer import AtlasSearchOptimizer, count_clauses
+from atlasq.queryset.transform import AtlasTransform
+from bson import ObjectId
+from mongoengine import BooleanField, Document, StringField
+from tests.test_base import TestBaseCase
+
+
+class MyDocument(Document):
+    name = StringField()
+    surname = StringField()
+    flag = BooleanField()
+
+    atlas = AtlasManager("test")
+
+
+class TestAtlasSearchOptimizer(TestBaseCase):
+    def _optimize(self, q):
+        optimizer = AtlasSearchOptimizer()
+        pipeline = optimizer.optimize(q.to_query(MyDocument))
+        self.assertEqual(1, len(pipeline))
+        self.assertEqual("test", pipeline[0]["$search"]["index"])
+        return pipeline[0]["$search"]["compound"], optimizer.clauses_before, optimizer.clauses_after
+
+    def test_count_clauses(self):
+        self.assertEqual(1, count_clauses({"text": {"query": "a", "path": "name"}}))
+        self.assertEqual(
+            4,
+            count_clauses(
+                {
+                    "compound": {
+                        "filter": [{"text": {"query": "a", "path": "name"}}],
+                        "mustNot": [{"embeddedDocument": {"path": "e", "operator": {"exists": {"path": "e.f"}}}}],
+                    }
+                }
+            ),
+        )
+
+    def test_equals_to_in(self):
+        ids = [ObjectId(), ObjectId(), ObjectId()]
+        compound, before, after = self._optimize(AtlasQ(id=ids[0]) | AtlasQ(id=ids[1]) | AtlasQ(id__in=ids[1:]))
+        self.assertEqual({"filter": [{"in": {"path": "_id", "value": ids}}]}, compound)
+        self.assertEqual((7, 2), (before, after))
+
+        compound, before, after = self._optimize(AtlasQ(id__ne=ids[0]) & AtlasQ(id__nin=ids[1:]))
+        self.assertEqual({"mustNot": [{"equals": {"path": "_id", "value": ids[0]}}, {"in": {"path": "_id", "value": ids[1:]}}]}, compound)
+        self.assertEqual((3, 3), (before, after))
+
+    def test_in_chunks(self):
+        ids = [ObjectId(), ObjectId(), ObjectId()]
+        compound, _, _ = self._optimize(AtlasQ(id__in=ids) | AtlasQ(id__in=ids[:2]))
+        self.assertEqual({"filter": [{"in": {"path": "_id", "value": ids}}]}, compound)
+        with patch.object(AtlasTransform, "in_chunk_size", 2):
+            compound, _, _ = self._optimize(AtlasQ(id=ids[0]) | AtlasQ(id=ids[1]) | AtlasQ(id=ids[2]))
+        self.assertEqual(
+            {
+                "should": [
+                    {"compound": {"filter": [{"in": {"path": "_id", "value": ids[:2]}}]}},
+                    {"compound": {"filter": [{"in": {"path": "_id", "value": ids[2:]}}]}},
+                ],
+                "minimumShouldMatch": 1,
+            },
+            compound,
+        )
+
+    def test_text_multi_path(self):
+        compound, before, after = self._optimize((AtlasQ(name="a") | AtlasQ(surname="a")) & AtlasQ(flag=True))
+        self.assertEqual(
+            {
+                "filter": [
+                    {"text": {"query": "a", "path": ["name", "surname"]}},
+                    {"equals": {"path": "flag", "value": True}},
+                ]
+            },
+            compound,
+        )
+        self.assertEqual((7, 3), (before, after))
+
+    def test_or_in_filter(self):
+        compound, _, _ = self._optimize((AtlasQ(name="a") | AtlasQ(surname="b")) & AtlasQ(flag=True))
+        self.assertEqual(
+            {
+                "filter": [{"equals": {"path": "flag", "value": True}}],
+                "should": [
+                    {"compound": {"filter": [{"text": {"query": "a", "path": "name"}}]}},
+                    {"compound": {"filter": [{"text": {"query": "b", "path": "surname"}}]}},
+                ],
+                "minimumShouldMatch": 1,
+            },
+            compound,
+        )
+
+    def test_dedupe(self):
+        compound, before, after = self._optimize(AtlasQ(name="a") | AtlasQ(name="a") | AtlasQ(name="b"))
+        self.assertEqual(
+            {
+                "should": [
+                    {"compound": {"filter": [{"text": {"query": "a", "path": "name"}}]}},
+                    {"compound": {"filter": [{"text": {"query": "b", "path": "name"}}]}},
+                ],
+                "minimumShouldMatch": 1,
+            },
+            compound,
+        )
+        self.assertEqual((7, 5), (before, after))
+
+    def test_minimum_should_match(self):
+        compound = {
+            "should": [
+                {"text": {"query": "a", "path": "name"}},
+                {"text": {"query": "a", "path": "name"}},
+                {"text": {"query": "a", "path": "surname"}},
+            ],
+            "minimumShouldMatch": 2,
+        }
+        pipeline = AtlasSearchOptimizer().optimize([{"$search": {"compound": compound, "index": "test"}}])
+        self.assertEqual(compound, pipeline[0]["$search"]["compound"])
+
+    def test_without_search(self):
+        pipeline = [{"$match": {"name": {"$type": "string"}}}]
+        self.assertEqual(pipeline, AtlasSearchOptimizer().optimize(pipeline))
+        self.assertEqual([], AtlasSearchOptimizer().optimize([]))
+
+    def test_queryset(self):
+        ids = [ObjectId(), ObjectId()]
+        pipeline = MyDocument.atlas.filter(id__in=ids)._get_search_pipeline()
+        self.assertEqual([{"$search": {"compound": {"filter": [{"in": {"path": "_id", "value": ids}}]}, "index": "test"}}], pipeline)
@@ -0,0 +1,150 @@
+import datetime
+from unittest.mock import patch
+
+from atlasq import AtlasManager, AtlasPreparedQuery, AtlasQ, Param
+from atlasq.queryset.exceptions import AtlasFieldError, AtlasQueryError
+from atlasq.queryset.node import AtlasBoundQ
+from bson import ObjectId
+from mongoengine import DateTimeField, Document, StringField
+from tests.test_base import TestBaseCase
+
+
+class MyDocument(Document):
+    name = StringField()
+    created = DateTimeField()
+
+    atlas = AtlasManager("test")
+
+
+class MyRoutedDocument(Document):
+    name = StringField()
+
+    atlas = AtlasManager(["full", "exact"])
+
+
+class TestAtlasPreparedQuery(TestBaseCase):
+    def test_prepare(self):
+        prepared = AtlasPreparedQuery(AtlasQ(name=Param("n")) & AtlasQ(created__gte=Param("since", datetime.datetime)), MyDocument)
+        self.assertEqual({"n", "since"}, prepared.params)
+        self.assertEqual(
+            [
+                {
+                    "$search": {
+                        "index": "test",
+                        "compound": {
+                            "filter": [
+                                {"text": {"query": Param("n"), "path": "name"}},
+                                {"range": {"path": "created", "gte": Param("since", datetime.datetime)}},
+                            ]
+                        },
+                    }
+                }
+            ],
+            prepared.pipeline,
+        )
+
+    def test_bind(self):
+        prepared = AtlasPreparedQuery(AtlasQ(name=Param("n")) & AtlasQ(created__gte=Param("since", datetime.datetime)), MyDocument)
+        since = datetime.datetime(2023, 1, 1, 10, 10, 10, 5000)
+        with patch("atlasq.queryset.transform.AtlasTransform.transform") as transform:
+            bound = prepared.bind(n="value", since=since)
+            transform.assert_not_called()
+        self.assertIsInstance(bound, AtlasBoundQ)
+        self.assertEqual(
+            [
+                {
+                    "$search": {
+                        "index": "test",
+                        "compound": {
+                            "filter": [
+                                {"text": {"query": "value", "path": "name"}},
+                                {"range": {"path": "created", "gte": since.replace(microsecond=0)}},
+                            ]
+                        },
+                    }
+                }
+            ],
+            bound.to_query(MyDocument),
+        )
+        # the prepared query is not changed
+        self.assertEqual({"n", "since"}, prepared.params)
+        with self.assertRaises(AtlasFieldError):
+            prepared.bind(n="value", since="yesterday")
+        with self.assertRaises(AtlasFieldError):
+            prepared.bind(n="", since=since)
+        with self.assertRaises(AtlasQueryError):
+            prepared.bind(n="value")
+        with self.assertRaises(AtlasQueryError):
+            prepared.bind(n="value", since=since, other=3)
+
+    def test_bind_token(self):
+        index = MyDocument.atlas.index
+        index._set_indexed_from_mappings({"mappings": {"dynamic": False, "fields": {"name": [{"type": "string"}, {"type": "token"}]}}})
+        index.ensured = True
+        try:
+            prepared = AtlasPreparedQuery(AtlasQ(name=Param("n")), MyDocument)
+            self.assertEqual([{"equals": {"path": "name", "value": Param("n")}}], prepared.pipeline[0]["$search"]["compound"]["filter"])
+            bound = prepared.bind(n="value")
+            self.assertEqual([{"equals": {"path": "name", "value": "value"}}], bound.pipeline[0]["$search"]["compound"]["filter"])
+        finally:
+            index.ensured = False
+
+    def test_bind_id(self):
+        prepared = AtlasPreparedQuery(AtlasQ(id=Param("id"), name__ne=Param("n")), MyDocument)
+        bound = prepared.bind(id="5e45de3dd2bfea029b68cce2", n="value")
+        self.assertEqual(
+            {
+                "filter": [{"equals": {"path": "_id", "value": ObjectId("5e45de3dd2bfea029b68cce2")}}],
+                "mustNot": [{"text": {"query": "value", "path": "name"}}],
+            },
+            bound.pipeline[0]["$search"]["compound"],
+        )
+        bound = prepared.bind(id=["5e45de3dd2bfea029b68cce2"], n="value")
+        self.assertEqual(
+            [{"in": {"path": "_id", "value": [ObjectId("5e45de3dd2bfea029b68cce2")]}}],
+            bound.pipeline[0]["$search"]["compound"]["filter"],
+        )
+        with self.assertRaises(TypeError):
+            prepared.bind(id=3, n="value")
+
+    def test_not_supported(self):
+        with self.assertRaises(AtlasQueryError):
+            AtlasPreparedQuery(AtlasQ(name__startswith=Param("n")), MyDocument)
+        with self.assertRaises(AtlasQueryError):
+            AtlasPreparedQuery(AtlasQ(name="a") & AtlasQ(name__regex=Param("n")), MyDocument)
+        # operators that can not be bound again
+        with patch("atlasq.queryset.transform.AtlasTransform._text", side_effect=lambda path, value: {"phrase": {"query": value, "path": path}}):
+            with self.assertRaises(AtlasQueryError):
+                AtlasPreparedQuery(AtlasQ(name=Param("n")), MyDocument)
+
+    def test_index(self):
+        full, exact = MyRoutedDocument.atlas.indexes
+        prepared = AtlasPreparedQuery(AtlasQ(name=Param("n")), MyRoutedDocument.atlas.using_index("exact"))
+        self.assertEqual("exact", prepared.pipeline[0]["$search"]["index"])
+        self.assertEqual("exact", prepared.bind(n="value").pipeline[0]["$search"]["index"])
+        full._set_indexed_from_mappings({"mappings": {"dynamic": False, "fields": {"name": {"type": "string"}, "other": {"type": "string"}}}})
+        exact._set_indexed_from_mappings({"mappings": {"dynamic": False, "fields": {"name": {"type": "token"}}}})
+        full.ensured = exact.ensured = True
+        try:
+            # the index the queryset routes the query to
+            prepared = AtlasPreparedQuery(AtlasQ(name=Param("n")), MyRoutedDocument)
+            self.assertEqual("exact", prepared.pipeline[0]["$search"]["index"])
+            bound = prepared.bind(n="value")
+            self.assertEqual(
+                {"index": "exact", "compound": {"filter": [{"equals": {"path": "name", "value": "value"}}]}},
+                bound.pipeline[0]["$search"],
+            )
+            prepared = AtlasPreparedQuery(AtlasQ(name__contains=Param("n")), MyRoutedDocument)
+            self.assertEqual("full", prepared.pipeline[0]["$search"]["index"])
+        finally:
+            full.ensured = exact.ensured = False
+
+    def test_queryset(self):
+        prepared = AtlasPreparedQuery(AtlasQ(name=Param("n")), MyDocument)
+        qs = MyDocument.atlas.filter(prepared.bind(n="value")).order_by("name")
+        self.assertEqual(
+            [{"$search": {"index": "test", "compound": {"filter": [{"text": {"query": "value", "path": "name"}}]}, "sort": {"name": 1}}}],
+            qs._aggrs,
+        )
+        with self.assertRaises(AtlasQueryError):
+            MyDocument.atlas.filter(prepared.bind(n="value"), name="value")
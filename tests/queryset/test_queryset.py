@@ -2,7 +2,9 @@ from unittest.mock import patch
 
 from atlasq import AtlasManager, AtlasQ
 from atlasq.queryset.exceptions import AtlasIndexFieldError, AtlasQueryError
+from bson import ObjectId
 from mongoengine import Document, ListField, StringField
+import mongomock
 from mongomock import command_cursor
 from mongomock.command_cursor import CommandCursor
 from tests.test_base import TestBaseCase
@@ -17,6 +19,17 @@ class MyDocument(Document):
     atlas = AtlasManager("test")
 
 
+class MyParentDocument(Document):
+    meta = {"allow_inheritance": True}
+    name = StringField()
+
+    atlas = AtlasManager("test")
+
+
+class MyChildDocument(MyParentDocument):
+    pass
+
+
 class TestQuerySet(TestBaseCase):
     def setUp(self) -> None:
         super(TestQuerySet, self).setUp()
@@ -51,6 +64,7 @@ class TestQuerySet(TestBaseCase):
                 "cluster_name",
                 self.db_name,
                 "my_document",
+                metadata_cache=None,
             )
 
     def test_count(self):
@@ -62,11 +76,69 @@ class TestQuerySet(TestBaseCase):
         with patch(
             "mongomock.aggregate.process_pipeline",
             side_effect=[
-                command_cursor.CommandCursor([{"meta": {"count": {"total": 0}}}]),
+                command_cursor.CommandCursor([{"count": {"total": 0}}]),
             ],
-        ):
-            r = self.base.filter(name="wrong.com").count()
-        self.assertEqual(r, 0)
+        ) as mock:
+            qs = self.base.filter(name="wrong.com")
+            r = qs.count()
+            self.assertEqual(r, 0)
+            # memoized
+            self.assertEqual(qs.count(), 0)
+            mock.assert_called_once()
+            self.assertEqual(
+                mock.call_args[0][2],
+                [
+                    {
+                        "$searchMeta": {
+                            "index": "test",
+                            "compound": {"filter": [{"text": {"query": "wrong.com", "path": "name"}}]},
+                            "count": {"type": "total"},
+                        }
+                    }
+                ],
+            )
+
+    def test_count_none(self):
+        self.obs.save()
+        with patch.object(MyDocument._get_collection(), "aggregate") as aggregate:
+            with patch.object(MyDocument._get_collection(), "estimated_document_count") as estimated:
+                self.assertEqual(0, self.base.none().count())
+                self.assertEqual(0, self.base.filter(name="test.com").none().count())
+                self.assertEqual(0, self.base.filter(name="test.com")[5:5].count())
+                estimated.assert_not_called()
+            aggregate.assert_not_called()
+
+    def test_count_no_filter(self):
+        self.obs.save()
+        with patch.object(MyDocument._get_collection(), "aggregate") as aggregate:
+            with patch.object(MyDocument._get_collection(), "estimated_document_count", return_value=1) as estimated:
+                self.assertEqual(self.base.count(), 1)
+                estimated.assert_called_once()
+                self.assertEqual(self.base.count(exact=True), 1)
+                estimated.assert_called_once()
+            aggregate.assert_not_called()
+
+    def test_get_count_pipeline(self):
+        self.assertEqual(self.base._get_count_pipeline(), [{"$count": "count"}])
+        qs = self.base.filter(related_threat__size=0)
+        pipeline = qs._get_count_pipeline()
+        self.assertEqual(pipeline[-1], {"$count": "count"})
+        self.assertNotIn("$searchMeta", pipeline[0])
+        qs = self.base.filter(name="test.com").order_by("name")
+        with patch.object(qs.pipeline_cache, "get_or_compile", wraps=qs.pipeline_cache.get_or_compile) as get_or_compile:
+            self.assertEqual(
+                [
+                    {
+                        "$searchMeta": {
+                            "index": "test",
+                            "compound": {"filter": [{"text": {"query": "test.com", "path": "name"}}]},
+                            "count": {"type": "total"},
+                        }
+                    }
+                ],
+                qs._get_count_pipeline(),
+            )
+            get_or_compile.assert_called_once()
 
     def test_order_by(self):
         with self.assertRaises(AtlasQueryError):
@@ -117,7 +189,7 @@ class TestQuerySet(TestBaseCase):
         with patch(
             "mongomock.aggregate.process_pipeline",
             side_effect=[
-                command_cursor.CommandCursor([{}]),
+                command_cursor.CommandCursor([]),
             ],
         ):
             self.assertEqual(len(qs), 0)
@@ -142,10 +214,14 @@ class TestQuerySet(TestBaseCase):
         obj = next(cursor)
         self.assertEqual(obj["_id"], self.obs.id)
         self.assertIn("name", obj)
-        # exclude does not work with aggregate, even with mongoengine
-        cursor = self.base.exclude("name").aggregate({"$match": {"name": "test.com"}})
-        obj = next(cursor)
+        # the projections of only and exclude come before the custom aggregations
+        obj = next(self.base.exclude("md5").aggregate({"$match": {"name": "test.com"}}))
         self.assertIn("name", obj)
+        self.assertNotIn("md5", obj)
+        obj = next(self.base.only("name").aggregate({"$match": {"name": "test.com"}}))
+        self.assertEqual({"_id", "name"}, set(obj))
+        with self.assertRaises(StopIteration):
+            next(self.base.exclude("name").aggregate({"$match": {"name": "test.com"}}))
 
     def test_first(self):
         self.assertIsNone(self.base.first())
@@ -163,7 +239,7 @@ class TestQuerySet(TestBaseCase):
         with patch(
             "mongomock.aggregate.process_pipeline",
             side_effect=[
-                command_cursor.CommandCursor([{}]),
+                command_cursor.CommandCursor([]),
             ],
         ):
             with self.assertRaises(MyDocument.DoesNotExist):
@@ -179,3 +255,251 @@ class TestQuerySet(TestBaseCase):
         self.base.index.ensured = True
         with self.assertRaises(AtlasIndexFieldError):
             self.base.get(another_field="test.com")
+
+    def test_hydrate(self):
+        self.obs.save()
+        with patch(
+            "mongomock.aggregate.process_pipeline",
+            side_effect=[
+                command_cursor.CommandCursor([{"_id": self.obs.id, "name": self.obs.name}]),
+            ],
+        ) as mock:
+            qs = self.base.filter(name="test.com")
+            objs = list(qs)
+            mock.assert_called_once()
+        # no id-requery
+        self.assertIsNone(qs._mongo_query)
+        self.assertEqual(1, len(objs))
+        self.assertIsInstance(objs[0], MyDocument)
+        self.assertEqual(objs[0].id, self.obs.id)
+        self.assertEqual(objs[0].name, self.obs.name)
+
+    def test_slice(self):
+        rows = [{"_id": i, "name": str(i)} for i in range(2)]
+        with patch(
+            "mongomock.aggregate.process_pipeline",
+            side_effect=[
+                command_cursor.CommandCursor(rows),
+                command_cursor.CommandCursor(rows[1:]),
+            ],
+        ) as mock:
+            qs = self.base.filter(name="test.com")
+            self.assertEqual(["0", "1"], [obj.name for obj in qs[1:3]])
+            self.assertEqual([{"$skip": 1}, {"$limit": 2}], mock.call_args[0][2][1:])
+            self.assertEqual("1", qs[3].name)
+            self.assertEqual([{"$skip": 3}, {"$limit": 1}], mock.call_args[0][2][1:])
+        with patch("mongomock.aggregate.process_pipeline") as mock:
+            with self.assertRaises(IndexError):
+                _ = qs[-1]
+            with self.assertRaises(IndexError):
+                _ = qs[-2:]
+            with self.assertRaises(IndexError):
+                _ = qs[:-1]
+            mock.assert_not_called()
+
+    def test_inheritance(self):
+        MyParentDocument.objects.delete()
+        MyParentDocument(name="a").save()
+        child = MyChildDocument(name="a").save()
+        process_pipeline = mongomock.aggregate.process_pipeline
+
+        def search(collection, database, pipeline, session):
+            # mongomock does not know $search, every document is a hit
+            if pipeline and "$search" in pipeline[0]:
+                pipeline = pipeline[1:]
+            if pipeline and "$searchMeta" in pipeline[0]:
+                return CommandCursor([{"count": {"total": collection.count_documents({})}}])
+            pipeline = [{"$addFields": {"_paginationToken": "token"}} if "$addFields" in stage else stage for stage in pipeline]
+            return process_pipeline(collection, database, pipeline, session)
+
+        with patch("mongomock.aggregate.process_pipeline", side_effect=search):
+            qs = MyChildDocument.atlas.filter(name="a")
+            self.assertEqual({"$match": {"_cls": "MyParentDocument.MyChildDocument"}}, qs._aggrs[1])
+            self.assertEqual([child.id], [obj.id for obj in qs])
+            self.assertIsInstance(qs.first(), MyChildDocument)
+            self.assertTrue(qs.exists())
+            self.assertEqual(1, qs.count())
+            self.assertEqual([child.id], [obj.id for obj in qs.paginate(1, 10).documents])
+            self.assertEqual(1, qs.paginate(1, 10).total)
+            self.assertEqual([child.id], [obj.id for obj in MyChildDocument.atlas.order_by("name").filter(name="a").paginate_after(None, 10).documents])
+            self.assertEqual([child.id], [obj.id for obj in MyChildDocument.atlas.all()])
+            self.assertEqual(2, MyParentDocument.atlas.filter(name="a").count())
+        MyParentDocument.objects.delete()
+
+    def test_skip_limit(self):
+        qs = self.base.filter(name="test.com").skip(100).limit(10)
+        self.assertEqual(qs._aggrs[1:], [{"$skip": 100}, {"$limit": 10}])
+        qs = self.base.only("name").filter(name="test.com")[100:200]
+        self.assertEqual(qs._aggrs[1:], [{"$skip": 100}, {"$limit": 100}, {"$project": {"name": 1}}])
+        # the aggregations that filter the documents must be executed before
+        qs = self.base.filter(name="test.com", related_threat__size=0).limit(10)
+        self.assertIn("$match", qs._aggrs[1])
+        self.assertEqual(qs._aggrs[2], {"$limit": 10})
+        # filtering again after the pipeline has been compiled
+        qs = self.base.filter(name="test.com")
+        _ = qs._aggrs
+        self.assertEqual(qs.limit(5)._aggrs[1:], [{"$limit": 5}])
+
+    def test_delete(self):
+        self.obs.save()
+        other = MyDocument.objects.create(name="other.com", md5="md5", classification="domain")
+        with patch(
+            "mongomock.aggregate.process_pipeline",
+            side_effect=[
+                command_cursor.CommandCursor([{"_id": self.obs.id, "name": self.obs.name}]),
+            ],
+        ):
+            self.assertEqual(1, self.base.filter(name="test.com").delete())
+        self.assertEqual([other], list(MyDocument.objects.all()))
+
+    def test_first_limit(self):
+        with patch(
+            "mongomock.aggregate.process_pipeline",
+            side_effect=[
+                command_cursor.CommandCursor([{"_id": self.obs.id, "name": self.obs.name}]),
+            ],
+        ) as mock:
+            self.assertEqual(self.base.filter(name="test.com").first().name, self.obs.name)
+            self.assertEqual([{"$limit": 1}], mock.call_args[0][2][1:])
+
+    def test_get_limit(self):
+        with patch(
+            "mongomock.aggregate.process_pipeline",
+            side_effect=[
+                command_cursor.CommandCursor([{"_id": self.obs.id, "name": self.obs.name}, {"_id": self.obs.id, "name": self.obs.name}]),
+            ],
+        ) as mock:
+            with self.assertRaises(MyDocument.MultipleObjectsReturned):
+                self.base.get(name="test.com")
+            mock.assert_called_once()
+            self.assertEqual([{"$limit": 2}], mock.call_args[0][2][1:])
+
+    def test_exists(self):
+        self.assertFalse(self.base.exists())
+        self.assertFalse(self.base)
+        self.obs.save()
+        self.assertTrue(self.base.exists())
+        self.assertTrue(self.base)
+        with patch(
+            "mongomock.aggregate.process_pipeline",
+            side_effect=[
+                command_cursor.CommandCursor([{"_id": self.obs.id}]),
+                command_cursor.CommandCursor([]),
+            ],
+        ) as mock:
+            self.assertTrue(self.base.filter(name="test.com").exists())
+            self.assertEqual([{"$limit": 1}, {"$project": {"_id": 1}}], mock.call_args[0][2][1:])
+            self.assertFalse(self.base.filter(name="test.com"))
+
+    def test_paginate_after(self):
+        rows = [{"_id": self.obs.id, "name": "test.com", "_paginationToken": "t1"}, {"_id": self.obs.id, "name": "test2.com", "_paginationToken": "t2"}]
+        with patch(
+            "mongomock.aggregate.process_pipeline",
+            side_effect=[
+                command_cursor.CommandCursor([dict(row) for row in rows]),
+                command_cursor.CommandCursor([dict(row) for row in rows[:1]]),
+            ],
+        ) as mock:
+            qs = self.base.filter(name="test.com").order_by("name")
+            page = qs.paginate_after(None, 2)
+            self.assertEqual(["test.com", "test2.com"], [obj.name for obj in page.documents])
+            self.assertEqual("t2", page.next_token)
+            self.assertIsNone(page.prev_token)
+            pipeline = mock.call_args[0][2]
+            self.assertNotIn("searchAfter", pipeline[0]["$search"])
+            self.assertEqual({"name": 1}, pipeline[0]["$search"]["sort"])
+            self.assertEqual({"$limit": 2}, pipeline[1])
+            self.assertEqual({"$addFields": {"_paginationToken": {"$meta": "searchSequenceToken"}}}, pipeline[-1])
+            page = qs.paginate_after(page.next_token, 2)
+            self.assertEqual("t2", mock.call_args[0][2][0]["$search"]["searchAfter"])
+            self.assertEqual(1, len(page.documents))
+            self.assertIsNone(page.next_token)
+            self.assertEqual("t1", page.prev_token)
+
+    def test_paginate_before(self):
+        rows = [{"_id": self.obs.id, "name": "test2.com", "_paginationToken": "t2"}, {"_id": self.obs.id, "name": "test.com", "_paginationToken": "t1"}]
+        with patch(
+            "mongomock.aggregate.process_pipeline",
+            side_effect=[
+                command_cursor.CommandCursor(rows),
+            ],
+        ) as mock:
+            page = self.base.filter(name="test.com").paginate_before("t3", 2)
+            self.assertEqual("t3", mock.call_args[0][2][0]["$search"]["searchBefore"])
+            self.assertEqual(["test.com", "test2.com"], [obj.name for obj in page.documents])
+            self.assertEqual("t2", page.next_token)
+            self.assertEqual("t1", page.prev_token)
+        with self.assertRaises(AtlasQueryError):
+            self.base.filter(name="test.com").paginate_before(None, 2)
+        with self.assertRaises(AtlasQueryError):
+            self.base.paginate_after(None, 2)
+
+    def test_in_bulk_ids(self):
+        objs = [MyDocument(id=ObjectId(), name=f"test{i}.com", md5="md5", classification="domain") for i in range(5)]
+
+        def process_pipeline(collection, database, pipeline, session):  # pylint: disable=unused-argument
+            chunk = next(clause["in"]["value"] for clause in pipeline[0]["$search"]["compound"]["filter"] if "in" in clause)
+            return CommandCursor([obj.to_mongo().to_dict() for obj in objs if obj.id in chunk])
+
+        ids = [str(obj.id) for obj in objs]
+        with patch("mongomock.aggregate.process_pipeline", side_effect=process_pipeline) as mock:
+            result = list(self.base.filter(classification="domain").in_bulk_ids(ids + ids[:1], chunk_size=2, workers=2))
+            self.assertEqual(3, mock.call_count)
+            self.assertEqual([obj.id for obj in objs], [obj.id for obj in result])
+            search = mock.call_args_list[0][0][2][0]["$search"]
+            self.assertEqual(
+                [{"text": {"query": "domain", "path": "classification"}}, {"in": {"path": "_id", "value": [objs[0].id, objs[1].id]}}],
+                sorted(search["compound"]["filter"], key=lambda clause: "in" in clause),
+            )
+
+            mock.reset_mock()
+            iterator = self.base.in_bulk_ids(ids, chunk_size=1, workers=1)
+            self.assertEqual(objs[0].id, next(iterator).id)
+            iterator.close()
+            self.assertLessEqual(mock.call_count, 2)
+
+        # the arguments are validated on the call, before iterating
+        with self.assertRaises(AtlasQueryError):
+            self.base.in_bulk_ids(ids, chunk_size=0)
+        with self.assertRaises(AtlasQueryError):
+            self.base.in_bulk_ids(ids, workers=0)
+        with self.assertRaises(AtlasQueryError):
+            self.base.limit(3).in_bulk_ids(ids)
+        with self.assertRaises(TypeError):
+            self.base.in_bulk_ids(ids + [3])
+
+    def test_paginate(self):
+        with patch(
+            "mongomock.aggregate.process_pipeline",
+            side_effect=[
+                command_cursor.CommandCursor(
+                    [
+                        {
+                            "documents": [{"_id": self.obs.id, "name": self.obs.name}],
+                            "meta": [{"count": {"total": 11}}],
+                        }
+                    ]
+                ),
+            ],
+        ) as mock:
+            page = self.base.only("name").filter(name="test.com").paginate(3, 5)
+            mock.assert_called_once()
+            self.assertEqual(11, page.total)
+            self.assertEqual([self.obs.name], [obj.name for obj in page.documents])
+            search, facet = mock.call_args[0][2]
+            self.assertEqual({"type": "total"}, search["$search"]["count"])
+            self.assertEqual(
+                {
+                    "$facet": {
+                        "documents": [{"$skip": 10}, {"$limit": 5}, {"$project": {"name": 1}}],
+                        "meta": [{"$replaceWith": "$$SEARCH_META"}, {"$limit": 1}],
+                    }
+                },
+                facet,
+            )
+        self.obs.save()
+        page = self.base.paginate(1, 5)
+        self.assertEqual(1, page.total)
+        self.assertEqual([self.obs], page.documents)
+        with self.assertRaises(AtlasQueryError):
+            self.base.paginate(0, 5)
@@ -4,7 +4,7 @@ from unittest import expectedFailure
 
 from atlasq.queryset.exceptions import AtlasFieldError, AtlasIndexFieldError
 from atlasq.queryset.index import AtlasIndex
-from atlasq.queryset.node import AtlasQ
+from atlasq.queryset.node import AtlasQ, Param
 from atlasq.queryset.transform import AtlasTransform
 from bson import ObjectId
 from mongoengine import Document, fields
@@ -21,22 +21,9 @@ class TestTransformSteps(TestBaseCase):
         self.assertEqual(
             result,
             {
-                "compound": {
-                    "should": [
-                        {
-                            "equals": {
-                                "path": "f",
-                                "value": nnow,
-                            }
-                        },
-                        {
-                            "equals": {
-                                "path": "f",
-                                "value": tomorrow,
-                            }
-                        },
-                    ],
-                    "minimumShouldMatch": 1,
+                "in": {
+                    "path": "f",
+                    "value": [nnow, tomorrow],
                 }
             },
         )
@@ -63,22 +50,9 @@ class TestTransformSteps(TestBaseCase):
         self.assertEqual(
             result,
             {
-                "compound": {
-                    "should": [
-                        {
-                            "equals": {
-                                "path": "f",
-                                "value": True,
-                            }
-                        },
-                        {
-                            "equals": {
-                                "path": "f",
-                                "value": False,
-                            }
-                        },
-                    ],
-                    "minimumShouldMatch": 1,
+                "in": {
+                    "path": "f",
+                    "value": [True, False],
                 }
             },
         )
@@ -118,22 +92,9 @@ class TestTransformSteps(TestBaseCase):
         self.assertEqual(
             result,
             {
-                "compound": {
-                    "should": [
-                        {
-                            "equals": {
-                                "path": "f",
-                                "value": ObjectId("5e45de3dd2bfea029b68cce2"),
-                            }
-                        },
-                        {
-                            "equals": {
-                                "path": "f",
-                                "value": ObjectId("5e45de3dd2bfea029b68cce3"),
-                            }
-                        },
-                    ],
-                    "minimumShouldMatch": 1,
+                "in": {
+                    "path": "f",
+                    "value": [ObjectId("5e45de3dd2bfea029b68cce2"), ObjectId("5e45de3dd2bfea029b68cce3")],
                 }
             },
         )
@@ -413,6 +374,41 @@ class TestTransformSteps(TestBaseCase):
             },
         )
 
+    def test_token(self):
+        index = AtlasIndex("test")
+        index._set_indexed_from_mappings(
+            {
+                "mappings": {
+                    "dynamic": False,
+                    "fields": {
+                        "token": [{"type": "string"}, {"type": "token"}],
+                        "keyword": {"type": "string", "multi": {"exact": {"type": "string", "analyzer": "lucene.keyword"}}},
+                        "string": {"type": "string"},
+                    },
+                }
+            }
+        )
+        q = AtlasQ(token="aaa", token__exact="bbb", keyword="ccc", string="ddd", token__ne="eee", token__in=["f", "g"], token__contains="h")
+        positive, negative, _ = AtlasTransform(q.query, index).transform()
+        # before the index is ensured, the types are unknown
+        self.assertEqual({"text": {"query": "aaa", "path": "token"}}, positive[0])
+        index.ensured = True
+        positive, negative, _ = AtlasTransform(q.query, index).transform()
+        self.assertEqual(
+            [
+                {"equals": {"path": "token", "value": "aaa"}},
+                {"equals": {"path": "token", "value": "bbb"}},
+                {"text": {"query": "ccc", "path": {"value": "keyword", "multi": "exact"}}},
+                {"text": {"query": "ddd", "path": "string"}},
+                {"in": {"path": "token", "value": ["f", "g"]}},
+                {"text": {"query": "h", "path": "token"}},
+            ],
+            positive,
+        )
+        self.assertEqual([{"equals": {"path": "token", "value": "eee"}}], negative)
+        with self.assertRaises(AtlasFieldError):
+            AtlasTransform({}, index)._single_equals("string", "aaa")
+
     def test__multiple_check_single_embedded_document(self):
         index = AtlasIndex("test")
         index.ensured = True
@@ -610,7 +606,7 @@ class TestTransformSteps(TestBaseCase):
         with self.assertRaises(AtlasIndexFieldError):
             AtlasTransform(q.query, index).transform()
 
-        index._indexed_fields["field.field2"] = "string"
+        index._indexed_fields = {**index._indexed_fields, "field.field2": "string"}
         try:
             AtlasTransform(q.query, index).transform()
         except AtlasIndexFieldError as e:
@@ -741,16 +737,47 @@ class TestTransformSteps(TestBaseCase):
         q = AtlasQ(f=3)
         t = AtlasTransform(q.query, AtlasIndex("test"))
         res = t._equals("field", [True])
-        self.assertIn("compound", res)
-        self.assertIn("minimumShouldMatch", res["compound"])
-        self.assertEqual(1, res["compound"]["minimumShouldMatch"])
-        self.assertIn("should", res["compound"])
-        self.assertEqual(1, len(res["compound"]["should"]))
-        self.assertIn("equals", res["compound"]["should"][0])
-        self.assertIn("path", res["compound"]["should"][0]["equals"])
-        self.assertIn("value", res["compound"]["should"][0]["equals"])
-        self.assertEqual(res["compound"]["should"][0]["equals"]["path"], "field")
-        self.assertEqual(res["compound"]["should"][0]["equals"]["value"], True)
+        self.assertIn("in", res)
+        self.assertEqual(res["in"]["path"], "field")
+        self.assertEqual(res["in"]["value"], [True])
+
+    def test__equals_list_params(self):
+        q = AtlasQ(f=3)
+        t = AtlasTransform(q.query, AtlasIndex("test"))
+        res = t._equals("field", [Param("a", bool), Param("b", bool)])
+        self.assertEqual(
+            {
+                "compound": {
+                    "should": [
+                        {"equals": {"path": "field", "value": Param("a", bool)}},
+                        {"equals": {"path": "field", "value": Param("b", bool)}},
+                    ],
+                    "minimumShouldMatch": 1,
+                }
+            },
+            res,
+        )
+
+    def test__in_chunks(self):
+        q = AtlasQ(f=3)
+        t = AtlasTransform(q.query, AtlasIndex("test"))
+        t.in_chunk_size = 2
+        res = t._in("field", [1, 2, 3, 4, 5])
+        self.assertEqual(
+            {
+                "compound": {
+                    "should": [
+                        {"in": {"path": "field", "value": [1, 2]}},
+                        {"in": {"path": "field", "value": [3, 4]}},
+                        {"in": {"path": "field", "value": [5]}},
+                    ],
+                    "minimumShouldMatch": 1,
+                }
+            },
+            res,
+        )
+        with self.assertRaises(AtlasFieldError):
+            t._in("field", [1, None])
 
     def test_equal(self):
         q = AtlasQ(f=3)
@@ -772,11 +799,40 @@ class TestTransformSteps(TestBaseCase):
         q = AtlasQ(f__startswith="test?")
         t = AtlasTransform(q.query, AtlasIndex("test"))
         res = t._startswith("f", "test?")
-        self.assertIn("regex", res)
-        self.assertIn("query", res["regex"])
-        self.assertIn("test\\?.*", res["regex"]["query"])
-        self.assertIn("path", res["regex"])
-        self.assertIn("f", res["regex"]["path"])
+        self.assertEqual({"wildcard": {"query": "test\\?*", "path": "f", "allowAnalyzedField": True}}, res)
+
+    def test_convert_startswith_index(self):
+        index = AtlasIndex("test")
+        index._set_indexed_from_mappings(
+            {
+                "analyzers": [{"name": "reverse", "tokenizer": {"type": "keyword"}, "tokenFilters": [{"type": "reverse"}]}],
+                "mappings": {
+                    "dynamic": False,
+                    "fields": {
+                        "auto": [{"type": "string"}, {"type": "autocomplete"}],
+                        "keyword": {
+                            "type": "string",
+                            "multi": {
+                                "exact": {"type": "string", "analyzer": "lucene.keyword"},
+                                "reversed": {"type": "string", "analyzer": "reverse"},
+                            },
+                        },
+                    },
+                },
+            }
+        )
+        index.ensured = True
+        t = AtlasTransform({}, index)
+        self.assertEqual({"autocomplete": {"query": "te", "path": "auto", "tokenOrder": "sequential"}}, t._startswith("auto", "te"))
+        self.assertEqual(
+            {"wildcard": {"query": "te*", "path": {"value": "keyword", "multi": "exact"}, "allowAnalyzedField": True}},
+            t._startswith("keyword", "te"),
+        )
+        self.assertEqual(
+            {"wildcard": {"query": "tse*", "path": {"value": "keyword", "multi": "reversed"}, "allowAnalyzedField": True}},
+            t._endswith("keyword", "est"),
+        )
+        self.assertEqual({"regex": {"query": ".*est", "path": "auto"}}, t._endswith("auto", "est"))
 
     def test_convert_endswith(self):
         q = AtlasQ(f__endswith="test?")
@@ -822,6 +878,25 @@ class TestTransformSteps(TestBaseCase):
         self.assertEqual(res["$match"]["field"]["$exists"], True)
         self.assertCountEqual(res["$match"]["field"]["$ne"], [None, [], ""])
 
+    def test_parse_key(self):
+        AtlasTransform._parse_key.cache_clear()
+        plan = AtlasTransform._parse_key("field__subfield__not__gte")
+        self.assertEqual(("field.subfield", False, False, 0, "_range", (("gte",),)), plan[:6])
+        self.assertIs(plan, AtlasTransform._parse_key("field__subfield__not__gte"))
+        self.assertEqual(1, AtlasTransform._parse_key.cache_info().hits)
+        plan = AtlasTransform._parse_key("field__id__in")
+        self.assertEqual(("field._id", True, True, 0, "_auto_convert_type_to_keyword", ()), plan[:6])
+        self.assertIsNone(plan.param_error)
+        plan = AtlasTransform._parse_key("field__size")
+        self.assertEqual(("field", "_size"), (plan.path, plan.handler))
+        self.assertEqual("Keyword size does not support parameters", plan.param_error)
+        plan = AtlasTransform._parse_key("field__type")
+        self.assertEqual((1, "_auto_convert_type_to_keyword"), (plan.types, plan.handler))
+        with self.assertRaises(NotImplementedError):
+            AtlasTransform._parse_key("field__size__ne")
+        with self.assertRaises(NotImplementedError):
+            AtlasTransform._parse_key("field__mod")
+
 
 class TestAtlasQ(TestBaseCase):
     def test_ids_in(self):
@@ -831,22 +906,32 @@ class TestAtlasQ(TestBaseCase):
         self.assertEqual(negative, [])
         self.assertEqual(
             {
-                "compound": {
-                    "should": [
-                        {
-                            "equals": {
-                                "path": "_id",
-                                "value": ObjectId("5e45de3dd2bfea029b68cce2"),
-                            }
-                        }
-                    ],
-                    "minimumShouldMatch": 1,
+                "in": {
+                    "path": "_id",
+                    "value": [ObjectId("5e45de3dd2bfea029b68cce2")],
                 }
             },
             positive[0],
             json.dumps(positive, indent=4, default=str),
         )
 
+    def test_ids_nin(self):
+        q1 = AtlasQ(id__nin=["5e45de3dd2bfea029b68cce2", "5e45de3dd2bfea029b68cce3"])
+        positive, negative, aggregations = AtlasTransform(q1.query, AtlasIndex("test")).transform()
+        self.assertEqual(aggregations, [])
+        self.assertEqual(positive, [])
+        self.assertEqual(
+            [
+                {
+                    "in": {
+                        "path": "_id",
+                        "value": [ObjectId("5e45de3dd2bfea029b68cce2"), ObjectId("5e45de3dd2bfea029b68cce3")],
+                    }
+                }
+            ],
+            negative,
+        )
+
     def test_size_val(self):
         q1 = AtlasQ(key__size=1)
         with self.assertRaises(NotImplementedError):